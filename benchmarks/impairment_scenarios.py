@@ -0,0 +1,186 @@
+"""
+Benchmark scenarios for txThings over impaired network links.
+
+Every scenario runs a client and a server protocol connected with
+a pair of txthings.impairment links in simulated time, and reports
+completion time and retransmission overhead (CON retransmissions, or
+for Q-Block transfers the number of blocks recovered after loss) for:
+- GET - single-block request and response
+- PUT/Block1 - blockwise request
+- GET/Block2 - blockwise response
+- PUT/Q-Block1, GET/Q-Block2 - the same transfers with Q-Block (RFC 9177)
+- Observe - registration followed by a series of notifications
+
+Usage:
+    python benchmarks/impairment_scenarios.py [runs] [seed]
+"""
+import sys
+
+from twisted.internet import defer, task
+
+from ipaddress import ip_address
+
+import txthings.coap as coap
+import txthings.resource as resource
+import txthings.impairment as impairment
+
+SERVER_ADDRESS = (u"10.0.0.1", coap.COAP_PORT)
+CLIENT_ADDRESS = (u"10.0.0.2", 61616)
+
+LARGE_PAYLOAD = b"0123456789abcdef" * 64  # 1 KiB - 16 blocks of 64 bytes
+NOTIFICATIONS = 10
+NOTIFICATION_INTERVAL = 5.0
+
+PROFILES = [
+    ('lossless', dict(delay=0.05)),
+    ('loss 5%', dict(loss=0.05, delay=impairment.uniformDelay(0.04, 0.06))),
+    ('loss 10%', dict(loss=0.10, delay=impairment.uniformDelay(0.04, 0.06))),
+    ('loss 20% jitter', dict(loss=0.20, delay=impairment.normalDelay(0.1, 0.05))),
+    ('loss 30% reorder', dict(loss=0.30, delay=impairment.uniformDelay(0.05, 0.3), reorder=0.1, reorder_delay=0.5, duplicate=0.05)),
+    ('loss 5% 2kB/s', dict(loss=0.05, delay=0.2, bandwidth=2000, queue_limit=4000)),
+]
+
+
+class SmallResource(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=b"22.5 C"))
+
+
+class LargeResource(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=LARGE_PAYLOAD))
+
+    def render_PUT(self, request):
+        code = coap.CHANGED if request.payload == LARGE_PAYLOAD else coap.BAD_REQUEST
+        return defer.succeed(coap.Message(code=code))
+
+
+class ObservedResource(resource.CoAPResource):
+    observable = True
+
+    def __init__(self):
+        resource.CoAPResource.__init__(self)
+        self.value = 0
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=b"%d" % self.value))
+
+    def change(self):
+        self.value += 1
+        self.updatedState()
+
+
+def setUp(clock, seed, profile):
+    root = resource.CoAPResource()
+    root.putChild(b'small', SmallResource())
+    root.putChild(b'large', LargeResource())
+    observed = ObservedResource()
+    root.putChild(b'obs', observed)
+    server = coap.Coap(resource.Endpoint(root), clock=clock)
+    client = coap.Coap(resource.Endpoint(None), clock=clock)
+    links = impairment.connect(clock, client, CLIENT_ADDRESS, server, SERVER_ADDRESS, seed=seed, **profile)
+    return client, observed, links
+
+
+def makeRequest(code, path, payload=b""):
+    request = coap.Message(code=code, payload=payload)
+    request.opt.uri_path = (path,)
+    request.remote = (ip_address(SERVER_ADDRESS[0]), SERVER_ADDRESS[1])
+    return request
+
+
+def scenarioGet(clock, client, observed):
+    return client.request(makeRequest(coap.GET, b'small'))
+
+
+def scenarioBlock1(clock, client, observed):
+    return client.request(makeRequest(coap.PUT, b'large', LARGE_PAYLOAD))
+
+
+def scenarioBlock2(clock, client, observed):
+    return client.request(makeRequest(coap.GET, b'large'))
+
+
+def scenarioQBlock1(clock, client, observed):
+    return client.request(makeRequest(coap.PUT, b'large', LARGE_PAYLOAD), qBlock=True)
+
+
+def scenarioQBlock2(clock, client, observed):
+    return client.request(makeRequest(coap.GET, b'large'), qBlock=True)
+
+
+def scenarioObserve(clock, client, observed):
+    """Register observation, then change the resource periodically.
+       Fires when the last notification arrives."""
+    done = defer.Deferred()
+    values = set()
+
+    def notified(response):
+        values.add(int(response.payload))
+        if observed.value in values and observed.value == NOTIFICATIONS and not done.called:
+            done.callback(len(values))
+
+    request = makeRequest(coap.GET, b'obs')
+    request.opt.observe = 0
+    client.request(request, observeCallback=notified)
+    for i in range(NOTIFICATIONS):
+        clock.callLater(NOTIFICATION_INTERVAL * (i + 1), observed.change)
+    return done
+
+SCENARIOS = [
+    ('GET', scenarioGet),
+    ('PUT/Block1', scenarioBlock1),
+    ('GET/Block2', scenarioBlock2),
+    ('PUT/Q-Block1', scenarioQBlock1),
+    ('GET/Q-Block2', scenarioQBlock2),
+    ('Observe', scenarioObserve),
+]
+
+
+def runScenario(scenario, profile, seed):
+    clock = task.Clock()
+    client, observed, links = setUp(clock, seed, profile)
+    start = clock.seconds()
+    d = scenario(clock, client, observed)
+    # Q-Block transfers recover lost blocks with NON requests, not
+    # CON retransmissions - their recovery is counted by the client
+    qblock = [transfer for transfer in client.outgoing_requests.values()
+              if isinstance(transfer, coap.QBlockClient)]
+    outcome = impairment.runUntilFired(clock, d, limit=coap.EXCHANGE_LIFETIME)
+    elapsed = clock.seconds() - start
+    succeeded = bool(outcome) and not hasattr(outcome[0], 'trap')
+    con_sent = sum(link.stats.con_sent for link in links)
+    retransmitted = sum(link.stats.con_retransmitted for link in links)
+    packets = sum(link.stats.packets_sent for link in links)
+    recovered = sum(transfer.recovered for transfer in qblock) if qblock else None
+    return succeeded, elapsed, con_sent, retransmitted, packets, recovered
+
+
+def main(argv):
+    runs = int(argv[1]) if len(argv) > 1 else 20
+    seed = int(argv[2]) if len(argv) > 2 else 1
+    print("%-18s %-12s %5s %10s %10s %10s %10s %8s" % ("profile", "scenario", "ok", "mean [s]",
+                                                       "max [s]", "retrans %", "recovered", "packets"))
+    for profile_name, profile in PROFILES:
+        for scenario_name, scenario in SCENARIOS:
+            results = [runScenario(scenario, profile, seed + 2 * i) for i in range(runs)]
+            ok = [r for r in results if r[0]]
+            times = [r[1] for r in ok] or [float('nan')]
+            con_sent = sum(r[2] for r in results)
+            retransmitted = sum(r[3] for r in results)
+            packets = sum(r[4] for r in results) / float(runs)
+            if results[0][5] is None:
+                overhead = "%.1f" % (100.0 * retransmitted / con_sent if con_sent else 0.0)
+                recovered = "n/a"
+            else:
+                overhead = "n/a"
+                recovered = "%.1f" % (sum(r[5] for r in results) / float(runs))
+            print("%-18s %-12s %2d/%-2d %10.2f %10.2f %10s %10s %8.1f" % (
+                profile_name, scenario_name, len(ok), runs,
+                sum(times) / len(times), max(times), overhead, recovered, packets))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
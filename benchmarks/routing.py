@@ -0,0 +1,110 @@
+"""
+Routing benchmark for txThings resource trees.
+
+Builds a static resource tree with given fan-out and depth (default
+10 and 5 - 111111 resources), then measures time needed to find
+resources for random paths of the deepest level:
+- baseline - Endpoint.getResourceFor as it was before routing index
+  (copy of prepath followed by segment by segment traversal)
+- indexed - Endpoint.getResourceFor (routing index lookup)
+- dynamic - Endpoint.getResourceFor for paths below a resource
+  with dynamic getChild (index miss followed by traversal)
+
+Every variant is run once as a warm-up, then repeat times (default 5)
+in turns, so the order of measurements doesn't favour any of them.
+The best and the median time per lookup are reported.
+
+Usage:
+    python benchmarks/routing.py [fanout] [depth] [lookups] [repeat]
+"""
+import copy
+import random
+import sys
+import timeit
+
+import txthings.coap as coap
+import txthings.resource as resource
+
+
+class DynamicResource(resource.CoAPResource):
+
+    def getChild(self, path, request):
+        return self
+
+
+def buildTree(fanout, depth):
+    """Return root of a tree and list of paths of its deepest resources."""
+    root = resource.CoAPResource()
+    level = [((), root)]
+    for i in range(depth):
+        next_level = []
+        for path, parent in level:
+            for n in range(fanout):
+                name = b"r%d" % n
+                child = resource.CoAPResource()
+                parent.putChild(name, child)
+                next_level.append((path + (name,), child))
+        level = next_level
+    return root, [path for path, child in level]
+
+
+def makeRequest(path):
+    request = coap.Message(code=coap.GET)
+    request.opt.uri_path = path
+    return request
+
+
+def indexedLookup(endpoint, request):
+    request.prepath = []
+    request.postpath = request.opt.uri_path
+    return endpoint.getResourceFor(request)
+
+
+def baselineLookup(endpoint, request):
+    """Endpoint.getResourceFor without routing index."""
+    request.prepath = []
+    request.postpath = list(request.opt.uri_path)
+    request.sitepath = copy.copy(request.prepath)
+    return resource.getChildForRequest(endpoint.resource, request)
+
+
+def measure(function, target, requests):
+    start = timeit.default_timer()
+    for request in requests:
+        function(target, request)
+    return (timeit.default_timer() - start) / len(requests)
+
+
+def main(argv):
+    fanout = int(argv[1]) if len(argv) > 1 else 10
+    depth = int(argv[2]) if len(argv) > 2 else 5
+    lookups = int(argv[3]) if len(argv) > 3 else 100000
+    repeat = int(argv[4]) if len(argv) > 4 else 5
+    start = timeit.default_timer()
+    root, paths = buildTree(fanout, depth)
+    root.putChild(b'dynamic', DynamicResource())
+    build_time = timeit.default_timer() - start
+    start = timeit.default_timer()
+    endpoint = resource.Endpoint(root)
+    index_time = timeit.default_timer() - start
+    print("%d resources, tree built in %.2f s, indexed in %.2f s" % (len(endpoint.routes), build_time, index_time))
+    rng = random.Random(1)
+    requests = [makeRequest(rng.choice(paths)) for i in range(lookups)]
+    dynamic_requests = [makeRequest((b'dynamic',) + rng.choice(paths)) for i in range(lookups)]
+    variants = [("baseline", baselineLookup, requests),
+                ("indexed", indexedLookup, requests),
+                ("dynamic", indexedLookup, dynamic_requests)]
+    times = dict((name, []) for name, function, variant_requests in variants)
+    for run in range(repeat + 1):
+        for name, function, variant_requests in variants:
+            elapsed = measure(function, endpoint, variant_requests)
+            if run > 0:  # first run is a warm-up
+                times[name].append(elapsed)
+    print("%-10s %12s %12s" % ("lookup", "best [us]", "median [us]"))
+    for name, function, variant_requests in variants:
+        results = sorted(times[name])
+        print("%-10s %12.2f %12.2f" % (name, 1e6 * results[0], 1e6 * results[len(results) // 2]))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,42 @@
+"""
+Simulated device fleet example.
+
+Starts a fleet of virtual devices behind a single UDP socket.
+Each device is addressed by its name in Uri-Host option, e.g.:
+
+    coap://dev-17/sensors/temp  (sent to this host, port 5683)
+
+Optionally every device registers itself in a Resource Directory
+(see rd.py) running at given address and port:
+
+    python fleet.py 1000 127.0.0.1 5684
+"""
+import sys
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from ipaddress import ip_address
+
+import txthings.coap as coap
+import txthings.fleet as fleet
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+log.startLogging(sys.stdout, setStdout=False)
+devices = fleet.DeviceFleet()
+devices.addDevices(count, behavior=fleet.DeviceBehavior(latency=0.05, observe_interval=30, payload_size=32))
+devices.addDevices(count // 10, prefix=b'big-', behavior=fleet.DeviceBehavior(latency=0.5, observe_interval=60, payload_size=1024))
+reactor.listenUDP(coap.COAP_PORT, devices.protocol)
+
+if len(sys.argv) > 2:
+    rd = (ip_address(u'%s' % sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else coap.COAP_PORT)
+
+    def register(device):
+        d = device.registerWith(rd)
+        d.addErrback(log.err)
+
+    for i, device in enumerate(devices.devices.values()):
+        reactor.callLater(i * 0.01, register, device)
+
+reactor.run()
@@ -73,7 +73,7 @@ class DirectoryResource (resource.CoAPResource):
         endpoint = params['ep']
         
         if endpoint in self.directory:
-            del self.children[self.directory[endpoint]]
+            self.delEntity(self.directory[endpoint])
         else:
             self.directory[endpoint] = str(self.eid)
             self.eid += 1
@@ -146,7 +146,7 @@ class DirectoryEntryResource (resource.CoAPResource):
         Remove this resource. Used by both expiry and deletion.
         """
         location = self.parent.directory.pop(self.endpoint)
-        del(self.parent.children[location])
+        self.parent.delEntity(location)
 
 
 class EndpointLookupResource (resource.CoAPResource):
@@ -14,6 +14,7 @@ from twisted.python import log
 
 import txthings.resource as resource
 import txthings.coap as coap
+import txthings.metrics as metrics
 
 
 class CounterResource (resource.CoAPResource):
@@ -79,8 +80,13 @@ class SeparateLargeResource(resource.CoAPResource):
 
     Method responseReady uses d.callback(response) to "fire" the deferred,
     and send the response.
+
+    With single_flight set, GET requests arriving while the response
+    is being prepared share the pending deferred (render_GET is called
+    once for all of them).
     """
     #isLeaf = wTrue
+    single_flight = True
 
     def __init__(self):
         resource.CoAPResource.__init__(self)
@@ -152,6 +158,8 @@ well_known = resource.CoAPResource()
 root.putChild('.well-known', well_known)
 core = CoreResource(root)
 well_known.putChild('core', core)
+protocol_metrics = metrics.CoapMetrics()
+well_known.putChild('stats', metrics.StatsResource(protocol_metrics))
 
 counter = CounterResource(5000)
 root.putChild('counter', counter)
@@ -169,5 +177,5 @@ separate = SeparateLargeResource()
 other.putChild('separate', separate)
 
 endpoint = resource.Endpoint(root)
-reactor.listenUDP(coap.COAP_PORT, coap.Coap(endpoint)) #, interface="::")
+reactor.listenUDP(coap.COAP_PORT, coap.Coap(endpoint, metrics=protocol_metrics)) #, interface="::")
 reactor.run()
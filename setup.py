@@ -17,4 +17,7 @@ setup(name='txThings',
       url='https://github.com/siskin/txThings/',
       packages=find_packages(exclude=["*.test", "*.test.*"]),
       install_requires = ['twisted>=14.0.0', 'six>=1.10.0'] + py2_ipa,
+      entry_points={
+          'console_scripts': ['coap-bench = txthings.bench:main'],
+      },
      )
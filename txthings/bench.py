@@ -0,0 +1,389 @@
+"""
+Load generator for CoAP servers (coap-bench).
+
+Sends requests with Coap.request at configurable concurrency and rate
+and reports throughput, latency percentiles, retransmissions and
+timeouts. Optionally registers a number of observations (observe fan-in)
+and counts incoming notifications. With --local a benchmark server is
+started in the same process and targeted over loopback.
+
+Example:
+    coap-bench --local --concurrency 50 --requests 20000
+    coap-bench 192.168.0.10 --path sensors/temp --rate 200 --duration 30
+"""
+import argparse
+import sys
+
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+
+from ipaddress import ip_address
+
+import txthings.coap as coap
+import txthings.error as error
+import txthings.metrics as metrics
+import txthings.resource as resource
+
+
+class LatencyHistogram(object):
+    """Histogram of latency values with bounded relative error.
+
+       Values are recorded in microseconds. Values below 128 us
+       are counted exactly, larger ones in logarithmic ranges
+       split into SUB_BUCKETS linear buckets (relative error
+       below 1/SUB_BUCKETS)."""
+
+    SUB_BUCKETS = 64
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 7
+        return (shift + 1) * self.SUB_BUCKETS + (value >> shift) - self.SUB_BUCKETS
+
+    def _upperBound(self, index):
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        sub = index % self.SUB_BUCKETS + self.SUB_BUCKETS
+        return ((sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Record a single latency given in seconds."""
+        value = max(0, int(seconds * 1000000))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Return latency (in seconds) below which given fraction
+           of recorded values lies."""
+        if self.total == 0:
+            return None
+        threshold = fraction * self.total
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(self._upperBound(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def mean(self):
+        if self.total == 0:
+            return None
+        return self.sum / float(self.total) / 1000000.0
+
+    def buckets(self, count=10):
+        """Return list of (upper bound in seconds, count) tuples
+           for count logarithmically spaced ranges between min and max."""
+        if self.total == 0:
+            return []
+        low = max(self.min, 1)
+        ratio = (float(self.max) / low) ** (1.0 / count) if self.max > low else 2.0
+        bounds = [low * ratio ** (i + 1) for i in range(count)]
+        bounds[-1] = max(bounds[-1], self.max)
+        result = [0] * count
+        for index, n in self.counts.items():
+            value = min(self._upperBound(index), self.max)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    result[i] += n
+                    break
+        return [(bound / 1000000.0, n) for bound, n in zip(bounds, result)]
+
+
+class BenchResource(resource.CoAPResource):
+    """Resource used by the local benchmark server. GET returns
+       a payload of configured size, PUT and POST accept anything."""
+
+    def __init__(self, payload_size):
+        resource.CoAPResource.__init__(self)
+        self.payload = b"x" * payload_size
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=self.payload))
+
+    def render_PUT(self, request):
+        return defer.succeed(coap.Message(code=coap.CHANGED))
+
+    def render_POST(self, request):
+        return defer.succeed(coap.Message(code=coap.CHANGED))
+
+    def render_DELETE(self, request):
+        return defer.succeed(coap.Message(code=coap.DELETED))
+
+
+class TickResource(resource.CoAPResource):
+    """Observable resource used by the local benchmark server.
+       Sends notification to all observers on every tick."""
+
+    observable = True
+
+    def __init__(self):
+        resource.CoAPResource.__init__(self)
+        self.ticks = 0
+
+    def tick(self):
+        self.ticks += 1
+        self.updatedState()
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=b"%d" % self.ticks))
+
+
+class BenchClient(object):
+    """Generates requests according to the configuration
+       and collects results.
+
+       Without rate the load is closed-loop: 'concurrency' requests
+       are kept in flight. With rate (requests per second) requests
+       are started at fixed intervals, unless 'concurrency' requests
+       are already in flight (such requests are counted as skipped)."""
+
+    def __init__(self, protocol, remote, path, method=coap.GET, payload_size=0, confirmable=True,
+                 concurrency=1, rate=None, requests=None, duration=None, timeout=None,
+                 observers=0, observe_path=None):
+        self.protocol = protocol
+        self.clock = protocol.clock
+        self.remote = remote
+        self.path = path
+        self.method = method
+        self.payload = b"x" * payload_size if method in (coap.PUT, coap.POST) else b""
+        self.confirmable = confirmable
+        self.concurrency = concurrency
+        self.rate = rate
+        self.requests = requests
+        self.duration = duration
+        self.timeout = timeout
+        self.observers = observers
+        self.observe_path = observe_path
+        self.histogram = LatencyHistogram()
+        self.codes = {}
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.notifications = 0
+        self.in_flight = 0
+        self.start_time = None
+        self.end_time = None
+        self.finished = None
+        self._ticker = None
+        self._stopping = False
+
+    def start(self):
+        """Start the benchmark. Returns Deferred fired with self
+           when all requests are completed."""
+        self.finished = defer.Deferred()
+        self.start_time = self.clock.seconds()
+        for i in range(self.observers):
+            self.observe()
+        if self.duration is not None:
+            self.clock.callLater(self.duration, self.stop)
+        if self.rate:
+            self._ticker = task.LoopingCall(self.tick)
+            self._ticker.clock = self.clock
+            self._ticker.start(1.0 / self.rate)
+        else:
+            for i in range(self.concurrency):
+                self.sendNext()
+        return self.finished
+
+    def stop(self):
+        """Stop issuing new requests. Benchmark finishes when
+           requests in flight complete."""
+        self._stopping = True
+        if self._ticker is not None and self._ticker.running:
+            self._ticker.stop()
+        self.checkFinished()
+
+    def checkFinished(self):
+        if self._stopping and self.in_flight == 0 and not self.finished.called:
+            self.end_time = self.clock.seconds()
+            self.finished.callback(self)
+
+    def exhausted(self):
+        return self._stopping or (self.requests is not None and self.sent >= self.requests)
+
+    def tick(self):
+        if self.exhausted():
+            self.stop()
+        elif self.in_flight >= self.concurrency:
+            self.skipped += 1
+        else:
+            self.sendOne()
+
+    def sendNext(self):
+        if self.exhausted():
+            self.stop()
+        else:
+            self.sendOne()
+
+    def makeRequest(self, path):
+        request = coap.Message(code=self.method, payload=self.payload)
+        if not self.confirmable:
+            request.mtype = coap.NON
+        request.opt.uri_path = path
+        request.remote = self.remote
+        return request
+
+    def sendOne(self):
+        self.sent += 1
+        self.in_flight += 1
+        started = self.clock.seconds()
+        d = self.protocol.request(self.makeRequest(self.path))
+        if self.timeout is not None:
+            timer = self.clock.callLater(self.timeout, d.cancel)
+        else:
+            timer = None
+        d.addCallbacks(self.gotResponse, self.gotFailure, callbackArgs=(started,))
+        d.addBoth(self.requestDone, timer)
+
+    def gotResponse(self, response, started):
+        self.completed += 1
+        self.histogram.record(self.clock.seconds() - started)
+        self.codes[response.code] = self.codes.get(response.code, 0) + 1
+
+    def gotFailure(self, failure):
+        if failure.check(defer.CancelledError, error.RequestTimedOut):
+            self.timeouts += 1
+        else:
+            self.failed += 1
+            log.msg("Request failed: %s" % failure.getErrorMessage())
+
+    def requestDone(self, result, timer):
+        if timer is not None and timer.active():
+            timer.cancel()
+        self.in_flight -= 1
+        if self.rate:
+            self.checkFinished()
+        else:
+            self.sendNext()
+
+    def observe(self):
+        request = self.makeRequest(self.observe_path)
+        request.code = coap.GET
+        request.payload = b""
+        request.opt.observe = 0
+        d = self.protocol.request(request, observeCallback=self.gotNotification)
+        d.addErrback(self.gotFailure)
+
+    def gotNotification(self, response):
+        self.notifications += 1
+
+    def report(self):
+        """Return benchmark results as a printable string."""
+        elapsed = (self.end_time or self.clock.seconds()) - self.start_time
+        lines = []
+        lines.append("Requests: sent %d, completed %d, failed %d, timed out %d, skipped %d" % (
+            self.sent, self.completed, self.failed, self.timeouts, self.skipped))
+        lines.append("Elapsed: %.3f s, throughput: %.1f req/s" % (
+            elapsed, self.completed / elapsed if elapsed > 0 else 0.0))
+        stats = self.protocol.metrics
+        if stats is not None:
+            lines.append("Retransmissions: %d, duplicates received: %d, exchange timeouts: %d" % (
+                stats.retransmissions, sum(stats.duplicates.values()), stats.timeouts.get('exchange', 0)))
+        if self.observers:
+            lines.append("Notifications: %d from %d observations (%.1f /s)" % (
+                self.notifications, self.observers, self.notifications / elapsed if elapsed > 0 else 0.0))
+        for code in sorted(self.codes):
+            lines.append("  %s: %d" % (coap.responses.get(code, str(code)), self.codes[code]))
+        if self.histogram.total:
+            lines.append("Latency [ms]: min %.3f, mean %.3f, max %.3f" % (
+                self.histogram.min / 1000.0, self.histogram.mean() * 1000, self.histogram.max / 1000.0))
+            lines.append("  " + ", ".join("%s %.3f" % (name, self.histogram.percentile(fraction) * 1000)
+                                          for name, fraction in (("p50", 0.5), ("p90", 0.9),
+                                                                 ("p99", 0.99), ("p999", 0.999))))
+            lines.append("Latency histogram:")
+            width = max(n for bound, n in self.histogram.buckets()) or 1
+            for bound, n in self.histogram.buckets():
+                lines.append("  <= %10.3f ms %8d %s" % (bound * 1000, n, "#" * (40 * n // width)))
+        return "\n".join(lines)
+
+
+def startLocalServer(payload_size, notify_rate):
+    """Start benchmark server on loopback. Returns the listening port."""
+    root = resource.CoAPResource()
+    root.putChild(b'bench', BenchResource(payload_size))
+    tick = TickResource()
+    root.putChild(b'tick', tick)
+    if notify_rate:
+        ticker = task.LoopingCall(tick.tick)
+        ticker.start(1.0 / notify_rate, now=False)
+    return reactor.listenUDP(0, coap.Coap(resource.Endpoint(root)), interface='127.0.0.1')
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog='coap-bench', description='CoAP load generator based on txThings.')
+    parser.add_argument('host', nargs='?', default='127.0.0.1', help='server IP address')
+    parser.add_argument('--port', type=int, default=coap.COAP_PORT)
+    parser.add_argument('--path', default='bench', help='Uri-Path of the target resource')
+    parser.add_argument('--method', default='GET', choices=sorted(coap.requests_rev))
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='request payload size (PUT/POST); response payload size of the local server')
+    parser.add_argument('--non', action='store_true', help='send NON requests instead of CON')
+    parser.add_argument('--concurrency', type=int, default=1, help='maximum number of requests in flight')
+    parser.add_argument('--rate', type=float, default=None, help='requests per second (default: closed loop)')
+    parser.add_argument('--requests', type=int, default=None, help='total number of requests')
+    parser.add_argument('--duration', type=float, default=None, help='benchmark duration in seconds')
+    parser.add_argument('--timeout', type=float, default=10.0, help='per-request timeout in seconds')
+    parser.add_argument('--observe', type=int, default=0, metavar='N', help='number of observations to register')
+    parser.add_argument('--observe-path', default='tick', help='Uri-Path of the observed resource')
+    parser.add_argument('--notify-rate', type=float, default=10.0,
+                        help='notifications per second sent by the local server')
+    parser.add_argument('--local', action='store_true', help='start a local benchmark server on loopback')
+    parser.add_argument('--verbose', action='store_true', help='print protocol log')
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 1000
+    return args
+
+
+def splitPath(path):
+    return tuple(segment.encode('utf-8') for segment in path.strip('/').split('/') if segment)
+
+
+def main(argv=None):
+    args = parseArguments(sys.argv[1:] if argv is None else argv)
+    if args.verbose:
+        log.startLogging(sys.stdout)
+    host, port = args.host, args.port
+    if args.local:
+        server_port = startLocalServer(args.payload_size, args.notify_rate)
+        host, port = u'127.0.0.1', server_port.getHost().port
+    protocol = coap.Coap(resource.Endpoint(None), metrics=metrics.CoapMetrics())
+    reactor.listenUDP(0, protocol, interface='127.0.0.1' if args.local else '')
+    client = BenchClient(protocol, (ip_address(u'%s' % host), port), splitPath(args.path),
+                         method=coap.requests_rev[args.method], payload_size=args.payload_size,
+                         confirmable=not args.non, concurrency=args.concurrency, rate=args.rate,
+                         requests=args.requests, duration=args.duration, timeout=args.timeout,
+                         observers=args.observe, observe_path=splitPath(args.observe_path))
+
+    def done(client):
+        print(client.report())
+        reactor.stop()
+
+    def failed(failure):
+        print(failure.getTraceback())
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: client.start().addCallbacks(done, failed))
+    reactor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,13 +7,16 @@ from itertools import chain
 import codecs
 import collections
 import copy
+import hashlib
 import random
 import struct
 import sys
+import tempfile
 
 from twisted.internet import protocol, defer, reactor
 from twisted.python import log, failure
 import txthings.error as error
+import txthings.streaming as streaming
 
 from ipaddress import ip_address
 
@@ -90,6 +93,68 @@ i.e. message layer information about the message exchange can be purged"""
 DEFAULT_BLOCK_SIZE_EXP = 2  # Block size 64
 """Default size exponent for blockwise transfers."""
 
+MAX_BLOCK_SIZE_EXP = 6  # Block size 1024
+"""Largest size exponent allowed by RFC 7959."""
+
+BLOCK_OVERHEAD = 100
+"""Bytes of a datagram reserved for IP, UDP and CoAP headers and options
+   when block size is derived from path MTU (IPv6 + UDP headers take 48)."""
+
+MAX_PAYLOADS = 10
+"""Number of Q-Block payloads sent in one burst (RFC 9177)."""
+
+MAX_QBLOCK_NUMBER = 2 ** 20
+"""Largest Q-Block block number accepted from peers."""
+
+NON_TIMEOUT = ACK_TIMEOUT
+"""Time Q-Block sender waits after a burst
+   before it continues on its own (RFC 9177)."""
+
+NON_RECEIVE_TIMEOUT = 2 * NON_TIMEOUT
+"""Time Q-Block receiver waits for missing payloads
+   before asking for them (RFC 9177)."""
+
+NON_MAX_RETRANSMIT = MAX_RETRANSMIT
+"""Number of times Q-Block endpoint repeats its request
+   for missing payloads without any progress (RFC 9177)."""
+
+NON_PARTIAL_TIMEOUT = EXCHANGE_LIFETIME
+"""Time after which Q-Block sender forgets the body
+   if receiver does not ask for more payloads (RFC 9177)."""
+
+DEFAULT_MAX_AGE = 60
+"""Freshness lifetime (in seconds) of response without Max-Age option."""
+
+REPRESENTATION_CACHE_SIZE = 4 * 1024 * 1024
+"""Default number of payload bytes kept by RepresentationCache."""
+
+CLIENT_CACHE_ENTRIES = 1000
+"""Default number of responses kept by ClientCache."""
+
+CLIENT_CACHE_SIZE = 1024 * 1024
+"""Default number of payload bytes kept by ClientCache."""
+
+MAX_BLOCKWISE_SESSIONS = 1000
+"""Default limit of unfinished incoming blockwise transfers."""
+
+MAX_PEER_SESSIONS = 16
+"""Default limit of unfinished incoming blockwise transfers from one peer."""
+
+MAX_BLOCKWISE_BUFFER = 64 * 1024 * 1024
+"""Default limit of payload bytes held by all unfinished
+   incoming blockwise transfers."""
+
+MAX_PEER_BUFFER = 8 * 1024 * 1024
+"""Default limit of payload bytes held by unfinished incoming
+   blockwise transfers from one peer."""
+
+MAX_BODY_SIZE = None
+"""Default largest request body accepted blockwise (None - unlimited,
+   memory is still bounded by buffer limits). Applications may set
+   a limit for the whole server (SessionTable) or for a resource
+   (CoAPResource.max_body_size) - larger requests get 4.13 Request
+   Entity Too Large."""
+
 EMPTY_ACK_DELAY = 0.1
 """After this time protocol sends empty ACK, and separate response"""
 
@@ -123,6 +188,7 @@ GET = 1
 POST = 2
 PUT = 3
 DELETE = 4
+FETCH = 5
 CREATED = 65
 DELETED = 66
 VALID = 67
@@ -150,7 +216,8 @@ PROXYING_NOT_SUPPORTED = 165
 requests = {1: 'GET',
             2: 'POST',
             3: 'PUT',
-            4: 'DELETE'}
+            4: 'DELETE',
+            5: 'FETCH'}
 
 requests_rev = {v:k for k, v in requests.items()}
 
@@ -224,10 +291,12 @@ CONTENT_FORMAT = 12
 MAX_AGE = 14
 URI_QUERY = 15
 ACCEPT = 17
+Q_BLOCK1 = 19
 LOCATION_QUERY = 20
 BLOCK2 = 23
 BLOCK1 = 27
 SIZE2 = 28
+Q_BLOCK2 = 31
 PROXY_URI = 35
 PROXY_SCHEME = 39
 SIZE1 = 60
@@ -244,10 +313,12 @@ options = {1: 'If-Match',
            14: 'Max-Age',
            15: 'Uri-Query',
            17: 'Accept',
+           19: 'Q-Block1',
            20: 'Location-Query',
            23: 'Block2',
            27: 'Block1',
            28: 'Size2',
+           31: 'Q-Block2',
            35: 'Proxy-Uri',
            39: 'Proxy-Scheme',
            60: 'Size1'}
@@ -260,7 +331,8 @@ media_types = {0: 'text/plain',
                42: 'application/octet-stream',
                47: 'application/exi',
                50: 'application/json',
-               60: 'application/cbor'}
+               60: 'application/cbor',
+               272: 'application/missing-blocks+cbor-seq'}
 """A map from CoAP-assigned integral codes to Internet media type descriptions."""
 
 media_types_rev = {v:k for k, v in media_types.items()}
@@ -282,6 +354,8 @@ class Message(object):
         self.remote = None
         self.prepath = None
         self.postpath = None
+        self.body = None  # file holding payload of spooled blockwise request (payload is empty then)
+        self.route_params = {}  # parameters of route template matched by request path
 
         if self.payload is None:
             raise TypeError("Payload must not be None. Use empty string instead.")
@@ -321,25 +395,36 @@ class Message(object):
         start = number * size
         if start < len(self.payload):
             end = start + size if start + size < len(self.payload) else len(self.payload)
-            block = copy.deepcopy(self)
-            block.payload = block.payload[start:end]
-            block.mid = None
             more = True if end < len(self.payload) else False
-            if isRequest(block.code):
-                block.opt.block1 = (number, more, size_exp)
-                block.opt.size1 = len(self.payload)
-            else:
-                block.opt.block2 = (number, more, size_exp)
-                block.opt.size2 = len(self.payload)
-            return block
+            return self.blockMessage(number, more, size_exp, self.payload[start:end], len(self.payload))
+
+    def blockMessage(self, number, more, size_exp, payload, total_size=None):
+        """Create block of current message carrying given payload.
+           Options are copied, payload of current message is not."""
+        block = copy.copy(self)
+        block.opt = copy.deepcopy(self.opt)
+        block.payload = payload
+        block.mid = None
+        if isRequest(block.code):
+            block.opt.block1 = (number, more, size_exp)
+            if total_size is not None:
+                block.opt.size1 = total_size
+        else:
+            block.opt.block2 = (number, more, size_exp)
+            if total_size is not None:
+                block.opt.size2 = total_size
+        return block
 
     def appendRequestBlock(self, next_block):
         """Append next block to current request message.
            Used when assembling incoming blockwise requests."""
         if isRequest(self.code):
             block1 = next_block.opt.block1
-            if block1.block_number * (2 ** (block1.size_exponent + 4)) == len(self.payload):
-                self.payload += next_block.payload
+            if block1.block_number * (2 ** (block1.size_exponent + 4)) == self.bodySize():
+                if self.body is None:
+                    self.payload += next_block.payload
+                else:
+                    self.body.write(next_block.payload)
                 self.opt.block1 = block1
                 self.token = next_block.token
                 self.mid = next_block.mid
@@ -349,6 +434,17 @@ class Message(object):
         else:
             raise ValueError("Fatal Error: called appendRequestBlock on non-request message!!!")
 
+    def bodySize(self):
+        """Return size of payload (also when it is spooled to a file)."""
+        return len(self.payload) if self.body is None else self.body.tell()
+
+    def spoolBody(self, fileobj):
+        """Move payload to a file object - further request blocks
+           are appended to the file."""
+        fileobj.write(self.payload)
+        self.body = fileobj
+        self.payload = b""
+
     def appendResponseBlock(self, next_block):
         """Append next block to current response message.
            Used when assembling incoming blockwise responses."""
@@ -368,32 +464,37 @@ class Message(object):
         else:
             raise ValueError("Fatal Error: called appendResponseBlock on non-response message!!!")
 
-    def generateNextBlock2Request(self, response):
+    def generateNextBlock2Request(self, response, size_exp=None):
         """Generate a request for next response block.
            This method is used by client after receiving
-           blockwise response from server with "more" flag set."""
+           blockwise response from server with "more" flag set.
+
+           If size_exp is smaller than block size used by server,
+           client asks for smaller blocks (and proper block number)."""
         request = copy.deepcopy(self)
         request.payload = b""
         request.mid = None
-        if response.opt.block2.block_number == 0 and response.opt.block2.size_exponent > DEFAULT_BLOCK_SIZE_EXP:
-            new_size_exponent = DEFAULT_BLOCK_SIZE_EXP
-            new_block_number = 2 ** (response.opt.block2.size_exponent - new_size_exponent)
-            request.opt.block2 = (new_block_number, False, new_size_exponent)
+        block2 = response.opt.block2
+        if size_exp is not None and block2.size_exponent > size_exp:
+            new_block_number = (block2.block_number + 1) * 2 ** (block2.size_exponent - size_exp)
+            request.opt.block2 = (new_block_number, False, size_exp)
         else:
-            request.opt.block2 = (response.opt.block2.block_number + 1, False, response.opt.block2.size_exponent)
+            request.opt.block2 = (block2.block_number + 1, False, block2.size_exponent)
         request.opt.deleteOption(BLOCK1)
         request.opt.deleteOption(OBSERVE)
         return request
 
-    def generateNextBlock1Response(self):
+    def generateNextBlock1Response(self, size_exp=MAX_BLOCK_SIZE_EXP):
         """Generate a response to acknowledge incoming request block.
            This method is used by server after receiving
-           blockwise request from client with "more" flag set."""
+           blockwise request from client with "more" flag set.
+
+           Client using blocks larger than size_exp is asked
+           to switch to smaller blocks."""
         response = Message(code=CHANGED, token=self.token )
         response.remote = self.remote
-        if self.opt.block1.block_number == 0 and self.opt.block1.size_exponent > DEFAULT_BLOCK_SIZE_EXP:
-            new_size_exponent = DEFAULT_BLOCK_SIZE_EXP
-            response.opt.block1 = (0, True, new_size_exponent)
+        if self.opt.block1.block_number == 0 and self.opt.block1.size_exponent > size_exp:
+            response.opt.block1 = (0, True, size_exp)
         else:
             response.opt.block1 = (self.opt.block1.block_number, True, self.opt.block1.size_exponent)
         return response
@@ -411,6 +512,7 @@ class Options(object):
     """Represent CoAP Header Options."""
     def __init__(self):
         self._options = {}
+        self._encoded = None  # cached result of encode(), reset when options change
 
     def decode(self, rawdata):
         """Decode all options in message from raw binary data."""
@@ -433,7 +535,11 @@ class Options(object):
         return ''
 
     def encode(self):
-        """Encode all options in option header into string of bytes."""
+        """Encode all options in option header into string of bytes.
+           Result is kept until options are added or deleted
+           (option objects must not be modified in place)."""
+        if self._encoded is not None:
+            return self._encoded
         data = []
         current_opt_num = 0
         option_list = self.optionList()
@@ -445,15 +551,26 @@ class Options(object):
             data.append(extended_length)
             data.append(option.encode())
             current_opt_num = option.number
-        return b"".join(data)
+        self._encoded = b"".join(data)
+        return self._encoded
+
+    def copy(self):
+        """Return copy of option header, which may be changed
+           independently (option objects and encoded form are shared)."""
+        options = Options()
+        options._options = dict((number, list(option_list)) for number, option_list in six.iteritems(self._options))
+        options._encoded = self._encoded
+        return options
 
     def addOption(self, option):
         """Add option into option header."""
+        self._encoded = None
         self._options.setdefault(option.number, []).append(option)
 
     def deleteOption(self, number):
         """Delete option from option header."""
         if number in self._options:
+            self._encoded = None
             self._options.pop(number)
 
     def getOption (self, number):
@@ -482,6 +599,22 @@ class Options(object):
 
     uri_path = property(_getUriPath, _setUriPath)
 
+    def _setUriHost(self, host):
+        """Convenience setter: Uri-Host option"""
+        self.deleteOption(number=URI_HOST)
+        if host is not None:
+            self.addOption(StringOption(number=URI_HOST, value=host))
+
+    def _getUriHost(self):
+        """Convenience getter: Uri-Host option"""
+        uri_host = self.getOption(number=URI_HOST)
+        if uri_host is not None:
+            return uri_host[0].value
+        else:
+            return None
+
+    uri_host = property(_getUriHost, _setUriHost)
+
     def _setUriQuery(self, segments):
         """Convenience setter: Uri-Query option"""
         if isinstance(segments, six.binary_type):
@@ -531,6 +664,37 @@ class Options(object):
 
     block1 = property(_getBlock1, _setBlock1)
 
+    def _setQBlock2(self, block_tuple):
+        """Convenience setter: Q-Block2 option"""
+        self.deleteOption(number=Q_BLOCK2)
+        self.addOption(BlockOption(number=Q_BLOCK2, value=block_tuple))
+
+    def _getQBlock2(self):
+        """Convenience getter: Q-Block2 option (first one,
+           requests may carry several of them)"""
+        qblock2 = self.getOption(number=Q_BLOCK2)
+        if qblock2 is not None:
+            return qblock2[0].value
+        else:
+            return None
+
+    qblock2 = property(_getQBlock2, _setQBlock2)
+
+    def _setQBlock1(self, block_tuple):
+        """Convenience setter: Q-Block1 option"""
+        self.deleteOption(number=Q_BLOCK1)
+        self.addOption(BlockOption(number=Q_BLOCK1, value=block_tuple))
+
+    def _getQBlock1(self):
+        """Convenience getter: Q-Block1 option"""
+        qblock1 = self.getOption(number=Q_BLOCK1)
+        if qblock1 is not None:
+            return qblock1[0].value
+        else:
+            return None
+
+    qblock1 = property(_getQBlock1, _setQBlock1)
+
     def _setSize1(self, size1):
         """Convenience setter: Size1 option"""
         self.deleteOption(number=SIZE1)
@@ -538,7 +702,11 @@ class Options(object):
 
     def _getSize1(self):
         """Convenience getter: Size1 option"""
-        return self.getOption(number=SIZE1)
+        size1 = self.getOption(number=SIZE1)
+        if size1 is not None:
+            return size1[0].value
+        else:
+            return None
 
     size1 = property(_getSize1, _setSize1)
 
@@ -549,10 +717,30 @@ class Options(object):
 
     def _getSize2(self):
         """Convenience getter: Size2 option"""
-        return self.getOption(number=SIZE2)
+        size2 = self.getOption(number=SIZE2)
+        if size2 is not None:
+            return size2[0].value
+        else:
+            return None
 
     size2 = property(_getSize2, _setSize2)
 
+    def _setMaxAge(self, max_age):
+        """Convenience setter: Max-Age option"""
+        self.deleteOption(number=MAX_AGE)
+        if max_age is not None:
+            self.addOption(UintOption(number=MAX_AGE, value=max_age))
+
+    def _getMaxAge(self):
+        """Convenience getter: Max-Age option"""
+        max_age = self.getOption(number=MAX_AGE)
+        if max_age is not None:
+            return max_age[0].value
+        else:
+            return None
+
+    max_age = property(_getMaxAge, _setMaxAge)
+
     def _setContentFormat(self, content_format):
         """Convenience setter: Content-Format option"""
         self.deleteOption(number=CONTENT_FORMAT)
@@ -757,7 +945,7 @@ class BlockOption(object):
         self.value = self.BlockwiseTuple(block_number=(as_integer >> 4), more=bool(as_integer & 0x08), size_exponent=(as_integer & 0x07))
 
     def _length(self):
-        return ((self.value[0].bit_length() + 3) / 8 + 1)
+        return len(self.encode())
     length = property(_length)
 
 option_formats = {3:  StringOption,
@@ -769,10 +957,13 @@ option_formats = {3:  StringOption,
                   14: UintOption,
                   15: StringOption,
                   16: UintOption,
+                  17: UintOption,
+                  19: BlockOption,
                   20: StringOption,
                   23: BlockOption,
                   27: BlockOption,
                   28: UintOption,
+                  31: BlockOption,
                   35: StringOption,
                   39: StringOption,
                   60: UintOption}
@@ -795,10 +986,489 @@ def uriPathAsString(segment_list):
     return b'/' + b'/'.join(segment_list)
 
 
+def missingBlocks(blocks, start, upto, limit):
+    """Return up to limit numbers from start to upto (inclusive)
+       which are not in blocks. Work is proportional to number
+       of received blocks and limit, not to upto."""
+    missing = []
+    number = start
+    while number <= upto and len(missing) < limit:
+        if number not in blocks:
+            missing.append(number)
+        number += 1
+    return missing
+
+
+def encodeUintSequence(numbers):
+    """Encode unsigned integers as CBOR sequence (used
+       for Q-Block missing block reports)."""
+    data = []
+    for number in numbers:
+        if number < 24:
+            data.append(six.int2byte(number))
+        elif number < 0x100:
+            data.append(struct.pack('!BB', 0x18, number))
+        elif number < 0x10000:
+            data.append(struct.pack('!BH', 0x19, number))
+        elif number < 0x100000000:
+            data.append(struct.pack('!BL', 0x1A, number))
+        else:
+            data.append(struct.pack('!BQ', 0x1B, number))
+    return b"".join(data)
+
+
+def decodeUintSequence(data):
+    """Decode CBOR sequence of unsigned integers."""
+    numbers = []
+    position = 0
+    while position < len(data):
+        initial = six.indexbytes(data, position)
+        if initial >> 5 != 0:
+            raise ValueError("Only unsigned integers are allowed in sequence")
+        additional = initial & 0x1F
+        if additional < 24:
+            numbers.append(additional)
+            position += 1
+        elif additional <= 27:
+            length = 1 << (additional - 24)
+            value = 0
+            for byte in six.iterbytes(data[position + 1:position + 1 + length]):
+                value = (value << 8) + byte
+            numbers.append(value)
+            position += 1 + length
+        else:
+            raise ValueError("Invalid unsigned integer encoding")
+    return numbers
+
+
+def generateETag(payload):
+    """Return ETag identifying given representation
+       (first 8 bytes of payload SHA-1 digest)."""
+    return hashlib.sha1(payload).digest()[:8]
+
+
+def blockSizeExponentForMTU(mtu, overhead=BLOCK_OVERHEAD):
+    """Return largest block size exponent for which a block
+       (with headers) fits in datagram of given path MTU."""
+    size_exp = MAX_BLOCK_SIZE_EXP
+    while size_exp > 0 and 2 ** (size_exp + 4) + overhead > mtu:
+        size_exp -= 1
+    return size_exp
+
+
+def representationKey(request):
+    """Return key identifying representation of a resource
+       requested with GET (Uri-Host, Uri-Path, Uri-Query and Accept
+       - server may host several virtual hosts)."""
+    return (request.opt.uri_host, uriPathAsString(request.opt.uri_path), tuple(request.opt.uri_query), request.opt.accept)
+
+
+class Representation(object):
+    """Rendered response shared by Block2 transfers to all clients.
+
+       Payload is kept only once - split into blocks of the size used
+       when representation was rendered. Blocks of other sizes are
+       sliced from them."""
+
+    def __init__(self, response, size_exp, expires):
+        self.response = copy.copy(response)
+        self.response.opt = copy.deepcopy(response.opt)
+        self.response.payload = b""
+        self.etag = response.opt.etag
+        self.size = len(response.payload)
+        self.expires = expires
+        self.block_size = 2 ** (size_exp + 4)
+        self.blocks = [response.payload[start:start + self.block_size]
+                       for start in range(0, self.size, self.block_size)]
+
+    def block(self, number, size_exp):
+        """Return response block (None if number is out of range)."""
+        size = 2 ** (size_exp + 4)
+        start = number * size
+        if start >= self.size:
+            return None
+        end = min(start + size, self.size)
+        return self.response.blockMessage(number, end < self.size, size_exp, self.read(start, end), self.size)
+
+    def read(self, start, end):
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        offset = first * self.block_size
+        if first == last:
+            data = self.blocks[first]
+            if start == offset and end - start == len(data):
+                return data
+            return data[start - offset:end - offset]
+        return b"".join(self.blocks[first:last + 1])[start - offset:end - offset]
+
+
+class RepresentationCache(object):
+    """Size-bounded cache of representations sent blockwise (Block2).
+
+       Block 0 of a response is always rendered by the resource, and
+       the representation is stored (replacing the previous one unless
+       ETag is the same). Requests for further blocks, from any client,
+       are served from the cache for lifetime seconds. Least recently
+       used representations are evicted when total payload size
+       exceeds max_size. The cache may be shared by several Coap
+       protocol instances."""
+
+    def __init__(self, max_size=REPRESENTATION_CACHE_SIZE, lifetime=MAX_TRANSMIT_WAIT):
+        self.max_size = max_size
+        self.lifetime = lifetime
+        self.entries = collections.OrderedDict()  # representation key -> Representation
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now):
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry.expires <= now:
+            self.size -= entry.size
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, response, size_exp, now):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry.etag == response.opt.etag:
+                log.msg("Representation unchanged - reusing cached blocks.")
+                entry.expires = now + self.lifetime
+                self.entries[key] = entry
+                return entry
+            self.size -= entry.size
+        entry = Representation(response, size_exp, now + self.lifetime)
+        if entry.size > self.max_size:
+            return entry
+        while self.entries and self.size + entry.size > self.max_size:
+            evicted = self.entries.popitem(last=False)[1]
+            self.size -= evicted.size
+        self.entries[key] = entry
+        self.size += entry.size
+        return entry
+
+
+def clientCacheKey(request):
+    """Return key identifying response to GET request in client cache."""
+    return (request.remote, request.opt.uri_host, uriPathAsString(request.opt.uri_path), tuple(request.opt.uri_query),
+            request.opt.accept)
+
+
+class ClientCache(object):
+    """Cache of responses to GET requests sent by Coap.request.
+
+       Responses are fresh for their Max-Age (DEFAULT_MAX_AGE if not
+       set) - during that time requests are answered locally. Stale
+       responses with ETag are revalidated: request is sent with the
+       ETag, and 2.03 Valid response refreshes the stored one (which
+       is returned to the application). Least recently used responses
+       are evicted when there are more than max_entries of them or
+       total payload size exceeds max_size."""
+
+    def __init__(self, max_entries=CLIENT_CACHE_ENTRIES, max_size=CLIENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # client cache key -> (response, expiry time)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def accepts(self, request):
+        """Check if response to request may be cached (GET without
+           Observe and Block2, and without ETags set by application)."""
+        return (request.code == GET and request.opt.observe is None and request.opt.block2 is None and
+                not request.opt.etags)
+
+    def get(self, key, now):
+        """Return copy of fresh response or None."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        if entry[1] <= now:
+            return None
+        self.hits += 1
+        return copyResponse(entry[0])
+
+    def validator(self, key):
+        """Return ETag of stored response (to be revalidated) or None."""
+        entry = self.entries.get(key)
+        return entry[0].opt.etag if entry is not None else None
+
+    def update(self, key, response, now):
+        """Process response received from server and return the
+           one to be passed to the application - or None if response
+           is 2.03 Valid, but stored response is gone (evicted while
+           request was in flight) and request has to be repeated
+           without ETag."""
+        entry = self.entries.get(key)
+        if response.code == VALID and (entry is None or response.opt.etag != entry[0].opt.etag):
+            self.remove(key)
+            return None
+        if response.code == VALID:
+            log.msg("Stored response revalidated.")
+            self.hits += 1
+            self.revalidations += 1
+            if response.opt.max_age is not None:
+                entry[0].opt.max_age = response.opt.max_age
+            self.entries[key] = (entry[0], now + self.maxAge(entry[0]))
+            return copyResponse(entry[0])
+        self.misses += 1
+        self.remove(key)
+        if response.code == CONTENT and isinstance(response.payload, six.binary_type):
+            self.store(key, response, now)
+        return response
+
+    def store(self, key, response, now):
+        size = len(response.payload)
+        if size > self.max_size:
+            return
+        while self.entries and (len(self.entries) >= self.max_entries or self.size + size > self.max_size):
+            self.size -= len(self.entries.popitem(last=False)[1][0].payload)
+        self.entries[key] = (copyResponse(response), now + self.maxAge(response))
+        self.size += size
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0].payload)
+
+    def maxAge(self, response):
+        max_age = response.opt.max_age
+        return max_age if max_age is not None else DEFAULT_MAX_AGE
+
+
+def synchronousResponse(result):
+    """Return response from result of render if it is already
+       available (Message or fired Deferred), otherwise None."""
+    if isinstance(result, Message):
+        return result
+    if isinstance(result, defer.Deferred) and result.called and isinstance(getattr(result, 'result', None), Message):
+        return result.result
+    return None
+
+
+def copyResponse(response):
+    """Return copy of response which may be changed independently
+       (payload is shared)."""
+    response = copy.copy(response)
+    response.opt = response.opt.copy()
+    return response
+
+
+def coalesceKey(request, blockSizeExp, qBlock):
+    """Return key identifying identical requests (same remote,
+       method, options and payload)."""
+    return (request.remote, request.code, request.opt.encode(), request.payload, blockSizeExp, qBlock)
+
+
+class SharedRequest(object):
+    """Outgoing request (see coalesce_requests argument of Coap)
+       or pending render (see single_flight attribute of CoAPResource)
+       shared by several consumers.
+
+       Each consumer receives its own Deferred, which fires with its
+       own copy of response. Cancelling it detaches only that
+       consumer - the exchange is cancelled when no consumers are
+       left."""
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.consumers = []
+        deferred.addBoth(self.deliver)
+
+    def join(self):
+        d = defer.Deferred(self.leave)
+        self.consumers.append(d)
+        return d
+
+    def leave(self, d):
+        self.consumers.remove(d)
+        if not self.consumers:
+            log.msg("All consumers left - cancelling shared request.")
+            self.deferred.cancel()
+
+    def deliver(self, result):
+        consumers, self.consumers = self.consumers, []
+        for d in consumers:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(copyResponse(result))
+
+
+def bufferedLength(payload):
+    """Return number of payload bytes held in memory (payloads
+       which are not byte strings, e.g. memory-mapped files, are
+       not counted)."""
+    return len(payload) if isinstance(payload, six.binary_type) else 0
+
+
+class SessionTable(object):
+    """Table of unfinished incoming blockwise transfers (Responder,
+       QBlock1Receiver and QBlock2Sender objects identified by URL path
+       and remote). It behaves like a dictionary, but keeps number of
+       sessions and payload bytes they hold (reported by their
+       bufferedSize method, when they are stored) below global and
+       per-peer limits. When a limit is exceeded, least recently stored
+       sessions (of the same peer, if per-peer limit is exceeded) are
+       removed and their evict method is called.
+
+       Max_body_size is the largest request body accepted blockwise
+       (None - unlimited)."""
+
+    def __init__(self, max_sessions=MAX_BLOCKWISE_SESSIONS, max_peer_sessions=MAX_PEER_SESSIONS,
+                 max_buffer=MAX_BLOCKWISE_BUFFER, max_peer_buffer=MAX_PEER_BUFFER,
+                 max_body_size=MAX_BODY_SIZE):
+        self.max_sessions = max_sessions
+        self.max_peer_sessions = max_peer_sessions
+        self.max_buffer = max_buffer
+        self.max_peer_buffer = max_peer_buffer
+        self.max_body_size = max_body_size
+        self.sessions = collections.OrderedDict()  # (URL path, remote) -> session
+        self.sizes = {}  # (URL path, remote) -> buffered bytes
+        self.peers = {}  # remote -> [number of sessions, buffered bytes]
+        self.size = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, key):
+        return key in self.sessions
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def __getitem__(self, key):
+        return self.sessions[key]
+
+    def __setitem__(self, key, session):
+        self.pop(key, None)
+        size = session.bufferedSize()
+        self.sessions[key] = session
+        self.sizes[key] = size
+        self.size += size
+        peer = self.peers.setdefault(key[1], [0, 0])
+        peer[0] += 1
+        peer[1] += size
+        self.enforceLimits(key)
+
+    def __delitem__(self, key):
+        if key not in self.sessions:
+            raise KeyError(key)
+        self.pop(key)
+
+    def get(self, key, default=None):
+        return self.sessions.get(key, default)
+
+    def setdefault(self, key, session):
+        if key not in self.sessions:
+            self[key] = session
+        return self.sessions.get(key, session)
+
+    def pop(self, key, *default):
+        if key not in self.sessions:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        session = self.sessions.pop(key)
+        size = self.sizes.pop(key)
+        self.size -= size
+        peer = self.peers[key[1]]
+        peer[0] -= 1
+        peer[1] -= size
+        if peer[0] == 0:
+            del self.peers[key[1]]
+        return session
+
+    def values(self):
+        return list(self.sessions.values())
+
+    def clear(self):
+        self.sessions.clear()
+        self.sizes.clear()
+        self.peers.clear()
+        self.size = 0
+
+    def enforceLimits(self, key):
+        """Evict old sessions until limits are met (session
+           identified by key is never evicted)."""
+        remote = key[1]
+        while self.peers[remote][0] > self.max_peer_sessions or self.peers[remote][1] > self.max_peer_buffer:
+            victim = next((k for k in self.sessions if k[1] == remote and k != key), None)
+            if victim is None:
+                break
+            self.evict(victim)
+        while len(self.sessions) > self.max_sessions or self.size > self.max_buffer:
+            victim = next((k for k in self.sessions if k != key), None)
+            if victim is None:
+                break
+            self.evict(victim)
+
+    def evict(self, key):
+        log.msg("Blockwise session limit exceeded - transfer %r from %s evicted." % (key[0], key[1][0]))
+        self.evictions += 1
+        self.pop(key).evict()
+
+
 class Coap(protocol.DatagramProtocol):
 
-    def __init__(self, endpoint):
-        """Initialize a CoAP protocol instance."""
+    def __init__(self, endpoint, clock=None, metrics=None, profiler=None,
+                 block_size_exp=DEFAULT_BLOCK_SIZE_EXP, max_block_size_exp=MAX_BLOCK_SIZE_EXP,
+                 representation_cache=None, session_table=None, spool_threshold=None, client_cache=None,
+                 coalesce_requests=False):
+        """Initialize a CoAP protocol instance.
+
+           Optional clock (an IReactorTime provider, e.g.
+           twisted.internet.task.Clock) is used for all protocol
+           timers instead of the global reactor.
+
+           Optional metrics (txthings.metrics.CoapMetrics) collects
+           protocol counters and histograms.
+
+           Optional profiler (txthings.profiling.RenderProfiler)
+           measures resource traversal and render latency.
+
+           Block_size_exp is the size exponent used for blockwise
+           transfers started by this endpoint (unless overridden per peer
+           or per request). Max_block_size_exp is the largest size
+           exponent accepted from peers - larger blocks are renegotiated
+           down.
+
+           Optional representation_cache (RepresentationCache) keeps
+           representations sent blockwise, so that further blocks are
+           served to all clients without rendering the resource again
+           (and without keeping a copy of payload for each client).
+
+           Optional session_table (SessionTable) limits number and size
+           of unfinished incoming blockwise transfers.
+
+           If spool_threshold is set, incoming Block1 request bodies
+           larger than spool_threshold bytes are written to temporary
+           files. Resource receives such request with empty payload and
+           the file (positioned at the beginning) as request.body.
+
+           Optional client_cache (ClientCache) keeps responses to GET
+           requests sent by this endpoint (see request method).
+
+           If coalesce_requests is set, identical GET and FETCH requests
+           sent while one of them is in flight share its exchange (see
+           request method)."""
+        self.clock = clock if clock is not None else reactor
+        self.metrics = metrics
+        self.profiler = profiler
+        if metrics is not None:
+            metrics.bind(self)
         self.message_id = random.randint(0, 65535)
         self.token = random.randint(0, 65535)
         self.endpoint = endpoint
@@ -806,14 +1476,31 @@ class Coap(protocol.DatagramProtocol):
         self.recent_remote_ids = {}  # recently received messages with IDs generated by remote endpoints (identified by message ID and remote)
         self.active_exchanges = {}  # active exchanges i.e. sent CON messages (identified by message ID and remote)
         self.outgoing_requests = {}  # unfinished outgoing requests (identified by token and remote)
-        self.incoming_requests = {}  # unfinished incoming requests (identified by URL path and remote)
+        self.incoming_requests = session_table if session_table is not None else SessionTable()  # unfinished incoming requests (identified by URL path and remote)
         self.observations = {} # outgoing observations. (token, remote) -> callback
+        self.block_size_exp = block_size_exp
+        self.max_block_size_exp = max_block_size_exp
+        self.peer_block_size_exp = {}  # preferred size exponents for selected peers (identified by remote)
+        self.representation_cache = representation_cache
+        self.spool_threshold = spool_threshold
+        self.client_cache = client_cache
+        self.coalesce_requests = coalesce_requests
+        self.shared_requests = {}  # in-flight requests shared by consumers (identified by coalesceKey)
+        self.shared_renders = {}  # pending renders of single_flight resources (identified by representationKey, and remote if per peer)
 
     def datagramReceived(self, data, remote):
         host, port = remote
         log.msg("Received %r from %s:%d" % (data, host, port))
         message = Message.decode(data, (ip_address(host), port), self)
+        self.messageReceived(message)
+
+    def messageReceived(self, message):
+        """Process decoded incoming message."""
+        if self.metrics is not None:
+            self.metrics.messageReceived(message)
         if self.deduplicateMessage(message) is True:
+            if self.metrics is not None:
+                self.metrics.duplicateReceived(message)
             return
         if isRequest(message.code):
             self.processRequest(message)
@@ -830,7 +1517,7 @@ class Coap(protocol.DatagramProtocol):
            EXCHANGE_LIFETIME seconds (usually 247 seconds)."""
 
         def addMessageToRecent(cache, key):
-            expiration = reactor.callLater(EXCHANGE_LIFETIME, removeMessageFromRecent, cache, key)
+            expiration = self.clock.callLater(EXCHANGE_LIFETIME, removeMessageFromRecent, cache, key)
             cache[key] = (message, expiration)
 
         def removeMessageFromRecent(cache, key):
@@ -891,7 +1578,7 @@ class Coap(protocol.DatagramProtocol):
 
         elif (response.token, response.remote) in self.observations:
             ## @TODO: deduplication based on observe option value
-            callback_tuple, original_request_uri_path = self.observations[(response.token, response.remote)]
+            callback_tuple, original_request = self.observations[(response.token, response.remote)]
             callback, args, kw = callback_tuple
             args = args or ()
             kw = kw or {}
@@ -905,10 +1592,7 @@ class Coap(protocol.DatagramProtocol):
                 if block2.more is False:
                     callback(response, *args, **kw)
                 else:
-                    request = Message(code=GET)
-                    request.opt.uri_path = original_request_uri_path
-                    request.remote = response.remote
-                    request = request.generateNextBlock2Request(response)
+                    request = original_request.generateNextBlock2Request(response)
                     requester = Requester(response.protocol, request, None, None, None,
                                           None, None, None,
                                           None, None, None)
@@ -934,6 +1618,8 @@ class Coap(protocol.DatagramProtocol):
         if (uriPathAsString(request.opt.uri_path), request.remote) in self.incoming_requests:
             log.msg("Request pertains to earlier blockwise requests.")
             self.incoming_requests.pop((uriPathAsString(request.opt.uri_path), request.remote)).handleNextRequest(request)
+        elif request.opt.qblock1 is not None:
+            QBlock1Receiver(self, request)
         else:
             responder = Responder(self, request)
 
@@ -964,6 +1650,8 @@ class Coap(protocol.DatagramProtocol):
             message.mid = self.nextMessageID()
         msg = message.encode()
         self.transport.write(msg, target)
+        if self.metrics is not None:
+            self.metrics.messageSent(message)
         if message.mtype is CON:
             self.addExchange(message)
         log.msg("Message %r sent successfully" % msg)
@@ -990,16 +1678,30 @@ class Coap(protocol.DatagramProtocol):
 
         timeout = random.uniform(ACK_TIMEOUT, ACK_TIMEOUT * ACK_RANDOM_FACTOR)
         retransmission_counter = 0
-        next_retransmission = reactor.callLater(timeout, self.retransmit, message, timeout, retransmission_counter)
+        next_retransmission = self.clock.callLater(timeout, self.retransmit, message, timeout, retransmission_counter)
         self.active_exchanges[message.mid] = (message, next_retransmission)
+        if self.metrics is not None:
+            self.metrics.exchangeStarted(message, self.clock.seconds())
         log.msg("Exchange added, Message ID: %d." % message.mid)
 
     def removeExchange(self, message):
         """Remove exchange from active exchanges and cancel the timeout
            to next retransmission."""
         self.active_exchanges.pop(message.mid)[1].cancel()
+        if self.metrics is not None:
+            self.metrics.exchangeCompleted(message, self.clock.seconds())
         log.msg("Exchange removed, Message ID: %d." % message.mid)
 
+    def abandonExchange(self, message):
+        """Stop retransmitting CON message (e.g. request
+           cancelled by application)."""
+        exchange = self.active_exchanges.get(message.mid)
+        if exchange is not None and exchange[0] is message:
+            self.active_exchanges.pop(message.mid)[1].cancel()
+            if self.metrics is not None:
+                self.metrics.exchangeAbandoned(message)
+            log.msg("Exchange abandoned, Message ID: %d." % message.mid)
+
     def retransmit(self, message, timeout, retransmission_counter):
         """Retransmit CON message that has not been ACKed or RSTed."""
         self.active_exchanges.pop(message.mid)
@@ -1010,22 +1712,152 @@ class Coap(protocol.DatagramProtocol):
             self.transport.write(message.encode(), target)
             retransmission_counter += 1
             timeout *= 2
-            next_retransmission = reactor.callLater(timeout, self.retransmit, message, timeout, retransmission_counter)
+            next_retransmission = self.clock.callLater(timeout, self.retransmit, message, timeout, retransmission_counter)
             self.active_exchanges[message.mid] = (message, next_retransmission)
+            if self.metrics is not None:
+                self.metrics.exchangeRetransmitted(message)
             log.msg("Retransmission, Message ID: %d." % message.mid)
         else:
-            pass
+            if self.metrics is not None:
+                self.metrics.exchangeTimedOut(message)
             #TODO: error handling (especially for requests)
 
+    def setPeerBlockSize(self, remote, size_exp):
+        """Use given block size exponent for transfers with remote
+           endpoint (None restores the default)."""
+        if size_exp is None:
+            self.peer_block_size_exp.pop(remote, None)
+        else:
+            self.peer_block_size_exp[remote] = min(size_exp, self.max_block_size_exp)
+
+    def setPathMTU(self, remote, mtu):
+        """Pick block size for remote endpoint from path MTU estimate."""
+        self.setPeerBlockSize(remote, blockSizeExponentForMTU(mtu))
+
+    def blockSizeExponent(self, remote):
+        """Return block size exponent preferred for remote endpoint."""
+        return self.peer_block_size_exp.get(remote, self.block_size_exp)
+
     def request(self, request, observeCallback=None, block1Callback=None, block2Callback=None,
                 observeCallbackArgs=None, block1CallbackArgs=None, block2CallbackArgs=None,
-                observeCallbackKeywords=None, block1CallbackKeywords=None, block2CallbackKeywords=None):
+                observeCallbackKeywords=None, block1CallbackKeywords=None, block2CallbackKeywords=None,
+                blockSizeExp=None, block2Consumer=None, block1Producer=None, size1=None,
+                block2Window=None, qBlock=False, resumeOffset=0, resumeETag=None):
         """Send a request.
 
-           This is a method that should be called by user app."""
-        return Requester(self, request, observeCallback, block1Callback, block2Callback,
-                         observeCallbackArgs, block1CallbackArgs, block2CallbackArgs,
-                         observeCallbackKeywords, block1CallbackKeywords, block2CallbackKeywords).deferred
+           This is a method that should be called by user app.
+
+           Optional blockSizeExp overrides block size used for this
+           request (both for sending request payload and for receiving
+           response payload).
+
+           Optional block2Consumer (see txthings.streaming) receives
+           response payload block by block - it is not assembled in
+           memory, and returned Deferred fires with the last response
+           block with empty payload. Block2Consumer replaces
+           block2Callback.
+
+           Optional block1Producer (file object, bytes, mmap, iterator
+           of bytes or txthings.streaming producer) supplies request
+           payload, which is read block by block as the upload
+           advances. Size1 is the total size announced to the server
+           (for files and buffers it is determined automatically).
+
+           Optional block2Window is the number of Block2 requests kept
+           in flight at once - after the first response block reveals
+           block size and Size2, further blocks are requested in
+           parallel. Use it only for servers known to cope with it.
+
+           If qBlock is set, payload is transferred with Q-Block1 or
+           Q-Block2 options (RFC 9177): blocks are sent in bursts of
+           NON messages and only missing ones are repeated. Server
+           must support Q-Block. Other blockwise arguments (except
+           blockSizeExp) are ignored in this mode.
+
+           Download received partially before can be resumed: with
+           resumeOffset (number of payload bytes already received,
+           multiple of 16) client asks for the block starting at that
+           offset, and block2Consumer receives only the rest of payload.
+           If resumeETag is given and representation on server has
+           different ETag, request fails with ResourceChanged (and
+           download has to be started from the beginning).
+
+           To get a single block of representation, set Block2 option
+           with nonzero block number in request.
+
+           If protocol has client_cache, GET requests (without Observe,
+           Block2, ETags and block2Consumer) are answered from it while
+           stored response is fresh, and revalidated with its ETag
+           when it is stale.
+
+           If protocol has coalesce_requests set, GET and FETCH requests
+           (without Observe and any callbacks, consumers or producers)
+           identical to one already in flight don't start a new
+           exchange - they receive (a copy of) its response. Each
+           returned Deferred may be cancelled independently."""
+        cache = self.client_cache
+        key = None
+        if cache is not None and observeCallback is None and block2Consumer is None and cache.accepts(request):
+            key = clientCacheKey(request)
+            response = cache.get(key, self.clock.seconds())
+            if response is not None:
+                log.msg("Response served from client cache.")
+                return defer.succeed(response)
+            etag = cache.validator(key)
+            if etag is not None:
+                # Application may reuse its request - ETag is added to a copy
+                original_request = request
+                request = copy.copy(original_request)
+                request.opt = original_request.opt.copy()
+                request.opt.etags = [etag]
+
+                def revalidated(response):
+                    result = cache.update(key, response, self.clock.seconds())
+                    if result is None:
+                        log.msg("Stored response evicted during revalidation - repeating request.")
+                        return self.request(original_request, block2Callback=block2Callback,
+                                            block2CallbackArgs=block2CallbackArgs,
+                                            block2CallbackKeywords=block2CallbackKeywords,
+                                            blockSizeExp=blockSizeExp, block2Window=block2Window, qBlock=qBlock)
+                    return result
+        shared_key = None
+        if (self.coalesce_requests and request.code in (GET, FETCH) and request.opt.observe is None and
+                not any((observeCallback, block1Callback, block2Callback, block2Consumer, block1Producer,
+                         block2Window, resumeOffset))):
+            shared_key = coalesceKey(request, blockSizeExp, qBlock)
+            shared = self.shared_requests.get(shared_key)
+            if shared is not None:
+                log.msg("Identical request in flight - sharing its response.")
+                return shared.join()
+        if qBlock:
+            if blockSizeExp is None:
+                blockSizeExp = self.blockSizeExponent(request.remote)
+            if len(request.payload) > 2 ** (blockSizeExp + 4):
+                d = QBlock1Sender(self, request, blockSizeExp).deferred
+            else:
+                d = QBlock2Receiver(self, request, blockSizeExp).deferred
+        else:
+            d = Requester(self, request, observeCallback, block1Callback, block2Callback,
+                          observeCallbackArgs, block1CallbackArgs, block2CallbackArgs,
+                          observeCallbackKeywords, block1CallbackKeywords, block2CallbackKeywords,
+                          blockSizeExp, block2Consumer, block1Producer, size1,
+                          block2Window, resumeOffset, resumeETag).deferred
+        if key is not None and request.opt.etags:
+            d.addCallback(revalidated)
+        elif key is not None:
+            d.addCallback(lambda response: cache.update(key, response, self.clock.seconds()))
+        if shared_key is not None and not d.called:
+            # removed before response is delivered - consumer callbacks
+            # may send the same request again
+            d.addBoth(self.removeSharedRequest, shared_key)
+            shared = SharedRequest(d)
+            self.shared_requests[shared_key] = shared
+            return shared.join()
+        return d
+
+    def removeSharedRequest(self, result, key):
+        self.shared_requests.pop(key, None)
+        return result
 
 
 class Requester(object):
@@ -1037,10 +1869,21 @@ class Requester(object):
 
     def __init__(self, protocol, app_request, observeCallback, block1Callback, block2Callback,
                        observeCallbackArgs, block1CallbackArgs, block2CallbackArgs,
-                       observeCallbackKeywords, block1CallbackKeywords, block2CallbackKeywords):
+                       observeCallbackKeywords, block1CallbackKeywords, block2CallbackKeywords,
+                       blockSizeExp=None, block2Consumer=None, block1Producer=None, size1=None,
+                       block2Window=None, resumeOffset=0, resumeETag=None):
         self.protocol = protocol
         self.app_request = app_request
         self.assembled_response = None
+        self.consumer = block2Consumer
+        self.stream_offset = resumeOffset
+        self.stream_etag = resumeETag
+        self.stream_started = False
+        self.window = block2Window
+        self.window_requests = {}  # outstanding parallel Block2 requests (identified by token)
+        self.producer = None
+        if block1Producer is not None:
+            self.producer = streaming.producerFor(block1Producer, size1)
         assert observeCallback == None or callable(observeCallback)
         assert block1Callback == None or callable(block1Callback)
         assert block2Callback == None or callable(block2Callback)
@@ -1049,8 +1892,35 @@ class Requester(object):
                     (block2Callback, block2CallbackArgs, block2CallbackKeywords))
         if isRequest(self.app_request.code) is False:
             raise ValueError("Message code is not valid for request")
-        size_exp = DEFAULT_BLOCK_SIZE_EXP
-        if len(self.app_request.payload) > (2 ** (size_exp + 4)):
+        if blockSizeExp is None:
+            size_exp = protocol.blockSizeExponent(app_request.remote)
+            # Accept larger response blocks, unless block size was set for peer
+            self.size_exp = protocol.peer_block_size_exp.get(app_request.remote, protocol.max_block_size_exp)
+        else:
+            self.size_exp = size_exp = blockSizeExp
+        if resumeOffset:
+            if self.consumer is None:
+                raise ValueError("Resumed download requires block2Consumer")
+            resume_size_exp = size_exp
+            while resume_size_exp > 0 and resumeOffset % (2 ** (resume_size_exp + 4)) != 0:
+                resume_size_exp -= 1
+            if resumeOffset % (2 ** (resume_size_exp + 4)) != 0:
+                raise ValueError("Offset of resumed download must be a multiple of 16")
+            self.app_request.opt.block2 = (resumeOffset // (2 ** (resume_size_exp + 4)), False, resume_size_exp)
+        if self.app_request.code == GET and self.app_request.opt.block2 is None and size_exp != DEFAULT_BLOCK_SIZE_EXP:
+            # Early negotiation - ask server for non-default block size
+            self.app_request.opt.block2 = (0, False, size_exp)
+        if self.consumer is not None and self.app_request.opt.size2 is None:
+            # Ask server to announce total size in first block
+            self.app_request.opt.size2 = 0
+        if self.producer is not None:
+            request = self.extractRequestBlock(0, size_exp)
+            if request.opt.block1.more is True:
+                self.app_request.opt.block1 = request.opt.block1
+            else:
+                self.app_request.payload = request.payload
+                request = self.app_request
+        elif len(self.app_request.payload) > (2 ** (size_exp + 4)):
             request = self.app_request.extractBlock(0, size_exp)
             self.app_request.opt.block1 = request.opt.block1
         else:
@@ -1060,6 +1930,8 @@ class Requester(object):
         self.deferred = self.sendRequest(request)
         self.deferred.addCallback(self.processBlock1InResponse)
         self.deferred.addCallback(self.processBlock2InResponse)
+        if self.consumer is not None:
+            self.deferred.addErrback(self.streamFailed)
 
     def sendRequest(self, request):
         """Send a request or single request block.
@@ -1074,6 +1946,7 @@ class Requester(object):
             """Clean request after cancellation from user application."""
 
             log.msg("Request cancelled")
+            self.protocol.abandonExchange(request)
             self.protocol.outgoing_requests.pop((request.token, request.remote))
 
         def timeoutRequest(d):
@@ -1081,6 +1954,8 @@ class Requester(object):
 
             log.msg("Request timed out")
             del self.protocol.outgoing_requests[(request.token, request.remote)]
+            if self.protocol.metrics is not None:
+                self.protocol.metrics.requestTimedOut(request)
             d.errback(error.RequestTimedOut())
 
         def gotResult(result):
@@ -1097,21 +1972,24 @@ class Requester(object):
             return defer.fail()
         else:
             d = defer.Deferred(cancelRequest)
-            timeout = reactor.callLater(REQUEST_TIMEOUT, timeoutRequest, d)
+            timeout = self.protocol.clock.callLater(REQUEST_TIMEOUT, timeoutRequest, d)
             d.addBoth(gotResult)
             self.protocol.outgoing_requests[(request.token, request.remote)] = self
             log.msg("Sending request - Token: %s, Host: %s, Port: %s" % (codecs.encode(request.token, 'hex'), str(request.remote[0]), request.remote[1]))
             if request.opt.observe is not None and self.cbs[0][0] is not None:
-                d.addCallback(self.registerObservation, self.cbs[0], request.opt.uri_path)
+                d.addCallback(self.registerObservation, self.cbs[0], request)
             return d
 
     def handleResponse(self, response):
-        d, self.deferred = self.deferred, None
+        if response.token in self.window_requests:
+            d = self.window_requests.pop(response.token)
+        else:
+            d, self.deferred = self.deferred, None
         d.callback(response)
 
-    def registerObservation(self, response, callback, request_uri_path):
+    def registerObservation(self, response, callback, request):
         if response.opt.observe is not None:
-            self.protocol.observations[(response.token, response.remote)] = (callback, request_uri_path)
+            self.protocol.observations[(response.token, response.remote)] = (callback, request)
         return response
 
     def processBlock1InResponse(self, response):
@@ -1126,12 +2004,18 @@ class Requester(object):
         if response.opt.block1 is not None:
             block1 = response.opt.block1
             log.msg("Response with Block1 option received, number = %d, more = %d, size_exp = %d." % (block1.block_number, block1.more, block1.size_exponent))
+            if not isSuccessful(response.code):
+                log.msg("Error response to request block received, code = %d - blockwise transfer stopped." % response.code)
+                return defer.succeed(response)
             if block1.block_number == self.app_request.opt.block1.block_number:
-                if block1.size_exponent < self.app_request.opt.block1.size_exponent:
+                if self.app_request.opt.block1.more is False:
+                    # Last request block was acknowledged - nothing more to read
+                    next_block = None
+                elif block1.size_exponent < self.app_request.opt.block1.size_exponent:
                     next_number = (self.app_request.opt.block1.block_number + 1) * 2 ** (self.app_request.opt.block1.size_exponent - block1.size_exponent)
-                    next_block = self.app_request.extractBlock(next_number, block1.size_exponent)
+                    next_block = self.extractRequestBlock(next_number, block1.size_exponent)
                 else:
-                    next_block = self.app_request.extractBlock(self.app_request.opt.block1.block_number + 1, block1.size_exponent)
+                    next_block = self.extractRequestBlock(self.app_request.opt.block1.block_number + 1, block1.size_exponent)
                 if next_block is not None:
                     if block1.more is False:
                         if response.code not in (CREATED, DELETED, VALID, CHANGED, CONTENT, CONTINUE):
@@ -1160,6 +2044,17 @@ class Requester(object):
             else:
                 return defer.fail()
 
+    def extractRequestBlock(self, number, size_exp):
+        """Return request block with given number - taken from
+           block1Producer if present, from request payload otherwise."""
+        if self.producer is None:
+            return self.app_request.extractBlock(number, size_exp)
+        size = 2 ** (size_exp + 4)
+        payload, more = self.producer.readBlock(number * size, size)
+        if number > 0 and len(payload) == 0:
+            return None
+        return self.app_request.blockMessage(number, more, size_exp, payload, self.producer.size)
+
     def sendNextRequestBlock(self, result, next_block):
         """Helper method used for sending request blocks."""
         log.msg("Sending next block of blockwise request.")
@@ -1175,6 +2070,8 @@ class Requester(object):
 
            Method is recursive - calls itself until all response blocks
            from server are received."""
+        if self.consumer is not None:
+            return self.streamBlock2InResponse(response)
         if response.opt.block2 is not None:
             block2 = response.opt.block2
             log.msg("Response with Block2 option received, number = %d, more = %d, size_exp = %d." % (block2.block_number, block2.more, block2.size_exponent))
@@ -1184,14 +2081,19 @@ class Requester(object):
                 except error.Error as e:
                     return defer.fail(e)
             else:
-                if block2.block_number is 0:
+                if block2.block_number == 0:
                     log.msg("Receiving blockwise response")
                     self.assembled_response = response
+                elif self.app_request.opt.block2 is not None and self.app_request.opt.block2.block_number > 0:
+                    log.msg("Single block of response requested.")
+                    return defer.succeed(response)
                 else:
                     log.msg("ProcessBlock2 error: transfer started with nonzero block number.")
-                    return defer.fail()
+                    return defer.fail(error.NotImplemented())
             if block2.more is True:
-                request = self.app_request.generateNextBlock2Request(response)
+                if self.useWindow(response):
+                    return self.startBlock2Window(response)
+                request = self.app_request.generateNextBlock2Request(response, self.size_exp)
                 block2Callback, args, kw = self.cbs[2]
                 if block2Callback is None:
                     return self.askForNextResponseBlock(None, request)
@@ -1209,6 +2111,156 @@ class Requester(object):
             else:
                 return defer.fail(error.MissingBlock2Option)
 
+    def streamBlock2InResponse(self, response):
+        """Pass incoming response block to block2Consumer instead
+           of assembling the response.
+
+           Method is recursive - calls itself until all response blocks
+           from server are received."""
+        block2 = response.opt.block2
+        payload, response.payload = response.payload, b""
+        if not self.stream_started:
+            if self.stream_etag is not None and response.opt.etag != self.stream_etag:
+                log.msg("Representation changed since download was interrupted.")
+                return defer.fail(error.ResourceChanged())
+            if block2 is None:
+                # Whole representation received (also when resuming)
+                payload = payload[self.stream_offset:]
+            elif block2.block_number * (2 ** (block2.size_exponent + 4)) != self.stream_offset:
+                log.msg("ProcessBlock2 error: transfer started with unexpected block number.")
+                return defer.fail(error.NotImplemented())
+            self.stream_started = True
+            self.stream_etag = response.opt.etag
+            self.consumer.responseStarted(response)
+        elif block2 is None:
+            return defer.fail(error.MissingBlock2Option())
+        else:
+            log.msg("Response with Block2 option received, number = %d, more = %d, size_exp = %d." % (block2.block_number, block2.more, block2.size_exponent))
+            if block2.block_number * (2 ** (block2.size_exponent + 4)) != self.stream_offset:
+                return defer.fail(error.NotImplemented())
+            if response.opt.etag != self.stream_etag:
+                return defer.fail(error.ResourceChanged())
+        self.stream_offset += len(payload)
+        d = defer.maybeDeferred(self.consumer.dataReceived, payload)
+        if block2 is not None and block2.more is True:
+            if self.useWindow(response):
+                d.addCallback(lambda result: self.startBlock2Window(response))
+                d.addCallback(lambda last: self.streamFinished(None, last))
+                return d
+            request = self.app_request.generateNextBlock2Request(response, self.size_exp)
+            d.addCallback(self.askForNextResponseBlock, request)
+        else:
+            d.addCallback(self.streamFinished, response)
+        return d
+
+    def streamFinished(self, result, response):
+        self.consumer.responseFinished(response)
+        return response
+
+    def streamFailed(self, reason):
+        self.consumer.responseFailed(reason)
+        return reason
+
+    def useWindow(self, response):
+        """Check if remaining response blocks should be requested
+           in parallel."""
+        return (self.window is not None and self.window > 1 and
+                response.opt.block2.block_number == 0 and response.opt.size2 is not None)
+
+    def startBlock2Window(self, response):
+        """Request remaining response blocks in parallel, keeping
+           up to self.window blocks in flight (or received out of order).
+           Returns Deferred firing after the last block is delivered."""
+        log.msg("Requesting response blocks in parallel, window = %d." % self.window)
+        block2 = response.opt.block2
+        self.window_first = response
+        self.window_size_exp = block2.size_exponent
+        self.window_last = (response.opt.size2 - 1) // (2 ** (block2.size_exponent + 4))
+        self.window_blocks = {}  # blocks received out of order (identified by block number)
+        self.window_next_request = 1
+        self.window_next_delivery = 1
+        self.window_paused = False
+        self.window_done = defer.Deferred(self.cancelBlock2Window)
+        self.fillBlock2Window()
+        return self.window_done
+
+    def fillBlock2Window(self):
+        while (not self.window_done.called and self.window_next_request <= self.window_last and
+               len(self.window_requests) + len(self.window_blocks) < self.window):
+            number = self.window_next_request
+            self.window_next_request += 1
+            request = self.app_request.generateNextBlock2Request(self.window_first)
+            request.opt.block2 = (number, False, self.window_size_exp)
+            d = self.sendRequest(request)
+            if request.token is not None and not d.called:
+                self.window_requests[request.token] = d
+            d.addCallback(self.windowBlockReceived, number)
+            d.addErrback(self.windowFailed)
+
+    def windowBlockReceived(self, response, number):
+        block2 = response.opt.block2
+        if block2 is None:
+            raise error.MissingBlock2Option()
+        if block2.block_number != number or block2.size_exponent != self.window_size_exp:
+            raise error.NotImplemented()
+        if response.opt.etag != self.window_first.opt.etag:
+            raise error.ResourceChanged()
+        self.window_blocks[number] = response
+        self.deliverWindowBlocks()
+
+    def deliverWindowBlocks(self):
+        """Pass received blocks in order to the consumer
+           (or the assembled response)."""
+        while (not self.window_paused and not self.window_done.called and
+               self.window_next_delivery in self.window_blocks):
+            block = self.window_blocks.pop(self.window_next_delivery)
+            self.window_next_delivery += 1
+            if self.consumer is not None:
+                payload, block.payload = block.payload, b""
+                self.stream_offset += len(payload)
+                d = defer.maybeDeferred(self.consumer.dataReceived, payload)
+                if not d.called:
+                    self.window_paused = True
+                    d.addCallback(self.resumeBlock2Window)
+                d.addErrback(self.windowFailed)
+                self.window_final = block
+            else:
+                self.assembled_response.appendResponseBlock(block)
+                self.window_final = self.assembled_response
+        if self.window_done.called or self.window_paused:
+            return
+        if self.window_next_delivery > self.window_last:
+            self.window_done.callback(self.window_final)
+        else:
+            self.fillBlock2Window()
+
+    def resumeBlock2Window(self, result):
+        self.window_paused = False
+        self.deliverWindowBlocks()
+
+    def cancelBlock2Window(self, d):
+        """Application cancelled the request - cancel outstanding
+           block requests (no new ones are sent after window_done
+           fails with CancelledError)."""
+        log.msg("Parallel transfer cancelled.")
+        pending = list(self.window_requests.values())
+        self.window_requests.clear()
+        self.window_blocks.clear()
+        for request_d in pending:
+            request_d.cancel()
+
+    def windowFailed(self, reason):
+        """Abort parallel transfer - cancel outstanding requests."""
+        if self.window_done.called:
+            return None
+        pending = list(self.window_requests.values())
+        self.window_requests.clear()
+        self.window_blocks.clear()
+        self.window_done.errback(reason)
+        for d in pending:
+            d.cancel()
+        return None
+
     def askForNextResponseBlock(self, result, request):
         """Helper method used to ask server to send next response block."""
         log.msg("Requesting next block of blockwise response.")
@@ -1219,6 +2271,12 @@ class Requester(object):
 
 
 
+RESOURCE_ERRORS = (error.NoResource, error.UnallowedMethod, error.UnsupportedMethod,
+                   error.UnsupportedContentFormat, error.RequestEntityTooLarge)
+"""Exceptions raised by resource traversal or resource request
+   check, for which Responder sends error response."""
+
+
 class Responder(object):
     """Class used to handle single incoming request.
 
@@ -1232,10 +2290,15 @@ class Responder(object):
         self.protocol = protocol
         self.assembled_request = None
         self.app_response = None
+        self.max_body_size = protocol.incoming_requests.max_body_size
         log.msg("Request doesn't pertain to earlier blockwise requests.")
-        self.deferred = self.processBlock1InRequest(request)
-        self.deferred.addErrback(self.handleBlock1RequestErrors)
-        self.deferred.addCallback(self.dispatchRequest)
+        if request.opt.block1 is None:
+            # Fast path - complete request is dispatched without Deferred chain
+            self.deferred = None
+            self.dispatchRequest(request)
+        else:
+            self.deferred = self.processBlock1InRequest(request)
+            self.deferred.addCallbacks(self.dispatchRequest, self.handleBlock1RequestErrors)
 
     def processBlock1InRequest(self, request):
         """Process incoming request with regard to Block1 option.
@@ -1246,10 +2309,18 @@ class Responder(object):
             block1 = request.opt.block1
             log.msg("Request with Block1 option received, number = %d, more = %d, size_exp = %d." % (block1.block_number, block1.more, block1.size_exponent))
             if block1.block_number == 0:
-                #TODO: Check if resource is available - if not send error immediately
-                #TODO: Check if method is allowed - if not send error immediately
                 log.msg("New or restarted incoming blockwise request.")
+                self.discardRequestBody()
+                try:
+                    self.checkResource(request)
+                except RESOURCE_ERRORS as e:
+                    self.respondWithResourceError(request, e)
+                    return defer.fail(e)
                 self.assembled_request = request
+            elif self.assembled_request is None:
+                # Transfer expired or was evicted from session table
+                self.respondWithError(request, REQUEST_ENTITY_INCOMPLETE, b"Error: Request block received without preceding blocks!")
+                return defer.fail(error.NotImplemented())
             else:
                 try:
                     self.assembled_request.appendRequestBlock(request)
@@ -1257,23 +2328,77 @@ class Responder(object):
                     self.respondWithError(request, NOT_IMPLEMENTED, b"Error: Request block received out of order!")
                     return defer.fail(error.NotImplemented())
                     #raise error.NotImplemented
+            if self.max_body_size is not None and self.assembled_request.bodySize() > self.max_body_size:
+                self.rejectRequestBody(request, self.max_body_size)
+                return defer.fail(error.RequestEntityTooLarge(self.max_body_size))
+            threshold = self.protocol.spool_threshold
+            if threshold is not None and self.assembled_request.body is None and len(self.assembled_request.payload) > threshold:
+                log.msg("Request body exceeds %d bytes - spooling to temporary file." % threshold)
+                self.assembled_request.spoolBody(tempfile.TemporaryFile())
             if block1.more is True:
                 #TODO: SUCCES_CODE Code should be either Changed or Created - Resource check needed
-                #TODO: SIZE_CHECK1 should check if the size of incoming payload is still acceptable
-                #TODO: SIZE_CHECK2 should check if Size option is present, and reject the resource if size too large
                 return self.acknowledgeRequestBlock(request)
             else:
                 log.msg("Complete blockwise request received.")
+                if self.assembled_request.body is not None:
+                    self.assembled_request.body.seek(0)
                 return defer.succeed(self.assembled_request)
         else:
             if self.assembled_request is not None:
                 log.msg("Non-blockwise request received during blockwise transfer. Blockwise transfer cancelled.")
+                self.discardRequestBody()
             return defer.succeed(request)
 
+    def discardRequestBody(self):
+        """Forget partially received request (closing
+           its temporary file, if body was spooled)."""
+        if self.assembled_request is not None and self.assembled_request.body is not None:
+            self.assembled_request.body.close()
+        self.assembled_request = None
+
+    def checkResource(self, request):
+        """Resolve target resource of blockwise request when its first
+           block arrives and check if the request is acceptable (method,
+           content format and body size declared in Size1 option).
+           Raises one of RESOURCE_ERRORS otherwise."""
+        request.prepath = []
+        request.postpath = list(request.opt.uri_path)
+        resource = self.protocol.endpoint.getResourceFor(request)
+        resource.checkRequest(request)
+        if resource.max_body_size is not None:
+            if self.max_body_size is None or resource.max_body_size < self.max_body_size:
+                self.max_body_size = resource.max_body_size
+        if self.max_body_size is not None and request.opt.size1 is not None and request.opt.size1 > self.max_body_size:
+            raise error.RequestEntityTooLarge(self.max_body_size)
+
+    def respondWithResourceError(self, request, err):
+        """Send error response for exception raised by resource
+           traversal or resource request check."""
+        if isinstance(err, error.NoResource):
+            self.respondWithError(request, NOT_FOUND, b"Error: Resource not found!")
+        elif isinstance(err, error.UnallowedMethod):
+            self.respondWithError(request, METHOD_NOT_ALLOWED, b"Error: Method not allowed!")
+        elif isinstance(err, error.UnsupportedMethod):
+            self.respondWithError(request, METHOD_NOT_ALLOWED, b"Error: Method not recognized!")
+        elif isinstance(err, error.UnsupportedContentFormat):
+            self.respondWithError(request, UNSUPPORTED_CONTENT_FORMAT, b"Error: Content format not supported!")
+        else:
+            self.rejectRequestBody(request, err.args[0] if err.args else self.max_body_size)
+
+    def rejectRequestBody(self, request, max_body_size):
+        """Send 4.13 Request Entity Too Large (with Size1 option
+           indicating largest acceptable body) and stop assembling
+           the request."""
+        log.msg("Request body exceeds %d bytes - rejected." % max_body_size)
+        self.discardRequestBody()
+        response = Message(code=REQUEST_ENTITY_TOO_LARGE, payload=b"Error: Request entity too large!")
+        response.opt.size1 = max_body_size
+        self.respond(response, request)
+
     def acknowledgeRequestBlock(self, request):
         """Helper method used to ask client to send next request block."""
         log.msg("Sending block acknowledgement (allowing client to send next block).")
-        response = request.generateNextBlock1Response()
+        response = request.generateNextBlock1Response(self.protocol.max_block_size_exp)
         self.deferred = self.sendNonFinalResponse(response, request)
         self.deferred.addCallback(self.processBlock1InRequest)
         return self.deferred
@@ -1282,32 +2407,137 @@ class Responder(object):
         """Dispatch incoming request - search endpoint
            resource tree for resource in Uri Path
            and call proper CoAP Method on it."""
-        #TODO: Request with Block2 option and non-zero block number should get error response
+        cache = self.protocol.representation_cache
+        if cache is not None and request.code == GET and request.opt.block2 is not None and request.opt.block2.block_number > 0:
+            representation = cache.get(representationKey(request), self.protocol.clock.seconds())
+            if representation is not None:
+                log.msg("Serving block from cached representation.")
+                block_number, size_exp = self.requestedBlock(request)
+                self.sendCachedBlock(representation, block_number, size_exp, request)
+                return defer.succeed(None)
         request.prepath = []
         request.postpath = request.opt.uri_path
+        profiler = self.protocol.profiler
         try:
-            resource = self.protocol.endpoint.getResourceFor(request)
+            if profiler is None:
+                resource = self.protocol.endpoint.getResourceFor(request)
+            else:
+                resource = profiler.traverse(self.protocol.endpoint, request)
+            etag = resource.currentETag(request) if hasattr(resource, 'currentETag') else None
+            if self.isValidated(request, etag):
+                log.msg("Representation not changed - rendering skipped.")
+                return self.sendValid(request, etag)
+            cache = self.responseCacheFor(resource, request)
+            if cache is not None:
+                response = cache.get(representationKey(request), self.protocol.clock.seconds())
+                if response is not None:
+                    log.msg("Serving cached response.")
+                    return self.respond(response, request)
+            if getattr(resource, 'single_flight', False) and request.code == GET and request.opt.observe is None:
+                d = self.renderShared(resource, request)
+            elif profiler is None:
+                d = resource.render(request)
+            else:
+                d = profiler.render(resource, request)
+        except RESOURCE_ERRORS as e:
+            self.respondWithResourceError(request, e)
+        except Exception:
+            # Render is called directly (not from a Deferred callback) -
+            # errors must not reach the caller (e.g. updatedState)
+            log.err(failure.Failure(), "Error while rendering resource")
+            self.respondWithError(request, INTERNAL_SERVER_ERROR, b"Error: Internal server error!")
+        else:
+            app_response = synchronousResponse(d)
+            if app_response is not None:
+                # Response is ready - no need for empty ACK timer
+                return self.prepareResponse(app_response, request, resource, cache)
+            delayed_ack = self.protocol.clock.callLater(EMPTY_ACK_DELAY, self.sendEmptyAck, request)
+            d.addCallback(self.prepareResponse, request, resource, cache, delayed_ack)
+            return d
+
+    def prepareResponse(self, app_response, request, resource, cache, delayed_ack=None):
+        """Process response rendered by resource (observation,
+           ETag, response cache) and send it."""
+        if resource.observable and request.code == GET and request.opt.observe is not None:
+            app_response = self.handleObserve(app_response, request, resource)
+        if getattr(resource, 'etag_mode', None) is not None:
+            app_response = self.addETag(app_response, resource, request)
+        if cache is not None:
+            app_response = self.storeResponse(app_response, request, cache)
+        return self.respond(app_response, request, delayed_ack)
+
+    def renderShared(self, resource, request):
+        """Render resource, or join identical pending render
+           - each Responder receives its own copy of response."""
+        key = representationKey(request)
+        if getattr(resource, 'single_flight_per_peer', False):
+            key = (request.remote,) + key
+        shared = self.protocol.shared_renders.get(key)
+        if shared is not None:
+            log.msg("Identical render pending - sharing its response.")
+            return shared.join()
+        profiler = self.protocol.profiler
+        if profiler is None:
             d = resource.render(request)
-        except error.NoResource:
-            self.respondWithError(request, NOT_FOUND, b"Error: Resource not found!")
-        except error.UnallowedMethod:
-            self.respondWithError(request, METHOD_NOT_ALLOWED, b"Error: Method not allowed!")
-        except error.UnsupportedMethod:
-            self.respondWithError(request, METHOD_NOT_ALLOWED, b"Error: Method not recognized!")
         else:
-            delayed_ack = reactor.callLater(EMPTY_ACK_DELAY, self.sendEmptyAck, request)
-            if resource.observable and request.code == GET and request.opt.observe is not None:
-                d.addCallback(self.handleObserve, request, resource)
-            d.addCallback(self.respond, request, delayed_ack)
+            d = profiler.render(resource, request)
+        if not isinstance(d, defer.Deferred) or d.called:
             return d
+        d.addBoth(self.removeSharedRender, key)
+        shared = SharedRequest(d)
+        self.protocol.shared_renders[key] = shared
+        return shared.join()
+
+    def removeSharedRender(self, result, key):
+        self.protocol.shared_renders.pop(key, None)
+        return result
+
+    def addETag(self, app_response, resource, request):
+        if app_response.code == CONTENT and app_response.opt.etag is None:
+            app_response.opt.etag = resource.representationETag(app_response, request)
+        return app_response
+
+    def isValidated(self, request, etag):
+        """Check if request is a (non-Observe) GET for the first
+           or only block of representation with given ETag."""
+        if etag is None or request.code != GET or request.opt.observe is not None:
+            return False
+        block2 = request.opt.block2 or request.opt.qblock2
+        if block2 is not None and block2.block_number > 0:
+            return False
+        return etag in request.opt.etags
+
+    def sendValid(self, request, etag, max_age=None):
+        """Respond with 2.03 Valid - client's stored
+           representation (with given ETag) is still current."""
+        response = Message(code=VALID, payload=b"")
+        response.opt.etag = etag
+        response.opt.max_age = max_age
+        self.sendResponse(response, request)
+        return defer.succeed(None)
+
+    def responseCacheFor(self, resource, request):
+        """Return response cache of the resource, if request
+           may be served from it (GET without Observe and Block2)."""
+        cache = getattr(resource, 'response_cache', None)
+        if cache is not None and request.code == GET and request.opt.observe is None and request.opt.block2 is None:
+            return cache
+        return None
+
+    def storeResponse(self, app_response, request, cache):
+        cache.put(representationKey(request), app_response, self.protocol.clock.seconds())
+        return app_response
 
     def handleBlock1RequestErrors(self, err):
         """Handle (silently ignore) request errors related
            to Block1. Currently it's used to catch:
            - NotImplemented - requests which are send non-sequentially
            - WaitingForClientTimedOut - requests timed out
+           - RESOURCE_ERRORS - requests rejected (with error response)
+             before the whole body was received
         """
-        err.trap(error.NotImplemented, error.WaitingForClientTimedOut)
+        self.discardRequestBody()
+        err.trap(error.NotImplemented, error.WaitingForClientTimedOut, defer.CancelledError, *RESOURCE_ERRORS)
 
     def respondWithError(self, request, code, payload):
         """Helper method to send error response to client."""
@@ -1336,6 +2566,8 @@ class Responder(object):
         else:
             obs = Observation(request)
             resource.observers[observation_identifier] = obs
+            if self.protocol.metrics is not None:
+                self.protocol.metrics.observerAdded(resource)
 
         app_response.opt.observe = resource.observe_index
 
@@ -1351,16 +2583,67 @@ class Responder(object):
             if delayed_ack.active() is True:
                 delayed_ack.cancel()
         self.app_response = app_response
-        size_exp = min(request.opt.block2.size_exponent if request.opt.block2 is not None else DEFAULT_BLOCK_SIZE_EXP, DEFAULT_BLOCK_SIZE_EXP)
-        if len(self.app_response.payload) > (2 ** (size_exp + 4)):
-            response = self.app_response.extractBlock(0, size_exp)
-            self.app_response.opt.block2 = response.opt.block2
-            return self.sendResponseBlock(response, request)
+        if app_response.code == CONTENT and request.opt.etags:
+            etag = app_response.opt.etag
+            if etag is None and isinstance(app_response.payload, six.binary_type):
+                # Client may know ETag added to earlier blockwise response
+                etag = generateETag(app_response.payload)
+            if self.isValidated(request, etag):
+                log.msg("Representation not changed - sending 2.03 Valid.")
+                return self.sendValid(request, etag, app_response.opt.max_age)
+        block_number = 0
+        if request.opt.qblock2 is not None:
+            qblock2 = request.opt.qblock2
+            size_exp = min(qblock2.size_exponent, self.protocol.max_block_size_exp)
+            if len(app_response.payload) > (2 ** (size_exp + 4)) and app_response.code == CONTENT:
+                self.ensureETag()
+                sender = QBlock2Sender(self.protocol, app_response, request, size_exp)
+                sender.sendSet(qblock2.block_number * 2 ** (qblock2.size_exponent - size_exp), request)
+                return defer.succeed(None)
+        block_number, size_exp = self.requestedBlock(request)
+        if len(self.app_response.payload) > (2 ** (size_exp + 4)) or (block_number > 0 and app_response.code == CONTENT):
+            # Client may ask for any block of fresh representation
+            # (e.g. when fetching blocks in parallel or resuming download)
+            self.ensureETag()
+            cache = self.protocol.representation_cache
+            # Payloads which are not in memory (e.g. memory-mapped files)
+            # are sliced directly, without caching
+            if (cache is not None and request.code == GET and app_response.code == CONTENT and
+                    isinstance(app_response.payload, six.binary_type)):
+                representation = cache.put(representationKey(request), app_response, size_exp, self.protocol.clock.seconds())
+                self.app_response = None
+                self.sendCachedBlock(representation, block_number, size_exp, request)
+                return defer.succeed(None)
+            return self.sendBlock(block_number, size_exp, request)
         else:
             self.sendResponse(app_response, request)
             return defer.succeed(None)
-        if response is None:
-            return defer.fail()
+
+    def requestedBlock(self, request):
+        """Return number and size exponent of response block
+           requested by client (block size is limited to
+           max_block_size_exp of the protocol)."""
+        if request.opt.block2 is not None:
+            size_exp = min(request.opt.block2.size_exponent, self.protocol.max_block_size_exp)
+            block_number = request.opt.block2.block_number * 2 ** (request.opt.block2.size_exponent - size_exp)
+            return block_number, size_exp
+        return 0, self.protocol.blockSizeExponent(request.remote)
+
+    def sendCachedBlock(self, representation, block_number, size_exp, request):
+        """Send requested block of shared representation. Client
+           session is not kept - next block request is served from
+           the cache as well."""
+        block = representation.block(block_number, size_exp)
+        if block is None:
+            log.msg("Block out of range")
+            block = Message(code=BAD_OPTION, payload=b"Error: Block out of range!")
+        self.sendResponse(block, request)
+
+    def ensureETag(self):
+        """Add ETag to blockwise response, so that client can check
+           if all blocks belong to the same representation."""
+        if self.app_response.opt.etag is None:
+            self.app_response.opt.etag = generateETag(self.app_response.payload)
 
     def processBlock2InRequest(self, request):
         """Process incoming request with regard to Block2 option.
@@ -1371,24 +2654,29 @@ class Responder(object):
             block2 = request.opt.block2
             log.msg("Request with Block2 option received, number = %d, more = %d, size_exp = %d." % (block2.block_number, block2.more, block2.size_exponent))
             sent_length = (2 ** (self.app_response.opt.block2.size_exponent + 4)) * (self.app_response.opt.block2.block_number + 1)
-            #TODO: compare block size of request and response - calculate new block_number if necessary
-            if (2 ** (block2.size_exponent + 4)) * block2.block_number == sent_length:
-                next_block = self.app_response.extractBlock(block2.block_number, block2.size_exponent)
-                if next_block is None:
-                    log.msg("Block out of range")
-                    return defer.fail()
-                if next_block.opt.block2.more is True:
-                    self.app_response.opt.block2 = next_block.opt.block2
-                    return self.sendResponseBlock(next_block, request)
-                else:
-                    self.sendResponse(next_block, request)
-                    return defer.succeed(None)
-            else:
-                log.msg("Incorrect block number requested")
-                return defer.fail()
+            size_exp = min(block2.size_exponent, self.protocol.max_block_size_exp)
+            block_number = block2.block_number * 2 ** (block2.size_exponent - size_exp)
+            if (2 ** (size_exp + 4)) * block_number != sent_length:
+                log.msg("Block requested out of order (parallel or resumed transfer).")
+            return self.sendBlock(block_number, size_exp, request)
         else:
             return defer.fail()
 
+    def sendBlock(self, block_number, size_exp, request):
+        """Send requested block of the response. If more blocks
+           follow, wait for next request from client."""
+        block = self.app_response.extractBlock(block_number, size_exp)
+        if block is None:
+            log.msg("Block out of range")
+            self.sendResponse(Message(code=BAD_OPTION, payload=b"Error: Block out of range!"), request)
+            return defer.succeed(None)
+        if block.opt.block2.more is True:
+            self.app_response.opt.block2 = block.opt.block2
+            return self.sendResponseBlock(block, request)
+        else:
+            self.sendResponse(block, request)
+            return defer.succeed(None)
+
     def sendResponseBlock(self, response_block, request):
         """Helper method to send next response block to client."""
         log.msg("Sending response block.")
@@ -1400,8 +2688,9 @@ class Responder(object):
     def handleBlock2RequestErrors(self, err):
         """Handle (silently ignore) request errors related
            to Block2. Currently it's used only to ignore
-           when client doesn't request next block for a long time"""
-        err.trap(error.WaitingForClientTimedOut)
+           when client doesn't request next block for a long time
+           (or when transfer is evicted from session table)"""
+        err.trap(error.WaitingForClientTimedOut, defer.CancelledError)
 
     def sendNonFinalResponse(self, response, request):
         """Helper method to send, a response to client, and setup
@@ -1409,13 +2698,15 @@ class Responder(object):
 
         def cancelNonFinalResponse(d):
             log.msg("Waiting for next client request cancelled")
-            self.protocol.incoming_requests.pop((uriPathAsString(request.opt.uri_path), request.remote))
+            self.protocol.incoming_requests.pop((uriPathAsString(request.opt.uri_path), request.remote), None)
 
         def timeoutNonFinalResponse(d):
             """Clean the Response after a timeout."""
 
             log.msg("Waiting for next blockwise request timed out")
-            self.protocol.incoming_requests.pop((uriPathAsString(request.opt.uri_path), request.remote))
+            self.protocol.incoming_requests.pop((uriPathAsString(request.opt.uri_path), request.remote), None)
+            if self.protocol.metrics is not None:
+                self.protocol.metrics.clientTimedOut(request)
             d.errback(error.WaitingForClientTimedOut())
 
         def gotResult(result):
@@ -1424,7 +2715,7 @@ class Responder(object):
             return result
 
         d = defer.Deferred(cancelNonFinalResponse)
-        timeout = reactor.callLater(MAX_TRANSMIT_WAIT, timeoutNonFinalResponse, d)
+        timeout = self.protocol.clock.callLater(MAX_TRANSMIT_WAIT, timeoutNonFinalResponse, d)
         d.addBoth(gotResult)
         self.protocol.incoming_requests[(uriPathAsString(request.opt.uri_path), request.remote)] = self
         self.sendResponse(response, request)
@@ -1434,6 +2725,19 @@ class Responder(object):
         d, self.deferred = self.deferred, None
         d.callback(request)
 
+    def bufferedSize(self):
+        size = 0
+        if self.assembled_request is not None:
+            size += bufferedLength(self.assembled_request.payload)
+        if self.app_response is not None:
+            size += bufferedLength(self.app_response.payload)
+        return size
+
+    def evict(self):
+        """Stop waiting for next request from client."""
+        if self.deferred is not None and not self.deferred.called:
+            self.deferred.cancel()
+
     def sendResponse(self, response, request):
         """Send a response or single response block.
 
@@ -1473,6 +2777,483 @@ class Responder(object):
         ack = Message(mtype=ACK, code=EMPTY, payload="")
         self.respond(ack, request)
 
+def sendQBlockResponse(protocol, response, request):
+    """Send Q-Block response to request. First response to
+       CON request is piggybacked, others are NON."""
+    response.token = request.token
+    response.remote = request.remote
+    if response.mtype is None:
+        if request.mtype is CON and request.response_type is None:
+            response.mtype = ACK
+            response.mid = request.mid
+        else:
+            response.mtype = NON
+    request.response_type = response.mtype
+    protocol.sendMessage(response)
+
+
+class QBlock2Sender(object):
+    """Server side of Q-Block2 transfer (RFC 9177).
+
+       Response payload is sent in bursts of MAX_PAYLOADS NON blocks.
+       Next burst is sent when client asks for it (Q-Block2 option with
+       M bit set) or after NON_TIMEOUT. Client may ask for missing
+       blocks with several Q-Block2 options in one request. Sender is
+       kept in incoming_requests (like Responder waiting for next
+       Block2 request) until NON_PARTIAL_TIMEOUT passes without
+       requests from client."""
+
+    def __init__(self, protocol, app_response, request, size_exp):
+        self.protocol = protocol
+        self.app_response = app_response
+        self.size_exp = size_exp
+        self.key = (uriPathAsString(request.opt.uri_path), request.remote)
+        size = 2 ** (size_exp + 4)
+        self.count = (len(app_response.payload) + size - 1) // size
+        self.next_set = 0
+        self.burst = None
+        self.expiry = None
+
+    def sendSet(self, start, request):
+        """Send burst of blocks starting with given block number."""
+        if self.burst is not None and self.burst.active():
+            self.burst.cancel()
+        self.burst = None
+        end = min(start + MAX_PAYLOADS, self.count)
+        log.msg("Sending Q-Block2 blocks %d-%d." % (start, end - 1))
+        for number in range(start, end):
+            self.sendBlock(number, request)
+        self.next_set = max(self.next_set, end)
+        if start < end < self.count:
+            self.burst = self.protocol.clock.callLater(NON_TIMEOUT, self.sendSet, end, request)
+        self.register()
+
+    def sendBlock(self, number, request):
+        block = self.app_response.extractBlock(number, self.size_exp)
+        if block is None:
+            response = Message(code=BAD_OPTION, payload=b"Error: Block out of range!")
+        else:
+            response = block
+            response.opt.qblock2 = block.opt.block2
+            response.opt.deleteOption(BLOCK2)
+        sendQBlockResponse(self.protocol, response, request)
+
+    def handleNextRequest(self, request):
+        """Serve request for next burst or for missing blocks."""
+        qblocks = request.opt.getOption(Q_BLOCK2)
+        if not qblocks:
+            log.msg("Request without Q-Block2 option received - Q-Block2 transfer cancelled.")
+            self.expire()
+            Responder(self.protocol, request)
+            return
+        for option in qblocks:
+            number = option.value.block_number
+            if option.value.size_exponent > self.size_exp:
+                number = number * 2 ** (option.value.size_exponent - self.size_exp)
+            else:
+                number = number // 2 ** (self.size_exp - option.value.size_exponent)
+            if option.value.more:
+                if number >= self.next_set or number == 0:
+                    self.sendSet(number, request)
+            else:
+                self.sendBlock(number, request)
+        self.register()
+
+    def register(self):
+        self.protocol.incoming_requests[self.key] = self
+        if self.expiry is not None and self.expiry.active():
+            self.expiry.cancel()
+        self.expiry = self.protocol.clock.callLater(NON_PARTIAL_TIMEOUT, self.expire)
+
+    def bufferedSize(self):
+        return bufferedLength(self.app_response.payload)
+
+    def evict(self):
+        self.expire()
+
+    def expire(self):
+        """Forget the body."""
+        for timer in (self.burst, self.expiry):
+            if timer is not None and timer.active():
+                timer.cancel()
+        if self.protocol.incoming_requests.get(self.key) is self:
+            del self.protocol.incoming_requests[self.key]
+
+
+class QBlockClient(object):
+    """Common part of client side Q-Block transfers. All requests
+       of the transfer use the same token; transfer is registered
+       in outgoing_requests table until it's finished."""
+
+    def __init__(self, protocol, app_request, size_exp):
+        self.protocol = protocol
+        self.app_request = app_request
+        self.size_exp = size_exp
+        self.token = protocol.nextToken()
+        self.retries = 0
+        self.recovered = 0  # blocks sent again (Q-Block1) or asked for again (Q-Block2)
+        self.timer = None
+        self.deferred = defer.Deferred(self.cancel)
+
+    def register(self):
+        self.protocol.outgoing_requests[(self.token, self.app_request.remote)] = self
+
+    def restartTimer(self, timeout):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = self.protocol.clock.callLater(timeout, self.receiveTimedOut)
+
+    def cleanup(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        key = (self.token, self.app_request.remote)
+        if self.protocol.outgoing_requests.get(key) is self:
+            del self.protocol.outgoing_requests[key]
+
+    def cancel(self, d):
+        log.msg("Q-Block transfer cancelled")
+        self.cleanup()
+
+    def finish(self, response):
+        self.cleanup()
+        self.deferred.callback(response)
+
+    def fail(self, reason):
+        self.cleanup()
+        if self.protocol.metrics is not None and isinstance(reason, error.RequestTimedOut):
+            self.protocol.metrics.requestTimedOut(self.app_request)
+        self.deferred.errback(reason)
+
+
+class QBlock2Receiver(QBlockClient):
+    """Client side of Q-Block2 transfer (RFC 9177).
+
+       After NON_RECEIVE_TIMEOUT without new blocks client asks for
+       missing ones (up to MAX_PAYLOADS in one request). Transfer
+       fails after NON_MAX_RETRANSMIT attempts without progress."""
+
+    def __init__(self, protocol, app_request, size_exp):
+        QBlockClient.__init__(self, protocol, app_request, size_exp)
+        self.blocks = {}  # received payloads (identified by block number)
+        self.next_missing = 0  # all blocks before it were received
+        self.highest = None  # highest block number received
+        self.first = None
+        self.last = None
+        self.requested = 0
+        self.sendRequest(((0, True),))
+
+    def sendRequest(self, blocks):
+        """Send request with Q-Block2 option for every (number, more) tuple."""
+        request = copy.copy(self.app_request)
+        request.opt = copy.deepcopy(self.app_request.opt)
+        request.opt.deleteOption(Q_BLOCK2)
+        for number, more in blocks:
+            request.opt.addOption(BlockOption(Q_BLOCK2, (number, more, self.size_exp)))
+        request.token = self.token
+        request.mid = None
+        request.response_type = None
+        if request.mtype is None:
+            request.mtype = NON
+        self.protocol.sendMessage(request)
+        self.register()
+        self.restartTimer(NON_RECEIVE_TIMEOUT)
+
+    def handleResponse(self, response):
+        if self.deferred.called:
+            return
+        block = response.opt.qblock2
+        if block is None:
+            # Body fits in a single message (or error response)
+            self.finish(response)
+            return
+        if self.first is None:
+            self.first = response
+            self.size_exp = block.size_exponent
+        elif response.opt.etag != self.first.opt.etag:
+            self.fail(error.ResourceChanged())
+            return
+        elif block.size_exponent != self.size_exp:
+            self.fail(error.NotImplemented())
+            return
+        if block.block_number > MAX_QBLOCK_NUMBER:
+            log.msg("Q-Block2 block number %d out of range - block ignored." % block.block_number)
+            return
+        self.blocks[block.block_number] = response.payload
+        self.highest = max(self.highest, block.block_number) if self.highest is not None else block.block_number
+        self.retries = 0
+        if block.more is False:
+            self.last = block.block_number
+        elif response.opt.size2 is not None and (response.opt.size2 - 1) // (2 ** (self.size_exp + 4)) <= MAX_QBLOCK_NUMBER:
+            self.last = (response.opt.size2 - 1) // (2 ** (self.size_exp + 4))
+        missing = self.firstMissing()
+        if self.last is not None and missing > self.last:
+            payload = b"".join(self.blocks[number] for number in range(self.last + 1))
+            assembled = copy.copy(self.first)
+            assembled.opt = copy.deepcopy(self.first.opt)
+            assembled.opt.deleteOption(Q_BLOCK2)
+            assembled.payload = payload
+            self.finish(assembled)
+            return
+        self.register()
+        if missing % MAX_PAYLOADS == 0 and missing > self.requested:
+            # Burst complete - ask for the next one
+            self.requested = missing
+            self.sendRequest(((missing, True),))
+        else:
+            self.restartTimer(NON_RECEIVE_TIMEOUT)
+
+    def firstMissing(self):
+        while self.next_missing in self.blocks:
+            self.next_missing += 1
+        return self.next_missing
+
+    def receiveTimedOut(self):
+        self.timer = None
+        self.retries += 1
+        if self.retries > NON_MAX_RETRANSMIT:
+            self.fail(error.RequestTimedOut())
+            return
+        if not self.blocks:
+            self.sendRequest(((0, True),))
+            return
+        upto = self.last if self.last is not None else self.highest
+        missing = missingBlocks(self.blocks, self.firstMissing(), upto, MAX_PAYLOADS)
+        log.msg("Q-Block2 blocks missing: %r" % (missing,))
+        if missing:
+            self.recovered += len(missing)
+            self.sendRequest([(number, False) for number in missing])
+        else:
+            self.sendRequest(((upto + 1, True),))
+
+
+class QBlock1Sender(QBlockClient):
+    """Client side of Q-Block1 transfer (RFC 9177).
+
+       Request payload is sent in bursts of MAX_PAYLOADS NON blocks,
+       all with the same token. Next burst is sent after server
+       confirms the previous one with 2.31 Continue. Blocks listed
+       in 4.08 Request Entity Incomplete response are sent again. If
+       server doesn't respond within NON_TIMEOUT, last block of
+       the burst is repeated."""
+
+    def __init__(self, protocol, app_request, size_exp):
+        QBlockClient.__init__(self, protocol, app_request, size_exp)
+        size = 2 ** (size_exp + 4)
+        self.count = (len(app_request.payload) + size - 1) // size
+        self.set_end = 0
+        self.sendSet(0)
+
+    def sendSet(self, start):
+        self.set_end = min(start + MAX_PAYLOADS, self.count)
+        log.msg("Sending Q-Block1 blocks %d-%d." % (start, self.set_end - 1))
+        for number in range(start, self.set_end):
+            self.sendBlock(number)
+        self.restartTimer(NON_TIMEOUT)
+
+    def sendBlock(self, number):
+        block = self.app_request.extractBlock(number, self.size_exp)
+        block.opt.qblock1 = block.opt.block1
+        block.opt.deleteOption(BLOCK1)
+        block.token = self.token
+        block.mtype = NON
+        block.response_type = None
+        self.protocol.sendMessage(block)
+        self.register()
+
+    def handleResponse(self, response):
+        if self.deferred.called:
+            return
+        self.retries = 0
+        if response.code == CONTINUE and response.opt.qblock1 is not None:
+            if response.opt.qblock1.block_number + 1 >= self.set_end and self.set_end < self.count:
+                self.sendSet(self.set_end)
+            else:
+                self.register()
+                self.restartTimer(NON_TIMEOUT)
+        elif response.code == REQUEST_ENTITY_INCOMPLETE and response.opt.content_format == media_types_rev['application/missing-blocks+cbor-seq']:
+            missing = [number for number in decodeUintSequence(response.payload) if number < self.count]
+            log.msg("Q-Block1 blocks missing: %r" % (missing,))
+            for number in missing[:MAX_PAYLOADS]:
+                self.sendBlock(number)
+            self.recovered += len(missing[:MAX_PAYLOADS])
+            self.register()
+            self.restartTimer(NON_TIMEOUT)
+        else:
+            self.finish(response)
+
+    def receiveTimedOut(self):
+        self.timer = None
+        self.retries += 1
+        if self.retries > NON_MAX_RETRANSMIT:
+            self.fail(error.RequestTimedOut())
+            return
+        self.sendBlock(self.set_end - 1)
+        self.recovered += 1
+        self.restartTimer(NON_TIMEOUT)
+
+
+class QBlock1Receiver(object):
+    """Server side of Q-Block1 transfer (RFC 9177).
+
+       Received blocks are kept in incoming_requests table (like
+       Block1 requests being assembled by Responder). After each
+       complete burst server responds with 2.31 Continue. Missing
+       blocks are reported in 4.08 Request Entity Incomplete
+       response (CBOR sequence of block numbers) when last block of
+       a burst arrives, or NON_RECEIVE_TIMEOUT after last received
+       block. Complete request is passed to Responder. Its response
+       is repeated if client sends more blocks of the same body
+       (with the same token) within NON_PARTIAL_TIMEOUT."""
+
+    def __init__(self, protocol, request):
+        self.protocol = protocol
+        self.key = (uriPathAsString(request.opt.uri_path), request.remote)
+        self.blocks = {}  # received payloads (identified by block number)
+        self.next_missing = 0  # all blocks before it were received
+        self.highest = None  # highest block number received
+        self.received = 0
+        self.first = None
+        self.last = None
+        self.latest = None
+        self.size_exp = None
+        self.retries = 0
+        self.timer = None
+        self.responder = None
+        self.handleNextRequest(request)
+
+    def handleNextRequest(self, request):
+        block = request.opt.qblock1
+        if block is None:
+            log.msg("Request without Q-Block1 option received - Q-Block1 transfer cancelled.")
+            self.cleanup()
+            Responder(self.protocol, request)
+            return
+        if self.responder is not None:
+            if request.token != self.latest.token:
+                self.cleanup()
+                QBlock1Receiver(self.protocol, request)
+            else:
+                self.repeatResponse(request)
+            return
+        if self.size_exp is None:
+            self.size_exp = block.size_exponent
+        elif block.size_exponent != self.size_exp:
+            log.msg("Q-Block1 block size changed during transfer - block ignored.")
+            self.protocol.incoming_requests[self.key] = self
+            return
+        block_size = 2 ** (self.size_exp + 4)
+        max_body_size = self.protocol.incoming_requests.max_body_size
+        if max_body_size is None:
+            max_body_size = (MAX_QBLOCK_NUMBER + 1) * block_size
+        # Block number is checked before block is stored - missing
+        # blocks are never enumerated up to number chosen by client
+        max_number = min(MAX_QBLOCK_NUMBER, (max_body_size - 1) // block_size)
+        if block.block_number not in self.blocks:
+            self.received += len(request.payload)
+        if (block.block_number > max_number or self.received > max_body_size or
+                (request.opt.size1 is not None and request.opt.size1 > max_body_size)):
+            log.msg("Request body exceeds %d bytes - rejected." % max_body_size)
+            self.cleanup()
+            response = Message(code=REQUEST_ENTITY_TOO_LARGE, payload=b"Error: Request entity too large!")
+            response.opt.size1 = max_body_size
+            sendQBlockResponse(self.protocol, response, request)
+            return
+        self.blocks[block.block_number] = request.payload
+        self.highest = max(self.highest, block.block_number) if self.highest is not None else block.block_number
+        while self.next_missing in self.blocks:
+            self.next_missing += 1
+        if block.block_number == 0:
+            self.first = request
+        if block.more is False:
+            self.last = block.block_number
+        self.latest = request
+        self.retries = 0
+        if self.first is not None and self.last is not None and self.next_missing > self.last:
+            self.dispatch()
+            return
+        self.protocol.incoming_requests[self.key] = self
+        if (block.block_number + 1) % MAX_PAYLOADS == 0 or block.more is False:
+            self.reportProgress(request)
+        self.restartTimer()
+
+    def reportProgress(self, request):
+        """Send 2.31 Continue if all blocks so far were received,
+           4.08 with list of missing blocks otherwise."""
+        upto = self.last if self.last is not None else self.highest
+        missing = missingBlocks(self.blocks, self.next_missing, upto, MAX_PAYLOADS)
+        if missing:
+            response = Message(code=REQUEST_ENTITY_INCOMPLETE, payload=encodeUintSequence(missing))
+            response.opt.content_format = media_types_rev['application/missing-blocks+cbor-seq']
+        else:
+            response = Message(code=CONTINUE)
+            response.opt.qblock1 = (upto, True, self.size_exp)
+        sendQBlockResponse(self.protocol, response, request)
+
+    def restartTimer(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = self.protocol.clock.callLater(NON_RECEIVE_TIMEOUT, self.receiveTimedOut)
+
+    def receiveTimedOut(self):
+        self.timer = None
+        if self.responder is not None:
+            self.cleanup()
+            return
+        self.retries += 1
+        if self.retries > NON_MAX_RETRANSMIT:
+            log.msg("Q-Block1 transfer timed out.")
+            self.cleanup()
+            if self.protocol.metrics is not None:
+                self.protocol.metrics.clientTimedOut(self.latest)
+            return
+        self.reportProgress(self.latest)
+        self.restartTimer()
+
+    def bufferedSize(self):
+        if self.responder is not None:
+            return self.responder.bufferedSize()
+        return self.received
+
+    def evict(self):
+        self.cleanup()
+
+    def cleanup(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        if self.protocol.incoming_requests.get(self.key) is self:
+            del self.protocol.incoming_requests[self.key]
+
+    def dispatch(self):
+        """Pass complete request to Responder. Response
+           is sent to the latest request block."""
+        log.msg("Complete Q-Block1 request received.")
+        self.cleanup()
+        request = copy.copy(self.first)
+        request.opt = copy.deepcopy(self.first.opt)
+        request.opt.deleteOption(Q_BLOCK1)
+        request.payload = b"".join(self.blocks[number] for number in range(self.last + 1))
+        request.token = self.latest.token
+        request.mid = self.latest.mid
+        request.mtype = self.latest.mtype
+        request.response_type = None
+        self.responder = Responder(self.protocol, request)
+        self.protocol.incoming_requests.setdefault(self.key, self)
+        self.timer = self.protocol.clock.callLater(NON_PARTIAL_TIMEOUT, self.receiveTimedOut)
+
+    def repeatResponse(self, request):
+        """Client didn't receive response to complete body - send it again."""
+        self.protocol.incoming_requests[self.key] = self
+        app_response = self.responder.app_response
+        if app_response is None:
+            return
+        log.msg("Repeating response to complete Q-Block1 request.")
+        response = copy.copy(app_response)
+        response.opt = copy.deepcopy(app_response.opt)
+        response.mtype = None
+        response.mid = None
+        sendQBlockResponse(self.protocol, response, request)
+
+
 class Observation(object):
     """An active CoAP observation is described as an Observation object
     attached to a Resource in .observers[(address, token)].
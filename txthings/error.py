@@ -61,6 +61,19 @@ class ResourceChanged(Error):
     not be received in a consistent state.
     """
 
+class UnsupportedContentFormat(Error):
+    """
+    Raised by a resource when content format of request payload
+    is not accepted.
+    """
+
+
+class RequestEntityTooLarge(Error):
+    """
+    Raised when request body exceeds size accepted by server
+    (largest accepted size may be passed as argument).
+    """
+
 class MissingBlock2Option(Error):
     """
     Raised when response with Block2 option is expected 
@@ -74,4 +87,6 @@ __all__ = ['Error',
            'UnsupportedMethod',
            'NotImplemented',
            'RequestTimedOut',
-           'ResourceChanged']
+           'ResourceChanged',
+           'UnsupportedContentFormat',
+           'RequestEntityTooLarge']
@@ -0,0 +1,356 @@
+"""
+Simulated fleet of CoAP devices hosted in a single process.
+
+Every VirtualDevice has its own protocol state (message deduplication,
+exchanges, blockwise transfers), but all devices share one resource
+tree built from template resources, and no device owns a socket.
+Datagrams reach devices in one of two ways:
+
+- FleetProtocol - a single UDP socket for the whole fleet. Requests
+  are demultiplexed by Uri-Host option (device name), ACK/RST and
+  responses by Message ID and Token of messages sent by devices.
+- InMemoryNetwork - every device gets its own virtual address on an
+  in-process network, to which clients (e.g. coap.Coap instances
+  created in the same process) can be attached.
+
+Example:
+    fleet = DeviceFleet()
+    fleet.addDevices(5000, behavior=DeviceBehavior(latency=0.05, observe_interval=10))
+    reactor.listenUDP(coap.COAP_PORT, fleet.protocol)
+"""
+import random
+import struct
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import log
+
+from ipaddress import ip_address
+
+import txthings.coap as coap
+import txthings.resource as resource
+
+
+class DeviceBehavior(object):
+    """Behaviour shared by a group of simulated devices.
+
+       Parameters:
+       - latency - delay before a response is ready (seconds),
+         either a number or a callable taking random.Random
+         instance (see txthings.impairment)
+       - observe_interval - interval between notifications sent
+         to observers of observable resources (None - never)
+       - payload_size - size of sensor representations; sizes above
+         the block size produce blockwise (Block2) responses"""
+
+    def __init__(self, latency=0.0, observe_interval=None, payload_size=16):
+        self.latency = latency
+        self.observe_interval = observe_interval
+        self.payload_size = payload_size
+
+    def responseDelay(self, rng):
+        return self.latency(rng) if callable(self.latency) else self.latency
+
+
+class DeviceResource(resource.CoAPResource):
+    """Base class for template resources shared by all devices
+       of a fleet. Device handling the request is available via
+       self.device(request), its state in device.state."""
+
+    def device(self, request):
+        return request.protocol.device
+
+    def respondLater(self, request, response):
+        """Return Deferred fired with response after the latency
+           configured in behaviour of the device."""
+        device = self.device(request)
+        delay = device.behavior.responseDelay(device.fleet.random)
+        if delay <= 0:
+            return defer.succeed(response)
+        d = defer.Deferred()
+        device.fleet.clock.callLater(delay, d.callback, response)
+        return d
+
+
+class SensorResource(DeviceResource):
+    """Observable sensor. Representation contains device name,
+       sensor name and current reading, padded to payload_size
+       configured in device behaviour."""
+
+    observable = True
+
+    def __init__(self, name):
+        DeviceResource.__init__(self)
+        self.name = name
+        self.visible = True
+
+    def render_GET(self, request):
+        device = self.device(request)
+        payload = b"%s/%s=%d;" % (device.name, self.name, self.observe_index)
+        size = device.behavior.payload_size
+        if len(payload) < size:
+            payload += b"." * (size - len(payload))
+        response = coap.Message(code=coap.CONTENT, payload=payload)
+        response.opt.content_format = coap.media_types_rev['text/plain']
+        return self.respondLater(request, response)
+
+    def notifyDevices(self, behavior):
+        """Send notifications to observers of devices with given behaviour."""
+        self.observe_index = (self.observe_index + 1) % (2 ** 24)
+        for observation in list(self.observers.values()):
+            if observation.original_request.protocol.device.behavior is behavior:
+                observation.trigger()
+
+
+class StateResource(DeviceResource):
+    """Per-device value which can be read with GET and changed with PUT."""
+
+    def __init__(self, key, default=b""):
+        DeviceResource.__init__(self)
+        self.key = key
+        self.default = default
+        self.visible = True
+
+    def render_GET(self, request):
+        value = self.device(request).state.get(self.key, self.default)
+        return self.respondLater(request, coap.Message(code=coap.CONTENT, payload=value))
+
+    def render_PUT(self, request):
+        self.device(request).state[self.key] = request.payload
+        return self.respondLater(request, coap.Message(code=coap.CHANGED))
+
+
+def defaultTemplate():
+    """Build default device resource tree:
+       /sensors/temp, /sensors/humidity (observable) and /config."""
+    root = resource.CoAPResource()
+    sensors = resource.CoAPResource()
+    root.putChild(b'sensors', sensors)
+    sensors.putChild(b'temp', SensorResource(b'temp'))
+    sensors.putChild(b'humidity', SensorResource(b'humidity'))
+    root.putChild(b'config', StateResource(b'config', b'{}'))
+    return root
+
+
+def iterateResources(root, path=()):
+    """Yield (path, resource) for all static resources in a tree."""
+    yield path, root
+    for name, child in root.children.items():
+        for item in iterateResources(child, path + (name,)):
+            yield item
+
+
+class DeviceCoap(coap.Coap):
+    """Protocol instance of a single virtual device. Message IDs
+       and tokens come from the fleet, so that devices sharing one
+       socket never reuse them towards the same peer."""
+
+    def __init__(self, fleet, device):
+        coap.Coap.__init__(self, fleet.endpoint, clock=fleet.clock)
+        self.fleet = fleet
+        self.device = device
+
+    def nextMessageID(self):
+        return self.fleet.nextMessageID()
+
+    def nextToken(self):
+        return self.fleet.nextToken()
+
+
+class VirtualDevice(object):
+    """Single simulated device."""
+
+    def __init__(self, fleet, name, behavior):
+        self.fleet = fleet
+        self.name = name
+        self.behavior = behavior
+        self.state = {}
+        self.address = None
+        self.protocol = DeviceCoap(fleet, self)
+
+    def registerWith(self, remote, path=(b'rd',), lifetime=None):
+        """Register device resources in a Resource Directory
+           (e.g. examples/rd.py). Returns Deferred from Coap.request."""
+        links = []
+        for resource_path, item in iterateResources(self.fleet.root):
+            if item.visible:
+                links.append(b'</' + b'/'.join(resource_path) + b'>')
+        request = coap.Message(code=coap.POST, payload=b','.join(links))
+        request.opt.uri_path = path
+        query = [b'ep=' + self.name]
+        if lifetime is not None:
+            query.append(b'lt=%d' % lifetime)
+        request.opt.uri_query = query
+        request.opt.content_format = coap.media_types_rev['application/link-format']
+        request.remote = remote
+        return self.protocol.request(request)
+
+
+class DeviceTransport(object):
+    """Transport of a device attached to FleetProtocol. Remembers
+       which device sent CON messages and requests, so that ACK, RST
+       and responses arriving on the shared socket can be routed back."""
+
+    def __init__(self, fleet, device):
+        self.fleet = fleet
+        self.device = device
+
+    def write(self, packet, addr):
+        self.fleet.protocol.deviceSent(self.device, packet, addr)
+
+
+class FleetProtocol(DatagramProtocol):
+    """Single-socket demultiplexer for all devices of a fleet.
+
+       Requests are delivered to the device named in Uri-Host option
+       (requests without Uri-Host go to the default device, if set).
+       ACK and RST messages are routed by Message ID, responses by
+       Token of messages previously sent by devices."""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.pending_mids = {}  # (message ID, remote) -> device, for CON sent by devices
+        self.pending_tokens = {}  # (token, remote) -> device, for requests sent by devices
+        self.unroutable = 0
+
+    def deviceSent(self, device, packet, addr):
+        (vttkl, code, mid) = struct.unpack('!BBH', packet[:4])
+        remote = (ip_address(u'%s' % addr[0]), addr[1])
+        if (vttkl & 0x30) >> 4 == coap.CON:
+            self.remember(self.pending_mids, (mid, remote), device)
+        if coap.isRequest(code):
+            token = packet[4:4 + (vttkl & 0x0F)]
+            self.remember(self.pending_tokens, (token, remote), device)
+        self.transport.write(packet, addr)
+
+    def remember(self, table, key, device):
+        if key not in table:
+            self.fleet.clock.callLater(coap.EXCHANGE_LIFETIME, table.pop, key, None)
+        table[key] = device
+
+    def datagramReceived(self, data, remote):
+        host, port = remote
+        message = coap.Message.decode(data, (ip_address(host), port))
+        device = self.route(message)
+        if device is None:
+            self.unroutable += 1
+            log.msg("Fleet: no device for message from %s:%d" % (host, port))
+            return
+        message.protocol = device.protocol
+        device.protocol.messageReceived(message)
+
+    def route(self, message):
+        if coap.isRequest(message.code):
+            host = message.opt.uri_host
+            if host is None:
+                return self.fleet.default_device
+            return self.fleet.devices.get(host)
+        if message.mtype in (coap.ACK, coap.RST) and (message.mid, message.remote) in self.pending_mids:
+            return self.pending_mids[(message.mid, message.remote)]
+        return self.pending_tokens.get((message.token, message.remote))
+
+
+class InMemoryNetwork(object):
+    """In-process datagram network. Protocols are attached with
+       their own (host, port) address; every written datagram is
+       delivered to the protocol attached at destination address
+       after given delay (or dropped if there is none)."""
+
+    def __init__(self, clock=None, delay=0.0):
+        self.clock = clock if clock is not None else reactor
+        self.delay = delay
+        self.hosts = {}
+        self.undeliverable = 0
+
+    def attach(self, protocol, address):
+        host, port = address
+        self.hosts[(u'%s' % host, port)] = protocol
+        protocol.transport = InMemoryTransport(self, (u'%s' % host, port))
+        return protocol.transport
+
+    def send(self, packet, source, destination):
+        recipient = self.hosts.get((u'%s' % destination[0], destination[1]))
+        if recipient is None:
+            self.undeliverable += 1
+            return
+        self.clock.callLater(self.delay, recipient.datagramReceived, packet, source)
+
+
+class InMemoryTransport(object):
+
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+
+    def write(self, packet, addr):
+        self.network.send(packet, self.address, addr)
+
+    def getHost(self):
+        return self.address
+
+
+class DeviceFleet(object):
+    """Collection of virtual devices sharing a template resource tree."""
+
+    def __init__(self, root=None, clock=None, seed=None):
+        self.root = root if root is not None else defaultTemplate()
+        self.endpoint = resource.Endpoint(self.root)
+        self.clock = clock if clock is not None else reactor
+        self.random = random.Random(seed)
+        self.devices = {}  # name -> device
+        self.default_device = None
+        self.protocol = FleetProtocol(self)
+        self.message_id = self.random.randint(0, 65535)
+        self.token = self.random.randint(0, 0xffffffff)
+        self._notifiers = {}  # behaviour -> LoopingCall
+
+    def nextMessageID(self):
+        message_id = self.message_id
+        self.message_id = 0xFFFF & (1 + self.message_id)
+        return message_id
+
+    def nextToken(self):
+        self.token = (self.token + 1) & 0xffffffffffffffff
+        return struct.pack('!Q', self.token).lstrip(b'\x00') or b'\x00'
+
+    def addDevice(self, name, behavior=None):
+        """Create device with given name (bytes, used as Uri-Host)."""
+        behavior = behavior if behavior is not None else DeviceBehavior()
+        device = VirtualDevice(self, name, behavior)
+        device.protocol.transport = DeviceTransport(self, device)
+        self.devices[name] = device
+        if self.default_device is None:
+            self.default_device = device
+        self.scheduleNotifications(behavior)
+        return device
+
+    def addDevices(self, count, prefix=b'dev-', behavior=None):
+        """Create count devices named prefix + number."""
+        return [self.addDevice(prefix + (b'%d' % i), behavior) for i in range(len(self.devices), len(self.devices) + count)]
+
+    def attachTo(self, network, addresses):
+        """Attach all devices to InMemoryNetwork, each with its own
+           address taken from iterable of (host, port) tuples."""
+        for device, address in zip(sorted(self.devices.values(), key=lambda d: d.name), addresses):
+            device.address = (ip_address(u'%s' % address[0]), address[1])
+            network.attach(device.protocol, address)
+
+    def scheduleNotifications(self, behavior):
+        if behavior.observe_interval is None or behavior in self._notifiers:
+            return
+        notifier = task.LoopingCall(self.notify, behavior)
+        notifier.clock = self.clock
+        notifier.start(behavior.observe_interval, now=False)
+        self._notifiers[behavior] = notifier
+
+    def notify(self, behavior):
+        for path, item in iterateResources(self.root):
+            if isinstance(item, SensorResource) and item.observers:
+                item.notifyDevices(behavior)
+
+    def stop(self):
+        """Stop sending periodic notifications."""
+        for notifier in self._notifiers.values():
+            if notifier.running:
+                notifier.stop()
+        self._notifiers.clear()
@@ -0,0 +1,197 @@
+'''
+Network impairment simulator for txThings.
+
+Transports defined here replace a real UDP socket and deliver datagrams
+to another in-process protocol over a simulated link. Each link can
+drop, delay, duplicate and reorder packets, and limit bandwidth.
+Together with twisted.internet.task.Clock (passed to coap.Coap as clock)
+they allow testing and benchmarking retransmissions, blockwise transfers
+and observations under adverse network conditions in simulated time.
+'''
+import random
+import struct
+
+from twisted.python import log
+
+
+def constantDelay(value):
+    """Delay distribution: always the same delay."""
+    return lambda rng: value
+
+
+def uniformDelay(low, high):
+    """Delay distribution: uniformly distributed between low and high."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def normalDelay(mean, stddev):
+    """Delay distribution: normally distributed, never negative."""
+    return lambda rng: max(0.0, rng.gauss(mean, stddev))
+
+
+def exponentialDelay(mean, minimum=0.0):
+    """Delay distribution: fixed minimum plus exponentially
+       distributed queueing delay with given mean."""
+    return lambda rng: minimum + rng.expovariate(1.0 / mean)
+
+
+class LinkStats(object):
+    """Counters collected by a single ImpairedLink."""
+
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_delivered = 0
+        self.bytes_delivered = 0
+        self.dropped = 0
+        self.queue_drops = 0
+        self.duplicated = 0
+        self.reordered = 0
+        self.con_sent = 0
+        self.con_retransmitted = 0
+
+    def asDict(self):
+        return dict(vars(self))
+
+
+class ImpairedLink(object):
+    """One direction of a simulated network path.
+
+       Parameters:
+       - loss - probability that a packet is dropped
+       - delay - one-way delay in seconds, either a number or
+         a callable taking random.Random instance (see *Delay functions)
+       - duplicate - probability that a packet is delivered twice
+       - reorder - probability that a packet is held back for
+         reorder_delay seconds, letting later packets overtake it
+       - bandwidth - link capacity in bytes per second (None - unlimited)
+       - queue_limit - maximum number of bytes waiting for transmission
+         when bandwidth is limited (None - unlimited); excess packets
+         are tail-dropped
+       - seed - seed for the random generator (reproducible runs)"""
+
+    def __init__(self, clock, loss=0.0, delay=0.0, duplicate=0.0, reorder=0.0,
+                 reorder_delay=None, bandwidth=None, queue_limit=None, seed=None):
+        self.clock = clock
+        self.loss = loss
+        self.delay = delay if callable(delay) else constantDelay(delay)
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.bandwidth = bandwidth
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed)
+        self.stats = LinkStats()
+        self._busy_until = 0.0
+        self._con_packets = {}  # last CON packet sent with given Message ID
+
+    def transmit(self, packet, deliver):
+        """Send packet over the link. Function deliver is called with
+           the packet for every copy that reaches the other end."""
+        now = self.clock.seconds()
+        self.stats.packets_sent += 1
+        self.stats.bytes_sent += len(packet)
+        self.countRetransmission(packet)
+        if self.random.random() < self.loss:
+            self.stats.dropped += 1
+            return
+        departure = now
+        if self.bandwidth is not None:
+            start = max(now, self._busy_until)
+            if self.queue_limit is not None and (start - now) * self.bandwidth > self.queue_limit:
+                self.stats.queue_drops += 1
+                return
+            self._busy_until = departure = start + len(packet) / float(self.bandwidth)
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.stats.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            latency = self.delay(self.random)
+            if self.reorder and self.random.random() < self.reorder:
+                self.stats.reordered += 1
+                latency += self.reorder_delay if self.reorder_delay is not None else 2 * latency
+            self.clock.callLater(departure - now + latency, self._deliver, packet, deliver)
+
+    def countRetransmission(self, packet):
+        """Recognize retransmitted CON messages (same Message ID and
+           identical contents as previously sent CON)."""
+        if len(packet) < 4:
+            return
+        (vttkl, code, mid) = struct.unpack('!BBH', packet[:4])
+        if (vttkl & 0x30) >> 4 != 0:
+            return
+        if self._con_packets.get(mid) == packet:
+            self.stats.con_retransmitted += 1
+        else:
+            self.stats.con_sent += 1
+            self._con_packets[mid] = packet
+
+    def _deliver(self, packet, deliver):
+        self.stats.packets_delivered += 1
+        self.stats.bytes_delivered += len(packet)
+        deliver(packet)
+
+
+class ImpairedDatagramTransport(object):
+    """Datagram transport which passes written packets through an
+       ImpairedLink to recipient protocol. Address and port are
+       the source address seen by the recipient (i.e. the address
+       of the protocol using this transport)."""
+
+    def __init__(self, recipient, address, port, link):
+        self.recipient = recipient
+        self.address = address
+        self.port = port
+        self.link = link
+
+    def write(self, packet, addr=None):
+        self.link.transmit(packet, self._deliver)
+
+    def _deliver(self, packet):
+        self.recipient.datagramReceived(packet, (self.address, self.port))
+
+    def getHost(self):
+        return (self.address, self.port)
+
+
+def connect(clock, protocol_a, address_a, protocol_b, address_b, seed=None, **profile):
+    """Connect two protocols with a pair of links sharing the same
+       impairment profile (keyword arguments of ImpairedLink).
+
+       Addresses are (host, port) tuples. Returns tuple
+       (link from a to b, link from b to a)."""
+    seed_ab = seed
+    seed_ba = seed + 1 if seed is not None else None
+    link_ab = ImpairedLink(clock, seed=seed_ab, **profile)
+    link_ba = ImpairedLink(clock, seed=seed_ba, **profile)
+    protocol_a.transport = ImpairedDatagramTransport(protocol_b, address_a[0], address_a[1], link_ab)
+    protocol_b.transport = ImpairedDatagramTransport(protocol_a, address_b[0], address_b[1], link_ba)
+    return link_ab, link_ba
+
+
+def runUntilFired(clock, d, limit=None):
+    """Advance a simulated clock from one scheduled call to the next,
+       until Deferred d fires, no calls remain or the time limit
+       (in simulated seconds from now) passes.
+
+       Returns list with the result or failure of d (empty if d
+       did not fire). Failures are consumed."""
+    outcome = []
+
+    def store(result):
+        outcome.append(result)
+
+    d.addBoth(store)
+    deadline = clock.seconds() + limit if limit is not None else None
+    while not outcome:
+        calls = clock.getDelayedCalls()
+        if not calls:
+            log.msg("Simulation stopped - no more scheduled calls")
+            break
+        next_time = min(call.getTime() for call in calls)
+        if deadline is not None and next_time > deadline:
+            clock.advance(deadline - clock.seconds())
+            break
+        clock.advance(max(0.0, next_time - clock.seconds()))
+    return outcome
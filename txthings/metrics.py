@@ -0,0 +1,281 @@
+"""
+Protocol metrics for txThings.
+
+CoapMetrics collects counters and histograms from one or more Coap
+protocol instances (pass it as metrics argument to coap.Coap):
+messages sent and received by type and code, duplicates, retransmissions,
+timeouts, round-trip times (overall and per peer) and current sizes of
+protocol tables. Metrics are available as a Python dictionary
+(snapshot), as Prometheus text exposition (prometheusText) and through
+StatsResource, which can be added to resource tree of a server
+(usually as /.well-known/stats).
+"""
+import bisect
+import collections
+import json
+
+from twisted.internet import defer
+
+import txthings.coap as coap
+import txthings.resource as resource
+
+DEFAULT_RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""Default upper bounds (in seconds) of round-trip time histogram buckets."""
+
+MAX_PEERS = 1000
+"""Default number of peers for which round-trip time statistics are kept."""
+
+PROMETHEUS_CONTENT_FORMAT = coap.media_types_rev['text/plain']
+JSON_CONTENT_FORMAT = coap.media_types_rev['application/json']
+
+
+def codeString(code):
+    """Return CoAP code in dotted c.dd notation."""
+    return "%d.%02d" % (code >> 5, code & 0x1F)
+
+
+class Histogram(object):
+    """Histogram with fixed bucket upper bounds, exported
+       as cumulative buckets (like Prometheus histograms)."""
+
+    def __init__(self, buckets=DEFAULT_RTT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return list of (upper bound, cumulative count) tuples,
+           last bound is float('inf')."""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, fraction):
+        """Return upper bound of the bucket containing given quantile
+           (float('inf') if it lies above the last bound)."""
+        if self.count == 0:
+            return None
+        threshold = fraction * self.count
+        for bound, total in self.cumulative():
+            if total >= threshold:
+                return bound
+
+    def asDict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': [(bound if bound != float('inf') else '+Inf', n) for bound, n in self.cumulative()]}
+
+
+class PeerStats(object):
+    """Round-trip time estimate for a single peer (RFC 6298 style
+       smoothed RTT and RTT variation)."""
+
+    def __init__(self):
+        self.samples = 0
+        self.srtt = None
+        self.rttvar = None
+        self.last = None
+
+    def update(self, rtt):
+        self.samples += 1
+        self.last = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+
+class CoapMetrics(object):
+    """Counters and histograms collected by Coap protocol instances.
+
+       Round-trip time is measured for CON messages between sending and
+       receiving matching ACK or RST. Retransmitted messages are not
+       sampled (Karn's algorithm)."""
+
+    def __init__(self, rtt_buckets=DEFAULT_RTT_BUCKETS, max_peers=MAX_PEERS):
+        self.protocols = []
+        self.messages_received = collections.defaultdict(int)  # (type, code) -> count
+        self.messages_sent = collections.defaultdict(int)  # (type, code) -> count
+        self.duplicates = collections.defaultdict(int)  # type -> count
+        self.retransmissions = 0
+        self.timeouts = collections.defaultdict(int)  # kind -> count
+        self.rtt = Histogram(rtt_buckets)
+        self.peers = collections.OrderedDict()  # remote -> PeerStats
+        self.max_peers = max_peers
+        self._exchange_starts = {}  # (message ID, remote) -> send time
+        self.observers = 0  # observations registered by bound server protocols
+
+    def bind(self, protocol):
+        """Attach protocol instance (called by Coap)."""
+        self.protocols.append(protocol)
+
+    def messageReceived(self, message):
+        self.messages_received[(message.mtype, message.code)] += 1
+
+    def duplicateReceived(self, message):
+        self.duplicates[message.mtype] += 1
+
+    def messageSent(self, message):
+        self.messages_sent[(message.mtype, message.code)] += 1
+
+    def exchangeStarted(self, message, now):
+        self._exchange_starts[(message.mid, message.remote)] = now
+
+    def exchangeRetransmitted(self, message):
+        self.retransmissions += 1
+        self._exchange_starts.pop((message.mid, message.remote), None)
+
+    def exchangeCompleted(self, message, now):
+        start = self._exchange_starts.pop((message.mid, message.remote), None)
+        if start is not None:
+            rtt = now - start
+            self.rtt.observe(rtt)
+            self.peerStats(message.remote).update(rtt)
+
+    def exchangeAbandoned(self, message):
+        self._exchange_starts.pop((message.mid, message.remote), None)
+
+    def exchangeTimedOut(self, message):
+        self.timeouts['exchange'] += 1
+        self._exchange_starts.pop((message.mid, message.remote), None)
+
+    def observerAdded(self, resource):
+        self.observers += 1
+
+    def requestTimedOut(self, request):
+        self.timeouts['request'] += 1
+
+    def clientTimedOut(self, request):
+        self.timeouts['blockwise'] += 1
+
+    def peerStats(self, remote):
+        stats = self.peers.pop(remote, None)
+        if stats is None:
+            stats = PeerStats()
+            if len(self.peers) >= self.max_peers:
+                self.peers.popitem(last=False)
+        self.peers[remote] = stats
+        return stats
+
+    def gauges(self):
+        """Return current sizes of protocol tables, summed over
+           all bound protocols."""
+        result = collections.OrderedDict()
+        result['active_exchanges'] = sum(len(p.active_exchanges) for p in self.protocols)
+        result['outgoing_requests'] = sum(len(p.outgoing_requests) for p in self.protocols)
+        result['incoming_requests'] = sum(len(p.incoming_requests) for p in self.protocols)
+        result['observations'] = sum(len(p.observations) for p in self.protocols)
+        # Windowed and Q-Block transfers have several outstanding tokens
+        transfers = set(requester for p in self.protocols for requester in p.outgoing_requests.values()
+                        if isBlockwiseTransfer(requester))
+        result['blockwise_sessions'] = result['incoming_requests'] + len(transfers)
+        result['blockwise_buffered_bytes'] = sum(p.incoming_requests.size for p in self.protocols)
+        result['observers'] = self.observers
+        return result
+
+    def snapshot(self):
+        """Return all metrics as a dictionary."""
+        return {
+            'messages_received': dict(('%s %s' % (coap.types[t], codeString(c)), n)
+                                      for (t, c), n in self.messages_received.items()),
+            'messages_sent': dict(('%s %s' % (coap.types[t], codeString(c)), n)
+                                  for (t, c), n in self.messages_sent.items()),
+            'duplicates': dict((coap.types[t], n) for t, n in self.duplicates.items()),
+            'retransmissions': self.retransmissions,
+            'timeouts': dict(self.timeouts),
+            'rtt': self.rtt.asDict(),
+            'peers': dict(('%s:%d' % (remote[0], remote[1]),
+                           {'samples': stats.samples, 'srtt': stats.srtt, 'rttvar': stats.rttvar})
+                          for remote, stats in self.peers.items()),
+            'gauges': dict(self.gauges()),
+        }
+
+    def prometheusText(self, prefix='txthings'):
+        """Return metrics in Prometheus text exposition format."""
+        lines = []
+
+        def family(name, kind, description):
+            lines.append('# HELP %s_%s %s' % (prefix, name, description))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, value, **labels):
+            if labels:
+                label_text = ','.join('%s="%s"' % (k, labels[k]) for k in sorted(labels))
+                lines.append('%s_%s{%s} %s' % (prefix, name, label_text, formatValue(value)))
+            else:
+                lines.append('%s_%s %s' % (prefix, name, formatValue(value)))
+
+        family('messages_received_total', 'counter', 'Messages received by type and code.')
+        for (t, c), n in sorted(self.messages_received.items()):
+            sample('messages_received_total', n, type=coap.types[t], code=codeString(c))
+        family('messages_sent_total', 'counter', 'Messages sent by type and code.')
+        for (t, c), n in sorted(self.messages_sent.items()):
+            sample('messages_sent_total', n, type=coap.types[t], code=codeString(c))
+        family('duplicates_total', 'counter', 'Duplicate messages dropped.')
+        for t, n in sorted(self.duplicates.items()):
+            sample('duplicates_total', n, type=coap.types[t])
+        family('retransmissions_total', 'counter', 'Retransmitted CON messages.')
+        sample('retransmissions_total', self.retransmissions)
+        family('timeouts_total', 'counter', 'Timeouts by kind (exchange, request, blockwise).')
+        for kind in ('exchange', 'request', 'blockwise'):
+            sample('timeouts_total', self.timeouts.get(kind, 0), kind=kind)
+        family('rtt_seconds', 'histogram', 'Round-trip time of CON messages.')
+        for bound, n in self.rtt.cumulative():
+            sample('rtt_seconds_bucket', n, le='+Inf' if bound == float('inf') else formatValue(bound))
+        sample('rtt_seconds_sum', self.rtt.sum)
+        sample('rtt_seconds_count', self.rtt.count)
+        family('peer_srtt_seconds', 'gauge', 'Smoothed round-trip time per peer.')
+        for remote, stats in self.peers.items():
+            sample('peer_srtt_seconds', stats.srtt, peer='%s:%d' % (remote[0], remote[1]))
+        for name, value in self.gauges().items():
+            family(name, 'gauge', 'Current number of %s.' % name.replace('_', ' '))
+            sample(name, value)
+        return '\n'.join(lines) + '\n'
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def isBlockwiseTransfer(requester):
+    """Check if outgoing request (Requester, or Q-Block client
+       which is always a blockwise transfer) is transferred
+       blockwise."""
+    if isinstance(requester, coap.QBlockClient):
+        return True
+    if requester.consumer is not None and requester.stream_started:
+        return True
+    return requester.assembled_response is not None or requester.app_request.opt.block1 is not None
+
+
+class StatsResource(resource.CoAPResource):
+    """Resource exposing protocol metrics. Responds with Prometheus
+       text exposition if request Accept option is text/plain,
+       JSON otherwise."""
+
+    def __init__(self, metrics):
+        resource.CoAPResource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        if request.opt.accept == PROMETHEUS_CONTENT_FORMAT:
+            payload = self.metrics.prometheusText().encode('utf-8')
+            content_format = PROMETHEUS_CONTENT_FORMAT
+        else:
+            payload = json.dumps(self.metrics.snapshot(), sort_keys=True).encode('utf-8')
+            content_format = JSON_CONTENT_FORMAT
+        response = coap.Message(code=coap.CONTENT, payload=payload)
+        response.opt.content_format = content_format
+        return defer.succeed(response)
@@ -0,0 +1,196 @@
+"""
+Render latency profiling for txThings servers.
+
+RenderProfiler (passed to coap.Coap as profiler) measures resource tree
+traversal (Endpoint.getResourceFor) and rendering of every request, from
+the call of resource.render until the returned Deferred fires. Latency
+histograms, error and in-flight counts are kept per resource and method.
+Optionally a fraction of renders is run under cProfile, and profiles of
+renders slower than a threshold are kept for the report.
+"""
+import cProfile
+import collections
+import pstats
+import random
+import timeit
+
+from twisted.python import log
+
+import six
+
+import txthings.coap as coap
+import txthings.metrics as metrics
+
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Default upper bounds (in seconds) of render latency histogram buckets."""
+
+
+def resourcePath(resource, request):
+    """Profiling key: Uri-Path consumed while traversing to the resource.
+       Use it only for trees without dynamic children or route templates
+       - otherwise statistics are kept for every distinct path."""
+    return coap.uriPathAsString(request.prepath).decode('utf-8', 'replace')
+
+
+def resourceRoute(resource, request):
+    """Default profiling key: path of static (indexed) resources, class
+       of resources reached through route templates or getChild - so the
+       number of keys doesn't grow with parameter values."""
+    if resource.routing is not None:
+        path = min(path for index, path in resource.routing)
+        return coap.uriPathAsString(path).decode('utf-8', 'replace')
+    return resource.__class__.__name__
+
+
+def resourceClass(resource, request):
+    """Profiling key for trees with dynamic children: class of the resource."""
+    return resource.__class__.__name__
+
+
+class RenderStats(object):
+    """Statistics of a single (resource, method) pair."""
+
+    def __init__(self, buckets):
+        self.latency = metrics.Histogram(buckets)
+        self.traversal = metrics.Histogram(buckets)
+        self.errors = 0
+        self.slow = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_latency = 0.0
+
+
+class SlowRender(object):
+    """Render slower than the threshold, with optional profile output."""
+
+    def __init__(self, key, method, latency, profile):
+        self.key = key
+        self.method = method
+        self.latency = latency
+        self.profile = profile
+
+
+class RenderProfiler(object):
+    """Collect per-resource and per-method render latencies.
+
+       Parameters:
+       - key - function (resource, request) -> name under which
+         statistics are kept (default: resourceRoute)
+       - slow_threshold - renders taking longer (seconds) are counted
+         as slow and their profiles (if sampled) are kept
+       - profile_rate - fraction of renders run under cProfile; only
+         the synchronous part of render (until it returns a Deferred)
+         is profiled
+       - max_profiles - number of slow render profiles kept
+       - timer - function returning current time in seconds"""
+
+    def __init__(self, key=resourceRoute, slow_threshold=None, profile_rate=0.0, max_profiles=10,
+                 buckets=DEFAULT_LATENCY_BUCKETS, timer=timeit.default_timer):
+        self.key = key
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.buckets = buckets
+        self.timer = timer
+        self.stats = {}  # (key, method) -> RenderStats
+        self.slow_renders = collections.deque(maxlen=max_profiles)
+        self.random = random.Random()
+
+    def traverse(self, endpoint, request):
+        """Find resource for request, measuring traversal time."""
+        start = self.timer()
+        resource = endpoint.getResourceFor(request)
+        request.traversal_time = self.timer() - start
+        return resource
+
+    def render(self, resource, request):
+        """Render resource, measuring time until the result is ready.
+           Returns the result of resource.render."""
+        method = coap.requests.get(request.code, str(request.code))
+        key = self.key(resource, request)
+        stats = self.stats.get((key, method))
+        if stats is None:
+            stats = self.stats[(key, method)] = RenderStats(self.buckets)
+        stats.traversal.observe(getattr(request, 'traversal_time', 0.0))
+        stats.in_flight += 1
+        stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+        profile = None
+        if self.profile_rate and self.random.random() < self.profile_rate:
+            profile = cProfile.Profile()
+        start = self.timer()
+        try:
+            if profile is not None:
+                d = profile.runcall(resource.render, request)
+            else:
+                d = resource.render(request)
+        except Exception:
+            self.finished(stats, key, method, start, profile, failed=True)
+            raise
+        if hasattr(d, 'addBoth'):
+            d.addBoth(self.renderDone, stats, key, method, start, profile)
+            return d
+        return self.renderDone(d, stats, key, method, start, profile)
+
+    def renderDone(self, result, stats, key, method, start, profile):
+        # Result is passed on untouched - anything but a Message
+        # (Failure or invalid result) is counted as an error
+        failed = not isinstance(result, coap.Message) or result.code >= coap.INTERNAL_SERVER_ERROR
+        self.finished(stats, key, method, start, profile, failed)
+        return result
+
+    def finished(self, stats, key, method, start, profile, failed):
+        latency = self.timer() - start
+        stats.in_flight -= 1
+        stats.latency.observe(latency)
+        stats.max_latency = max(stats.max_latency, latency)
+        if failed:
+            stats.errors += 1
+        if self.slow_threshold is not None and latency > self.slow_threshold:
+            stats.slow += 1
+            log.msg("Slow render of %s %s: %.3f s" % (method, key, latency))
+            self.slow_renders.append(SlowRender(key, method, latency, formatProfile(profile)))
+
+    def asDict(self):
+        result = {}
+        for (key, method), stats in self.stats.items():
+            result.setdefault(key, {})[method] = {
+                'count': stats.latency.count,
+                'errors': stats.errors,
+                'slow': stats.slow,
+                'in_flight': stats.in_flight,
+                'max_in_flight': stats.max_in_flight,
+                'latency': stats.latency.asDict(),
+                'traversal': stats.traversal.asDict(),
+                'max_latency': stats.max_latency,
+            }
+        return result
+
+    def report(self):
+        """Return printable report, resources sorted by total render time."""
+        lines = ["%-40s %-6s %8s %6s %6s %10s %10s %10s %10s %10s" % (
+            "resource", "method", "count", "errors", "flight", "total [s]",
+            "mean [ms]", "p90 [ms]", "max [ms]", "walk [us]")]
+        for (key, method), stats in sorted(self.stats.items(), key=lambda item: -item[1].latency.sum):
+            count = stats.latency.count
+            p90 = stats.latency.quantile(0.9)
+            lines.append("%-40s %-6s %8d %6d %6d %10.3f %10.3f %10s %10.3f %10.1f" % (
+                key, method, count, stats.errors, stats.in_flight, stats.latency.sum,
+                1000.0 * stats.latency.sum / count if count else 0.0,
+                "<=%.3g" % (1000.0 * p90) if p90 is not None and p90 != float('inf') else ">max",
+                1000.0 * stats.max_latency,
+                1000000.0 * stats.traversal.sum / stats.traversal.count if stats.traversal.count else 0.0))
+        for slow in self.slow_renders:
+            lines.append("")
+            lines.append("Slow render: %s %s took %.3f s" % (slow.method, slow.key, slow.latency))
+            if slow.profile:
+                lines.append(slow.profile)
+        return "\n".join(lines)
+
+
+def formatProfile(profile, limit=15):
+    if profile is None:
+        return None
+    stream = six.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
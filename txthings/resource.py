@@ -6,18 +6,38 @@
 Implementation of the lowest-level Resource class.
 """
 
+import collections
 import copy
+import hashlib
+import mmap
+import os
+import struct
+import sys
 
 from zope.interface import implementer
 
 import txthings.error as error
 import txthings.coap as coap
 from itertools import chain
+from twisted.internet import defer
 from twisted.python import log
 from twisted.python.reflect import prefixedMethodNames
 from twisted.web.resource import IResource
 
 
+ETAG_CONTENT = 'content'
+"""ETag mode: ETag is a hash of rendered payload."""
+
+ETAG_VERSION = 'version'
+"""ETag mode: ETag is derived from resource version, which is
+   incremented by updatedState(), and from requested representation
+   (Uri-Host, Uri-Path, Uri-Query, Accept) - requests carrying current
+   ETag are answered with 2.03 Valid without rendering."""
+
+ETAG_SALT = os.urandom(4)
+"""Random prefix of version ETags (differs between server runs)."""
+
+
 def getChildForRequest(resource, request):
     """
     Traverse resource tree to find who will handle the request.
@@ -28,6 +48,146 @@ def getChildForRequest(resource, request):
         resource = resource.getChildWithDefault(pathElement, request)
     return resource
 
+
+def canonicalInt(segment):
+    """Convert path segment in canonical decimal form (ASCII digits,
+       no sign, whitespace, underscores or leading zeros) to int, so
+       every value is reached through exactly one Uri-Path."""
+    if not segment.isdigit() or (segment.startswith(b'0') and segment != b'0'):
+        raise ValueError("Not a canonical decimal integer")
+    return int(segment)
+
+
+ROUTE_CONVERTERS = {
+    'str': lambda segment: segment.decode('utf-8'),
+    'int': canonicalInt,
+    'bytes': lambda segment: segment,
+}
+"""Converters for typed parameters of route templates. Converter
+   raising ValueError means that the segment doesn't match."""
+
+
+class RouteTrie(object):
+    """
+    Segment trie compiled from route templates like
+    'dev/{id:int}/sensor/{name}'. Template segments are either literal,
+    or parameters in braces with optional type (key of ROUTE_CONVERTERS,
+    'str' by default).
+    """
+
+    def __init__(self):
+        self.literals = {}  # path segment -> RouteTrie
+        self.parameters = []  # (name, converter, RouteTrie)
+        self.handler = None
+
+    def add(self, template, handler):
+        node = self
+        for segment in template.strip('/').split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                name, _, kind = segment[1:-1].partition(':')
+                if kind not in ('',) + tuple(ROUTE_CONVERTERS):
+                    raise ValueError("Unknown route parameter type: %s" % kind)
+                converter = ROUTE_CONVERTERS[kind or 'str']
+                for parameter in node.parameters:
+                    if parameter[:2] == (name, converter):
+                        node = parameter[2]
+                        break
+                else:
+                    child = RouteTrie()
+                    node.parameters.append((name, converter, child))
+                    node = child
+            else:
+                node = node.literals.setdefault(segment.encode('utf-8'), RouteTrie())
+        node.handler = handler
+
+    def match(self, segments):
+        """
+        Find handler for the longest template matching beginning of
+        segments (literal segments take precedence over parameters).
+        Returns tuple (handler, parameters, number of matched
+        segments) or None. Parameters are tried in order in which
+        templates were added.
+        """
+        best = None
+        pending = [(self, 0, ())]
+        while pending:
+            node, depth, params = pending.pop()
+            if node.handler is not None and (best is None or depth > best[2]):
+                best = (node.handler, params, depth)
+            if depth < len(segments):
+                segment = segments[depth]
+                for name, converter, child in reversed(node.parameters):
+                    try:
+                        value = converter(segment)
+                    except ValueError:
+                        continue
+                    pending.append((child, depth + 1, params + ((name, value),)))
+                child = node.literals.get(segment)
+                if child is not None:
+                    pending.append((child, depth + 1, params))
+        if best is not None:
+            return best[0], dict(best[1]), best[2]
+
+
+def isTraversable(resource):
+    """
+    Check if static children of resource are reached by default
+    traversal (resource is not a leaf and doesn't override
+    getChildWithDefault), so they can be put in routing index.
+    """
+    return not resource.isLeaf and type(resource).getChildWithDefault == CoAPResource.getChildWithDefault
+
+
+class RoutingIndex(object):
+    """
+    Index of static resources of a resource tree, keyed by full Uri-Path
+    tuple, which lets Endpoint find a resource with a single dictionary
+    lookup. It is kept up to date by putChild and delEntity of indexed
+    resources (children added by modifying children dictionary directly
+    are not indexed). One tree may be indexed by several endpoints
+    (e.g. IPv4 and IPv6 server), every resource remembers all its
+    registrations. Requests for paths not found in the index are
+    resolved by traversing the tree segment by segment - this is how
+    dynamic (getChild) resources are reached.
+    """
+
+    def __init__(self):
+        self.routes = {}  # Uri-Path tuple -> resource
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, path):
+        return self.routes.get(path)
+
+    def register(self, path, resource):
+        """Add resource and its static subtree at given path."""
+        pending = [(path, resource)]
+        while pending:
+            path, resource = pending.pop()
+            self.routes[path] = resource
+            if resource.routing is None:
+                resource.routing = set()
+            resource.routing.add((self, path))
+            if isTraversable(resource):
+                for name, child in resource.children.items():
+                    pending.append((path + (name,), child))
+
+    def unregister(self, path):
+        """Remove resource at given path and its static subtree."""
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            resource = self.routes.pop(path, None)
+            if resource is None:
+                continue
+            if resource.routing is not None:
+                resource.routing.discard((self, path))
+                if not resource.routing:
+                    resource.routing = None
+            pending.extend(path + (name,) for name in resource.children)
+
+
 @implementer(IResource)
 class CoAPResource:
     """
@@ -46,10 +206,27 @@ class CoAPResource:
         self.params = {}
         self.visible = False
         self.observers = {} # (address, token) -> observation
+        # Random start, so a resource reloaded (e.g. by LazyContainer)
+        # doesn't issue ETags of versions served before it was dropped
+        self.version = struct.unpack('!I', os.urandom(4))[0]
 
     observable = False
     observe_index = 0
+    version = 0  # incremented by updatedState (used for ETAG_VERSION ETags), random start
+    etag_mode = None  # ETAG_CONTENT or ETAG_VERSION - add ETag to 2.05 responses (opt-in)
     isLeaf = 0
+    routing = None  # set of (RoutingIndex, Uri-Path tuple) registrations if resource is indexed
+    routes = None  # RouteTrie of route templates registered with putRoute
+    response_cache = None  # ResponseCache of rendered GET responses (opt-in)
+    # Concurrent identical GET requests share one pending render - the
+    # response of one client is given to all, so set it only for
+    # resources rendering the same for every peer, or set also
+    # single_flight_per_peer to share renders only between requests
+    # from the same peer.
+    single_flight = False
+    single_flight_per_peer = False
+    accepted_content_formats = None  # content formats of request payload accepted by resource (None - any)
+    max_body_size = None  # largest request payload accepted by resource (None - limited only by protocol)
 
     ### Abstract Collection Interface
 
@@ -82,9 +259,12 @@ class CoAPResource:
 
     def delEntity(self, name):
         del self.children[name]
+        if self.routing is not None:
+            for index, path in list(self.routing):
+                index.unregister(path + (name,))
 
     def reallyPutEntity(self, name, entity):
-        self.children[name] = entity
+        self.putChild(name, entity)
 
     # Concrete HTTP interface
 
@@ -127,8 +307,30 @@ class CoAPResource:
         """
         if path in self.children:
             return self.children[path]
+        if self.routes is not None:
+            match = self.routes.match([path] + list(request.postpath))
+            if match is not None:
+                handler, params, length = match
+                request.prepath.extend(request.postpath[:length - 1])
+                del request.postpath[:length - 1]
+                request.route_params = dict(request.route_params, **params)
+                return handler
         return self.getChild(path, request)
 
+    def putRoute(self, template, handler):
+        """
+        Register handler for all paths below this resource matching
+        route template, e.g. 'dev/{id:int}/sensor/{name}'. Parameter
+        values (converted to declared types) are available to the
+        handler as request.route_params dictionary. Static children
+        take precedence over templates, templates take precedence over
+        getChild.
+        """
+        if self.routes is None:
+            self.routes = RouteTrie()
+        self.routes.add(template, handler)
+        handler.server = self.server
+
     def putChild(self, path, child):
         """
         Register a static child.
@@ -137,6 +339,11 @@ class CoAPResource:
         intended to have the root of a folder, e.g. /foo/, you want
         path to be ''.
         """
+        if self.routing is not None:
+            for index, prefix in list(self.routing):
+                index.unregister(prefix + (path,))
+                if isTraversable(self):
+                    index.register(prefix + (path,), child)
         self.children[path] = child
         child.server = self.server
 
@@ -159,12 +366,47 @@ class CoAPResource:
         Old code that overrides render() directly is likewise expected
         to return a string or NOT_DONE_YET.
         """
+        self.checkRequest(request)
+        return getattr(self, 'render_' + coap.requests[request.code])(request)
+
+    def currentETag(self, request):
+        """Return ETag of current representation if it is known
+           without rendering (ETAG_VERSION mode), otherwise None."""
+        if self.etag_mode == ETAG_VERSION:
+            variant = repr(coap.representationKey(request)).encode('utf-8')
+            return coap.generateETag(ETAG_SALT + struct.pack('!I', self.version % (2**32)) + variant)
+        return None
+
+    def representationETag(self, response, request):
+        """Return ETag to be added to response rendered by this
+           resource for request (if etag_mode is set)."""
+        etag = self.currentETag(request)
+        if etag is None and isinstance(response.payload, bytes):
+            etag = coap.generateETag(response.payload)
+        return etag
+
+    def checkRequest(self, request):
+        """
+        Check if request can be rendered by this resource.
+
+        For blockwise requests it is called when the first block
+        arrives, so that the client gets error response before it
+        sends the whole body. Raises UnsupportedMethod, UnallowedMethod,
+        UnsupportedContentFormat (if accepted_content_formats is set
+        and request carries payload) or RequestEntityTooLarge (if
+        max_body_size is set).
+        """
         if request.code not in coap.requests:
             raise error.UnsupportedMethod()
-        m = getattr(self, 'render_' + coap.requests[request.code], None)
-        if not m:
+        if not getattr(self, 'render_' + coap.requests[request.code], None):
             raise error.UnallowedMethod()
-        return m(request)
+        has_body = request.body is not None or len(request.payload) > 0
+        if (self.accepted_content_formats is not None and has_body and
+                request.opt.content_format not in self.accepted_content_formats):
+            raise error.UnsupportedContentFormat()
+        if self.max_body_size is not None:
+            if request.bodySize() > self.max_body_size or (request.opt.size1 is not None and request.opt.size1 > self.max_body_size):
+                raise error.RequestEntityTooLarge(self.max_body_size)
 
     def addParam(self, param):
         self.params.setdefault(param.name, []).append(param)
@@ -204,11 +446,87 @@ class CoAPResource:
         #        2^32 times in 256 seconds (or document why we can be sure that
         #        that will not happen)
         self.observe_index = (self.observe_index + 1) % (2**24)
+        self.version += 1
+
+        if self.response_cache is not None:
+            self.response_cache.clear()
 
         for o in self.observers.values():
             o.trigger()
 
 
+RESPONSE_CACHE_SIZE = 256 * 1024
+"""Default number of bytes (payload and encoded options)
+   kept by ResponseCache."""
+
+
+class ResponseCache(object):
+    """
+    Cache of 2.05 Content responses rendered by a resource for GET
+    requests, keyed by Uri-Host, Uri-Path, Uri-Query and Accept.
+    Enable it by setting response_cache attribute of a resource:
+
+        resource.response_cache = ResponseCache()
+
+    Responses are kept for their Max-Age (coap.DEFAULT_MAX_AGE if not
+    set), until resource.updatedState() is called, or until evicted
+    (least recently used first) when total size exceeds max_size.
+    Options are encoded once, when response is stored. Requests with
+    Observe or Block2 option always reach the resource.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # key -> (response, size, expiry time)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now):
+        """Return copy of cached response (sharing encoded
+           options with the cached one) or None if there is no
+           fresh response for the key."""
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[2] <= now:
+            self.size -= entry[1]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        stored = entry[0]
+        response = coap.Message(code=stored.code, payload=stored.payload)
+        response.opt = stored.opt.copy()
+        return response
+
+    def put(self, key, response, now):
+        max_age = response.opt.max_age
+        if max_age is None:
+            max_age = coap.DEFAULT_MAX_AGE
+        if response.code != coap.CONTENT or max_age == 0 or not isinstance(response.payload, bytes):
+            return
+        stored = coap.Message(code=response.code, payload=response.payload)
+        stored.opt = response.opt.copy()
+        size = len(stored.payload) + len(stored.opt.encode())
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        if size > self.max_size:
+            return
+        while self.entries and self.size + size > self.max_size:
+            self.size -= self.entries.popitem(last=False)[1][1]
+        self.entries[key] = (stored, size, now + max_age)
+        self.size += size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
 class LinkParam(object):
     def __init__(self, name, value):
         self.name = name
@@ -220,8 +538,85 @@ class LinkParam(object):
     def encode(self):
         return '%s="%s"' % (self.name, self.value)
 
+class FileResource(CoAPResource):
+    """
+    Resource serving contents of a file.
+
+    File is memory-mapped, so blocks of large files (e.g. firmware
+    images) are sliced from the mapping when they are sent, without
+    reading the whole file into memory. File is mapped again when its
+    modification time or size changes - previous mapping is closed
+    as soon as no response (e.g. unfinished Block2 transfer) refers
+    to it.
+
+    ETag is derived from modification time and size of the file, or
+    from its contents if etag_from_content is set. Requests with
+    matching ETag get 2.03 Valid response without payload.
+    """
+    isLeaf = 1
+
+    def __init__(self, path, content_format=None, etag_from_content=False):
+        CoAPResource.__init__(self)
+        self.path = path
+        self.content_format = content_format
+        self.etag_from_content = etag_from_content
+        self.stat = None
+        self.data = b""
+        self.etag = None
+        self.retired = []  # replaced mappings, possibly still used by responses
+
+    def load(self):
+        """Map file if it is not mapped yet or was modified."""
+        st = os.stat(self.path)
+        stat = (st.st_mtime, st.st_size)
+        if stat != self.stat:
+            log.msg("Mapping file %s (%d bytes)" % (self.path, st.st_size))
+            if isinstance(self.data, mmap.mmap):
+                self.retired.append(self.data)
+            if st.st_size > 0:
+                with open(self.path, 'rb') as f:
+                    self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = b""
+            if self.etag_from_content:
+                self.etag = hashlib.sha1(self.data).digest()[:8]
+            else:
+                self.etag = hashlib.sha1(("%r:%d" % stat).encode('ascii')).digest()[:8]
+            self.stat = stat
+        if self.retired:
+            self.closeRetired()
+
+    def closeRetired(self):
+        """Close replaced mappings no longer referenced by responses."""
+        used = []
+        while self.retired:
+            mapping = self.retired.pop()
+            # Unused mapping is referred to only by local variable
+            # and getrefcount argument
+            if sys.getrefcount(mapping) > 2:
+                used.append(mapping)
+            else:
+                mapping.close()
+        self.retired = used
+
+    def render_GET(self, request):
+        try:
+            self.load()
+        except (OSError, IOError):
+            return defer.succeed(coap.Message(code=coap.NOT_FOUND, payload=b"Error: File not found!"))
+        if self.etag in request.opt.etags:
+            response = coap.Message(code=coap.VALID, payload=b"")
+        else:
+            response = coap.Message(code=coap.CONTENT, payload=self.data)
+            if self.content_format is not None:
+                response.opt.content_format = self.content_format
+        response.opt.etag = self.etag
+        response.opt.size2 = len(self.data)
+        return defer.succeed(response)
+
+
 __all__ = [
-    'IResource', 'getChildForRequest', 'Resource', 'LinkParam']
+    'IResource', 'getChildForRequest', 'Resource', 'LinkParam', 'FileResource', 'RoutingIndex', 'RouteTrie', 'ResponseCache']
 
 
 class Endpoint():
@@ -233,6 +628,9 @@ class Endpoint():
         Initialize endpoint.
         """
         self.resource = root_resource
+        self.routes = RoutingIndex()
+        if root_resource is not None:
+            self.routes.register((), root_resource)
 
     def render(self, request):
         """
@@ -253,14 +651,22 @@ class Endpoint():
         """
         Get a resource for a request.
 
-        This iterates through the resource heirarchy, calling
+        Static resources are found in routing index. Otherwise this
+        iterates through the resource heirarchy, calling
         getChildWithDefault on each resource it finds for a path element,
         stopping when it hits an element where isLeaf is true.
         """
         #request.en = self
         # Sitepath is used to determine cookie names between distributed
         # servers and disconnected sites.
-        request.sitepath = copy.copy(request.prepath)
+        request.sitepath = request.prepath
+        path = tuple(request.postpath)
+        resource = self.routes.get(path)
+        if resource is not None:
+            request.prepath = request.prepath + list(path)
+            request.postpath = []
+            return resource
+        request.prepath = copy.copy(request.prepath)
         return getChildForRequest(self.resource, request)
 
 
@@ -0,0 +1,204 @@
+"""
+Lazily loaded resources backed by SQLite.
+
+LazyContainer is a resource whose children are not kept in memory:
+they are loaded from a SQLiteStore when a request traverses to them,
+and at most max_live of them are kept alive (least recently used are
+evicted). Resources with active observers are never evicted. Changed
+resources (StoredResource.markDirty) are written back in batches,
+flush_interval seconds after the first change, and kept alive until
+they are written. Endpoint.getResourceFor finds children of the
+container through the ordinary getChild traversal.
+
+SQLite is accessed synchronously - the store is meant to be a local
+file, and batching keeps the number of transactions low.
+"""
+import collections
+import sqlite3
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+import six
+
+import txthings.coap as coap
+import txthings.error as error
+import txthings.resource as resource
+
+MAX_LIVE = 10000
+"""Default number of stored resources kept in memory by LazyContainer."""
+
+FLUSH_INTERVAL = 5.0
+"""Default time (in seconds) after which changed resources are written back."""
+
+BATCH_SIZE = 500
+"""Default number of resources written in one transaction."""
+
+
+class SQLiteStore(object):
+    """Table of resource states (byte strings) identified by name."""
+
+    def __init__(self, path=':memory:', table='resources'):
+        self.connection = sqlite3.connect(path)
+        self.table = table
+        self.connection.execute('CREATE TABLE IF NOT EXISTS %s (name BLOB PRIMARY KEY, state BLOB NOT NULL)' % table)
+        self.connection.commit()
+        self.transactions = 0
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def load(self, name):
+        """Return state of resource, or None if there is no such resource."""
+        row = self.connection.execute('SELECT state FROM %s WHERE name = ?' % self.table,
+                                      (sqlite3.Binary(name),)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def save(self, items):
+        """Write (name, state) pairs in one transaction."""
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO %s (name, state) VALUES (?, ?)' % self.table,
+                                        [(sqlite3.Binary(name), sqlite3.Binary(state)) for name, state in items])
+        self.transactions += 1
+
+    def delete(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM %s WHERE name = ?' % self.table, (sqlite3.Binary(name),))
+        self.transactions += 1
+
+    def close(self):
+        self.connection.close()
+
+
+class StoredResource(resource.CoAPResource):
+    """Base class for children of LazyContainer. State is a byte
+       string: subclasses may override loadState and dumpState to
+       keep it in other form. Call markDirty after state changes.
+
+       Default implementation serves state with GET and replaces
+       it with PUT."""
+
+    def __init__(self, state=b""):
+        resource.CoAPResource.__init__(self)
+        self.container = None
+        self.name = None
+        self.loadState(state)
+
+    def loadState(self, state):
+        self.state = state
+
+    def dumpState(self):
+        return self.state
+
+    def markDirty(self):
+        if self.container is not None:
+            self.container.markDirty(self)
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=self.state))
+
+    def render_PUT(self, request):
+        self.loadState(request.payload)
+        self.markDirty()
+        self.updatedState()
+        return defer.succeed(coap.Message(code=coap.CHANGED))
+
+
+class LazyContainer(resource.CoAPResource):
+    """Resource with children loaded on demand from a SQLiteStore.
+
+       Factory is called as factory(state) to create child resource
+       from its stored state (StoredResource subclass by default)."""
+
+    def __init__(self, store, factory=StoredResource, max_live=MAX_LIVE, flush_interval=FLUSH_INTERVAL,
+                 batch_size=BATCH_SIZE, clock=None):
+        resource.CoAPResource.__init__(self)
+        self.store = store
+        self.factory = factory
+        self.max_live = max_live
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.clock = clock if clock is not None else reactor
+        self.live = collections.OrderedDict()  # name -> resource (least recently used first)
+        self.dirty = collections.OrderedDict()  # name -> resource waiting to be written
+        self.flush_timer = None
+        self.loads = 0
+        self.evictions = 0
+
+    def getChild(self, name, request):
+        child = self.live.pop(name, None)
+        if child is None:
+            state = self.store.load(name)
+            if state is None:
+                raise error.NoResource()
+            child = self.attach(name, self.factory(state))
+            self.loads += 1
+        self.live[name] = child
+        self.evict(name)
+        return child
+
+    def attach(self, name, child):
+        child.container = self
+        child.name = name
+        child.server = self.server
+        return child
+
+    def putStored(self, name, child):
+        """Add new resource (or replace existing one) - it is
+           written to the store with the next batch."""
+        self.live.pop(name, None)
+        self.live[name] = self.attach(name, child)
+        self.markDirty(child)
+        self.evict(name)
+
+    def delStored(self, name):
+        """Remove resource from memory and from the store."""
+        self.live.pop(name, None)
+        self.dirty.pop(name, None)
+        self.store.delete(name)
+
+    def markDirty(self, child):
+        if self.live.get(child.name) is not child:
+            # changed after eviction - it is the current version again
+            self.live.pop(child.name, None)
+            self.live[child.name] = child
+        self.dirty[child.name] = child
+        if self.flush_timer is None:
+            self.flush_timer = self.clock.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Write changed resources to the store, batch_size
+           resources per transaction."""
+        if self.flush_timer is not None and self.flush_timer.active():
+            self.flush_timer.cancel()
+        self.flush_timer = None
+        if not self.dirty:
+            return
+        log.msg("Writing %d changed resources to the store." % len(self.dirty))
+        items = [(name, child.dumpState()) for name, child in six.iteritems(self.dirty)]
+        self.dirty.clear()
+        for start in range(0, len(items), self.batch_size):
+            self.store.save(items[start:start + self.batch_size])
+        self.evict()
+
+    def evict(self, keep=None):
+        """Drop least recently used resources over max_live, except
+           the one named keep and those observed or waiting to be
+           written (these are moved to the end of the queue)."""
+        excess = len(self.live) - self.max_live
+        if excess <= 0:
+            return
+        victims = []
+        pinned = []
+        for name, child in six.iteritems(self.live):
+            if len(victims) >= excess:
+                break
+            if child.observers or name in self.dirty or name == keep:
+                pinned.append(name)
+            else:
+                victims.append(name)
+        for name in pinned:
+            self.live[name] = self.live.pop(name)
+        for name in victims:
+            del self.live[name]
+        self.evictions += len(victims)
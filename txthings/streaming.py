@@ -0,0 +1,223 @@
+"""
+Streaming of blockwise request and response payloads.
+
+Consumers passed to coap.Coap.request (as block2Consumer) receive
+Block2 response payload block by block, instead of having the whole
+payload assembled in memory. Consumer methods:
+
+- responseStarted(response) - first response block arrived (its options,
+  including Size2 if server sent it, are available)
+- dataReceived(data) - next chunk of payload; returning a Deferred
+  delays request for the next block until it fires (backpressure)
+- responseFinished(response) - last block arrived
+- responseFailed(reason) - transfer failed (reason is a Failure)
+
+Producers passed to coap.Coap.request (as block1Producer) supply Block1
+request payload, reading each block only when it is about to be sent.
+Producer method readBlock(offset, size) returns tuple (data, more), and
+attribute size holds total payload size (None if unknown).
+"""
+import collections
+import mmap
+import os
+
+from twisted.internet import defer
+
+
+class BlockConsumer(object):
+    """Base class for response payload consumers. Keeps total
+       size (from Size2 option, None if unknown) and number
+       of received bytes."""
+
+    def __init__(self):
+        self.size = None
+        self.received = 0
+
+    def responseStarted(self, response):
+        self.size = response.opt.size2
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def responseFinished(self, response):
+        pass
+
+    def responseFailed(self, reason):
+        pass
+
+
+class CallbackConsumer(BlockConsumer):
+    """Pass every chunk of payload to a callback. Callback
+       may return a Deferred to delay the transfer."""
+
+    def __init__(self, callback, *args, **kw):
+        BlockConsumer.__init__(self)
+        self.callback = callback
+        self.args = args
+        self.kw = kw
+
+    def dataReceived(self, data):
+        BlockConsumer.dataReceived(self, data)
+        return self.callback(data, *self.args, **self.kw)
+
+
+class FileConsumer(BlockConsumer):
+    """Write payload to a file-like object. If preallocate is set and
+       server sent Size2 option, file is extended to the full size
+       before first write."""
+
+    def __init__(self, fileobj, preallocate=False):
+        BlockConsumer.__init__(self)
+        self.fileobj = fileobj
+        self.preallocate = preallocate
+
+    def responseStarted(self, response):
+        BlockConsumer.responseStarted(self, response)
+        if self.preallocate and self.size:
+            position = self.fileobj.tell()
+            self.fileobj.truncate(position + self.size)
+            self.fileobj.seek(position)
+
+    def dataReceived(self, data):
+        BlockConsumer.dataReceived(self, data)
+        self.fileobj.write(data)
+
+    def responseFinished(self, response):
+        self.fileobj.flush()
+
+
+class BlockIterator(BlockConsumer):
+    """Queue of payload chunks read by application with nextChunk()
+       (returns a Deferred firing with next chunk, or None after
+       the last one). In Python 3 it can be used with 'async for'
+       inside coroutines driven by Deferreds (defer.ensureDeferred).
+
+       When more than max_chunks are queued, the transfer is paused
+       until application reads some of them."""
+
+    def __init__(self, max_chunks=4):
+        BlockConsumer.__init__(self)
+        self.max_chunks = max_chunks
+        self.chunks = collections.deque()
+        self.readers = collections.deque()
+        self.paused = None
+        self.finished = False
+        self.failure = None
+
+    def dataReceived(self, data):
+        BlockConsumer.dataReceived(self, data)
+        if self.readers:
+            self.readers.popleft().callback(data)
+            return None
+        self.chunks.append(data)
+        if len(self.chunks) >= self.max_chunks:
+            self.paused = defer.Deferred()
+            return self.paused
+
+    def responseFinished(self, response):
+        self.finished = True
+        while self.readers:
+            self.readers.popleft().callback(None)
+
+    def responseFailed(self, reason):
+        self.failure = reason
+        while self.readers:
+            self.readers.popleft().errback(reason)
+
+    def nextChunk(self):
+        if self.chunks:
+            data = self.chunks.popleft()
+            if self.paused is not None and len(self.chunks) < self.max_chunks:
+                paused, self.paused = self.paused, None
+                paused.callback(None)
+            return defer.succeed(data)
+        if self.failure is not None:
+            return defer.fail(self.failure)
+        if self.finished:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.readers.append(d)
+        return d
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.nextChunk().addCallback(self._stopAtEnd)
+
+    def _stopAtEnd(self, data):
+        if data is None:
+            raise StopAsyncIteration
+        return data
+
+
+class BufferProducer(object):
+    """Read payload blocks from bytes, memoryview or mmap object."""
+
+    def __init__(self, buf, size=None):
+        self.buf = buf
+        self.size = size if size is not None else len(buf)
+
+    def readBlock(self, offset, size):
+        end = min(offset + size, self.size)
+        return self.buf[offset:end], end < self.size
+
+
+class FileProducer(object):
+    """Read payload blocks from a seekable file-like object,
+       starting at its current position."""
+
+    def __init__(self, fileobj, size=None):
+        self.fileobj = fileobj
+        self.start = fileobj.tell()
+        if size is None:
+            try:
+                size = os.fstat(fileobj.fileno()).st_size - self.start
+            except (AttributeError, OSError, IOError, ValueError):
+                fileobj.seek(0, os.SEEK_END)
+                size = fileobj.tell() - self.start
+                fileobj.seek(self.start)
+        self.size = size
+
+    def readBlock(self, offset, size):
+        size = max(0, min(size, self.size - offset))
+        self.fileobj.seek(self.start + offset)
+        data = self.fileobj.read(size)
+        return data, offset + len(data) < self.size
+
+
+class IteratorProducer(object):
+    """Read payload blocks from an iterator of byte strings (chunks
+       of any length). Blocks must be read sequentially; only data
+       needed for the next block is buffered."""
+
+    def __init__(self, iterable, size=None):
+        self.iterator = iter(iterable)
+        self.size = size
+        self.buffer = b""
+        self.position = 0
+        self.exhausted = False
+
+    def readBlock(self, offset, size):
+        if offset != self.position:
+            raise ValueError("IteratorProducer supports only sequential reads")
+        while not self.exhausted and len(self.buffer) <= size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                self.exhausted = True
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data, len(self.buffer) > 0
+
+
+def producerFor(source, size=None):
+    """Return producer for given payload source: producer object,
+       file-like object, buffer (bytes, memoryview, mmap) or iterator."""
+    if hasattr(source, 'readBlock'):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return BufferProducer(source, size)
+    if hasattr(source, 'read'):
+        return FileProducer(source, size)
+    return IteratorProducer(source, size)
@@ -0,0 +1,86 @@
+"""
+Shared fixture for protocol tests: client and server connected
+with in-memory impairment links, driven by task.Clock.
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from txthings import coap
+from txthings import impairment
+from txthings import resource
+
+from ipaddress import ip_address
+
+SERVER_ADDRESS = (u"192.168.37.137", 5683)
+CLIENT_ADDRESS = (u"192.168.37.2", 61616)
+
+PAYLOAD = b"".join(b"%07d " % i for i in range(1024))  # 8 KB
+
+
+class BlobResource(resource.CoAPResource):
+
+    def __init__(self, payload=PAYLOAD):
+        resource.CoAPResource.__init__(self)
+        self.payload = payload
+        self.received = []
+        self.sizes = []
+        self.renders = 0
+
+    def render_GET(self, request):
+        self.renders += 1
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=self.payload))
+
+    def render_PUT(self, request):
+        self.received.append(request.payload)
+        self.sizes.append(request.opt.size1)
+        return defer.succeed(coap.Message(code=coap.CHANGED))
+
+
+class ProtocolTestCase(unittest.TestCase):
+    """Client and server protocols connected with in-memory links
+       (server has BlobResource at /blob). Subclasses may override
+       serverOptions and clientOptions (keyword arguments of Coap),
+       linkProfile (impairment profile of both links) and makeServer
+       (protocol serving given root resource)."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.blob = BlobResource()
+        root = resource.CoAPResource()
+        root.putChild(b'blob', self.blob)
+        self.server = self.makeServer(root)
+        self.client = coap.Coap(resource.Endpoint(None), clock=self.clock, **self.clientOptions())
+        self.client_link, self.server_link = impairment.connect(
+            self.clock, self.client, CLIENT_ADDRESS, self.server, SERVER_ADDRESS, **self.linkProfile())
+        self.remote = (ip_address(SERVER_ADDRESS[0]), SERVER_ADDRESS[1])
+
+    def makeServer(self, root):
+        return coap.Coap(resource.Endpoint(root), clock=self.clock, **self.serverOptions())
+
+    def serverOptions(self):
+        return {}
+
+    def clientOptions(self):
+        return {}
+
+    def linkProfile(self):
+        return {'delay': 0.01}
+
+    def makeRequest(self, code=coap.GET, payload=b"", path=(b'blob',)):
+        request = coap.Message(code=code, payload=payload)
+        request.opt.uri_path = path
+        request.remote = self.remote
+        return request
+
+    def tempPath(self, name='file'):
+        """Return path in a temporary directory removed after the test
+           (unlike mktemp, nothing is created in working directory)."""
+        directory = tempfile.mkdtemp(prefix='txthings-test-')
+        self.addCleanup(shutil.rmtree, directory, True)
+        return os.path.join(directory, name)
+
+    def transfer(self, d, limit=60):
+        return impairment.runUntilFired(self.clock, d, limit=limit)[0]
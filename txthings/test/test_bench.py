@@ -0,0 +1,65 @@
+"""
+Tests for coap-bench load generator.
+"""
+from twisted.trial import unittest
+from txthings import bench
+from txthings import coap
+from txthings import impairment
+from txthings import metrics
+
+from txthings.test.support import ProtocolTestCase
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = bench.LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+        self.assertEqual(histogram.total, 1000)
+        self.assertTrue(abs(histogram.percentile(0.5) - 0.5) <= 0.5 / 64)
+        self.assertTrue(abs(histogram.percentile(0.99) - 0.99) <= 0.99 / 64)
+        self.assertEqual(histogram.percentile(1.0), 1.0)
+        self.assertAlmostEqual(histogram.mean(), 0.5005, places=4)
+        self.assertEqual(sum(n for bound, n in histogram.buckets()), 1000)
+
+    def test_empty(self):
+        histogram = bench.LatencyHistogram()
+        self.assertEqual(histogram.percentile(0.5), None)
+        self.assertEqual(histogram.buckets(), [])
+
+
+class TestBenchClient(ProtocolTestCase):
+
+    def clientOptions(self):
+        return {'metrics': metrics.CoapMetrics()}
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        root = self.server.endpoint.resource
+        root.putChild(b'bench', bench.BenchResource(10))
+        self.tick = bench.TickResource()
+        root.putChild(b'tick', self.tick)
+
+    def test_closedLoop(self):
+        client = bench.BenchClient(self.client, self.remote, (b'bench',),
+                                   concurrency=4, requests=40, observers=2, observe_path=(b'tick',))
+        d = client.start()
+        self.clock.advance(0.1)
+        self.tick.tick()
+        outcome = impairment.runUntilFired(self.clock, d, limit=10)
+        self.assertEqual(outcome, [client])
+        self.assertEqual(client.completed, 40)
+        self.assertEqual(client.codes, {coap.CONTENT: 40})
+        self.assertEqual(client.histogram.total, 40)
+        self.assertEqual(client.notifications, 2)
+        self.assertIn("p999", client.report())
+        self.assertIn("Retransmissions: 0", client.report())
+
+    def test_rate(self):
+        client = bench.BenchClient(self.client, self.remote, (b'bench',), method=coap.PUT,
+                                   payload_size=5, rate=10, duration=2.0, concurrency=1)
+        outcome = impairment.runUntilFired(self.clock, client.start(), limit=10)
+        self.assertEqual(outcome, [client])
+        self.assertEqual(client.codes, {coap.CHANGED: client.completed})
+        self.assertTrue(18 <= client.completed <= 21)
@@ -0,0 +1,575 @@
+"""
+Tests for blockwise transfers (RFC 7959).
+"""
+import io
+import mmap
+import tempfile
+import timeit
+
+from twisted.internet import defer
+from txthings import coap
+from txthings import error
+from txthings import impairment
+from txthings import resource
+from txthings import streaming
+
+from ipaddress import ip_address
+
+from txthings.test.support import CLIENT_ADDRESS, PAYLOAD, BlobResource, ProtocolTestCase
+
+
+class TestBlockSize(ProtocolTestCase):
+
+    def test_default(self):
+        response = self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 64)
+
+    def test_perRequest(self):
+        response = self.transfer(self.client.request(self.makeRequest(), blockSizeExp=6))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 1024)
+
+    def test_perPeer(self):
+        self.client.setPathMTU(self.remote, 1280)
+        self.assertEqual(self.client.blockSizeExponent(self.remote), 6)
+        self.client.setPathMTU(self.remote, 576)
+        self.assertEqual(self.client.blockSizeExponent(self.remote), 4)
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD))
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD])
+        self.assertEqual(self.client_link.stats.packets_sent, len(PAYLOAD) // 256)
+
+    def test_serverLimit(self):
+        self.server.max_block_size_exp = 3
+        response = self.transfer(self.client.request(self.makeRequest(), blockSizeExp=6))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 128)
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD), blockSizeExp=6)
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD])
+
+    def test_clientShrinks(self):
+        self.server.block_size_exp = 6
+        response = self.transfer(self.client.request(self.makeRequest(), blockSizeExp=4))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 256)
+
+
+class TestServerBlockSize(ProtocolTestCase):
+
+    def serverOptions(self):
+        return {'block_size_exp': 5}
+
+    def test_serverDefault(self):
+        response = self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 512)
+
+
+class TestStreamingDownload(ProtocolTestCase):
+
+    def test_callback(self):
+        chunks = []
+        consumer = streaming.CallbackConsumer(chunks.append)
+        response = self.transfer(self.client.request(self.makeRequest(), block2Consumer=consumer))
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, b"")
+        self.assertEqual(consumer.size, len(PAYLOAD))
+        self.assertEqual(len(chunks), len(PAYLOAD) // 64)
+        self.assertEqual(b"".join(chunks), PAYLOAD)
+
+    def test_file(self):
+        sink = io.BytesIO()
+        consumer = streaming.FileConsumer(sink, preallocate=True)
+        self.transfer(self.client.request(self.makeRequest(), block2Consumer=consumer, blockSizeExp=6))
+        self.assertEqual(sink.getvalue(), PAYLOAD)
+
+    def test_backpressure(self):
+        consumer = streaming.BlockIterator(max_chunks=2)
+        d = self.client.request(self.makeRequest(), block2Consumer=consumer)
+        self.clock.pump([0.01] * 100)
+        self.assertNoResult(d)
+        self.assertEqual(self.server_link.stats.packets_sent, 2)
+        chunks = []
+
+        def read(data):
+            if data is not None:
+                chunks.append(data)
+                return consumer.nextChunk().addCallback(read)
+
+        done = consumer.nextChunk().addCallback(read)
+        impairment.runUntilFired(self.clock, done, limit=60)
+        self.assertEqual(b"".join(chunks), PAYLOAD)
+        self.assertEqual(self.successResultOf(d).code, coap.CONTENT)
+
+    def test_failure(self):
+        consumer = streaming.BlockIterator()
+        d = self.client.request(self.makeRequest(), block2Consumer=consumer)
+        self.clock.advance(0.015)
+        self.client_link.loss = 1.0
+        outcome = impairment.runUntilFired(self.clock, d, limit=coap.REQUEST_TIMEOUT + 10)
+        outcome[0].trap(error.RequestTimedOut)
+        self.assertEqual(self.successResultOf(consumer.nextChunk()), PAYLOAD[:64])
+        self.failureResultOf(consumer.nextChunk(), error.RequestTimedOut)
+
+
+class TestStreamingUpload(ProtocolTestCase):
+
+    def upload(self, source, **kw):
+        d = self.client.request(self.makeRequest(coap.PUT), block1Producer=source, **kw)
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD])
+
+    def test_file(self):
+        self.upload(io.BytesIO(PAYLOAD), blockSizeExp=6)
+        self.assertEqual(self.blob.sizes, [len(PAYLOAD)])
+        self.assertEqual(self.client_link.stats.packets_sent, len(PAYLOAD) // 1024)
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(PAYLOAD)
+            f.flush()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.upload(mapped)
+            mapped.close()
+        self.assertEqual(self.blob.sizes, [len(PAYLOAD)])
+
+    def test_iterator(self):
+        chunks = (PAYLOAD[i:i + 1000] for i in range(0, len(PAYLOAD), 1000))
+        self.server.max_block_size_exp = 4
+        self.upload(chunks, blockSizeExp=6, size1=len(PAYLOAD))
+        self.assertEqual(self.blob.sizes, [len(PAYLOAD)])
+
+    def test_iteratorOddSize(self):
+        payload = PAYLOAD[:1000]
+        d = self.client.request(self.makeRequest(coap.PUT), block1Producer=iter([payload[:300], payload[300:]]), blockSizeExp=2)
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [payload])
+
+    def test_singleBlock(self):
+        d = self.client.request(self.makeRequest(coap.PUT), block1Producer=iter([b"short", b" body"]))
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [b"short body"])
+        self.assertEqual(self.client_link.stats.packets_sent, 1)
+
+
+class TestParallelDownload(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.client_link.delay = self.server_link.delay = impairment.constantDelay(0.1)
+
+    def test_window(self):
+        start = self.clock.seconds()
+        response = self.transfer(self.client.request(self.makeRequest(), block2Window=8))
+        self.assertEqual(response.payload, PAYLOAD)
+        parallel = self.clock.seconds() - start
+        start = self.clock.seconds()
+        response = self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(response.payload, PAYLOAD)
+        sequential = self.clock.seconds() - start
+        self.assertTrue(parallel * 4 < sequential)
+
+    def test_reorderedStream(self):
+        self.client_link.reorder = self.server_link.reorder = 0.3
+        chunks = []
+        consumer = streaming.CallbackConsumer(chunks.append)
+        d = self.client.request(self.makeRequest(), block2Window=4, block2Consumer=consumer)
+        response = self.transfer(d)
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(b"".join(chunks), PAYLOAD)
+
+    def test_resourceChanged(self):
+        blob = self.blob
+
+        class ChangingResource(BlobResource):
+
+            def render_GET(self, request):
+                response = coap.Message(code=coap.CONTENT, payload=blob.payload)
+                response.opt.etag = b'v%d' % (len(blob.received),)
+                blob.received.append(None)
+                return defer.succeed(response)
+
+        self.server.endpoint.resource.putChild(b'blob', ChangingResource())
+        self.server.max_block_size_exp = 2
+        d = self.client.request(self.makeRequest(), block2Window=4)
+        self.clock.advance(0.25)
+        # server forgets ongoing transfer, further blocks are rendered again
+        self.server.incoming_requests.clear()
+        outcome = impairment.runUntilFired(self.clock, d, limit=60)
+        outcome[0].trap(error.ResourceChanged)
+        self.assertEqual(self.client.outgoing_requests, {})
+
+    def test_cancel(self):
+        d = self.client.request(self.makeRequest(), block2Window=4)
+        self.clock.pump([0.05] * 6)
+        self.assertEqual(len(self.client.outgoing_requests), 4)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.client.outgoing_requests, {})
+        self.assertEqual(self.client.active_exchanges, {})
+        packets = self.client_link.stats.packets_sent
+        self.clock.pump([1.0] * 100)
+        self.assertEqual(self.client_link.stats.packets_sent, packets)
+
+
+class TestResumableDownload(ProtocolTestCase):
+
+    def test_etag(self):
+        response = self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(response.opt.etag, coap.generateETag(PAYLOAD))
+
+    def test_singleBlock(self):
+        request = self.makeRequest()
+        request.opt.block2 = (5, False, 4)
+        response = self.transfer(self.client.request(request))
+        self.assertEqual(response.payload, PAYLOAD[1280:1536])
+        self.assertEqual(response.opt.block2.more, True)
+        self.assertEqual(response.opt.etag, coap.generateETag(PAYLOAD))
+
+    def test_resume(self):
+        chunks = []
+        consumer = streaming.CallbackConsumer(chunks.append)
+        d = self.client.request(self.makeRequest(), block2Consumer=consumer,
+                                resumeOffset=1024, resumeETag=coap.generateETag(PAYLOAD))
+        self.assertEqual(self.transfer(d).code, coap.CONTENT)
+        self.assertEqual(b"".join(chunks), PAYLOAD[1024:])
+        self.assertEqual(self.server_link.stats.packets_sent, (len(PAYLOAD) - 1024) // 64)
+
+    def test_resumeChanged(self):
+        consumer = streaming.BlockIterator()
+        d = self.client.request(self.makeRequest(), block2Consumer=consumer,
+                                resumeOffset=1024, resumeETag=b'stale')
+        impairment.runUntilFired(self.clock, d, limit=60)[0].trap(error.ResourceChanged)
+        self.failureResultOf(consumer.nextChunk(), error.ResourceChanged)
+
+    def test_resumeWithoutConsumer(self):
+        self.assertRaises(ValueError, self.client.request, self.makeRequest(), resumeOffset=1024)
+
+
+class TestRepresentationCache(ProtocolTestCase):
+
+    def serverOptions(self):
+        self.cache = coap.RepresentationCache(max_size=3 * len(PAYLOAD))
+        return {'representation_cache': self.cache}
+
+    def test_sharedBlocks(self):
+        d = self.client.request(self.makeRequest())
+        self.clock.pump([0.01] * 10)
+        self.assertEqual(len(self.server.incoming_requests), 0)
+        self.assertEqual(self.transfer(d).payload, PAYLOAD)
+        self.assertEqual(self.blob.renders, 1)
+        request = self.makeRequest()
+        request.opt.block2 = (3, False, 6)
+        response = self.transfer(self.client.request(request))
+        self.assertEqual(response.payload, PAYLOAD[3072:4096])
+        self.assertEqual(response.opt.etag, coap.generateETag(PAYLOAD))
+        self.assertEqual(self.blob.renders, 1)
+        self.assertEqual(self.cache.size, len(PAYLOAD))
+
+    def test_eviction(self):
+        self.server.endpoint.resource.putChild(b'other', BlobResource(PAYLOAD[::-1] * 3))
+        self.transfer(self.client.request(self.makeRequest()))
+        request = self.makeRequest()
+        request.opt.uri_path = (b'other',)
+        self.transfer(self.client.request(request, blockSizeExp=6))
+        self.assertEqual(list(self.cache.entries), [(None, b'/other', (), None)])
+        self.assertEqual(self.cache.size, 3 * len(PAYLOAD))
+        self.assertEqual(self.transfer(self.client.request(self.makeRequest())).payload, PAYLOAD)
+        self.assertEqual(list(self.cache.entries), [(None, b'/blob', (), None)])
+
+    def test_expiry(self):
+        self.transfer(self.client.request(self.makeRequest()))
+        self.clock.advance(coap.MAX_TRANSMIT_WAIT)
+        request = self.makeRequest()
+        request.opt.block2 = (1, False, 2)
+        self.assertEqual(self.transfer(self.client.request(request)).payload, PAYLOAD[64:128])
+        self.assertEqual(self.blob.renders, 2)
+
+
+class TestFileResource(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.path = self.tempPath()
+        with open(self.path, 'wb') as f:
+            f.write(PAYLOAD)
+        self.server.endpoint.resource.putChild(b'blob', resource.FileResource(self.path))
+
+    def test_download(self):
+        response = self.transfer(self.client.request(self.makeRequest(), blockSizeExp=6))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(response.opt.size2, len(PAYLOAD))
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 1024)
+
+    def test_validation(self):
+        etag = self.transfer(self.client.request(self.makeRequest())).opt.etag
+        request = self.makeRequest()
+        request.opt.etags = [b'other', etag]
+        response = self.transfer(self.client.request(request))
+        self.assertEqual(response.code, coap.VALID)
+        self.assertFalse(response.payload)
+        self.assertEqual(response.opt.etag, etag)
+
+    def test_modified(self):
+        etag = self.transfer(self.client.request(self.makeRequest())).opt.etag
+        with open(self.path, 'ab') as f:
+            f.write(b"appended")
+        request = self.makeRequest()
+        request.opt.etags = [etag]
+        response = self.transfer(self.client.request(request))
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD + b"appended")
+        self.assertNotEqual(response.opt.etag, etag)
+
+    def test_remapped(self):
+        served = self.server.endpoint.resource.children[b'blob']
+        served.load()
+        first = served.data
+        with open(self.path, 'ab') as f:
+            f.write(b"appended")
+        served.load()
+        # Mapping still referenced (like by unfinished transfer) stays open
+        self.assertEqual(served.retired, [first])
+        self.assertEqual(first[:8], PAYLOAD[:8])
+        del first
+        served.load()
+        self.assertEqual(served.retired, [])
+
+    def test_small(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"tiny")
+        response = self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(response.payload, b"tiny")
+        self.assertEqual(self.server_link.stats.packets_sent, 1)
+
+
+class TestSessionTable(ProtocolTestCase):
+
+    def serverOptions(self):
+        self.sessions = coap.SessionTable(max_sessions=4, max_peer_sessions=2,
+                                          max_peer_buffer=4096, max_body_size=len(PAYLOAD))
+        return {'session_table': self.sessions}
+
+    def startUpload(self, name):
+        self.server.endpoint.resource.putChild(name, BlobResource())
+        request = self.makeRequest(coap.PUT, PAYLOAD)
+        request.opt.uri_path = (name,)
+        d = self.client.request(request)
+        self.clock.pump([0.01] * 6)
+        return d
+
+    def test_peerLimit(self):
+        first = self.startUpload(b'a')
+        second = self.startUpload(b'b')
+        self.assertEqual(len(self.sessions), 2)
+        third = self.startUpload(b'c')
+        self.assertEqual([key[0] for key in self.sessions], [b'/b', b'/c'])
+        self.assertEqual(self.sessions.evictions, 1)
+        self.assertEqual(self.transfer(third).code, coap.CHANGED)
+        self.transfer(second)
+        self.assertEqual(self.transfer(first).code, coap.REQUEST_ENTITY_INCOMPLETE)
+        self.assertEqual(self.server.endpoint.resource.children[b'a'].received, [])
+        self.clock.advance(coap.REQUEST_TIMEOUT)
+        self.assertEqual(len(self.sessions), 0)
+        self.assertEqual(self.sessions.size, 0)
+
+    def test_bufferLimit(self):
+        self.startUpload(b'a')
+        self.clock.pump([0.01] * 140)
+        self.assertEqual(self.sessions.evictions, 0)
+        self.startUpload(b'b')
+        self.assertEqual([key[0] for key in self.sessions], [b'/b'])
+        self.assertTrue(self.sessions.size <= 4096)
+
+    def test_size1TooLarge(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD + b"!"))
+        response = self.transfer(d)
+        self.assertEqual(response.code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response.opt.size1, len(PAYLOAD))
+        self.assertEqual(self.client_link.stats.packets_sent, 1)
+        self.assertEqual(len(self.sessions), 0)
+
+    def test_runningSizeTooLarge(self):
+        chunks = [PAYLOAD, b"!"]
+        d = self.client.request(self.makeRequest(coap.PUT), block1Producer=iter(chunks))
+        response = self.transfer(d)
+        self.assertEqual(response.code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(self.blob.received, [])
+        self.assertEqual(len(self.sessions), 0)
+
+
+class SpoolingResource(resource.CoAPResource):
+
+    def __init__(self):
+        resource.CoAPResource.__init__(self)
+        self.bodies = []
+
+    def render_PUT(self, request):
+        if request.body is not None:
+            self.bodies.append((request.payload, request.body.read()))
+            request.body.close()
+        else:
+            self.bodies.append((request.payload, None))
+        return defer.succeed(coap.Message(code=coap.CHANGED))
+
+
+class TestSpooledUpload(ProtocolTestCase):
+
+    def serverOptions(self):
+        return {'spool_threshold': 1024}
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.target = SpoolingResource()
+        self.server.endpoint.resource.putChild(b'blob', self.target)
+
+    def test_spooled(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD))
+        self.clock.pump([0.01] * 100)
+        self.assertEqual(len(self.server.incoming_requests), 1)
+        self.assertEqual(self.server.incoming_requests.size, 0)
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.target.bodies, [(b"", PAYLOAD)])
+
+    def test_belowThreshold(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD[:1000]))
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.target.bodies, [(PAYLOAD[:1000], None)])
+
+    def test_discarded(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD))
+        self.clock.pump([0.01] * 100)
+        body = list(self.server.incoming_requests.values())[0].assembled_request.body
+        self.client_link.loss = 1.0
+        impairment.runUntilFired(self.clock, d, limit=coap.REQUEST_TIMEOUT + coap.MAX_TRANSMIT_WAIT + 10)
+        self.assertTrue(body.closed)
+        self.assertEqual(self.target.bodies, [])
+
+
+class TestEarlyRejection(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.blob.accepted_content_formats = (coap.media_types_rev['application/octet-stream'],)
+        self.blob.max_body_size = 4096
+
+    def upload(self, path=b'blob', payload=PAYLOAD[:4096], content_format=42):
+        request = self.makeRequest(coap.PUT, payload)
+        request.opt.uri_path = (path,)
+        if content_format is not None:
+            request.opt.content_format = content_format
+        return self.transfer(self.client.request(request))
+
+    def test_accepted(self):
+        self.assertEqual(self.upload().code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD[:4096]])
+
+    def test_notFound(self):
+        self.assertEqual(self.upload(path=b'missing').code, coap.NOT_FOUND)
+        self.assertEqual(self.client_link.stats.packets_sent, 1)
+
+    def test_methodNotAllowed(self):
+        self.server.endpoint.resource.putChild(b'readonly', resource.FileResource(self.tempPath()))
+        self.assertEqual(self.upload(path=b'readonly').code, coap.METHOD_NOT_ALLOWED)
+        self.assertEqual(self.client_link.stats.packets_sent, 1)
+
+    def test_contentFormat(self):
+        self.assertEqual(self.upload(content_format=0).code, coap.UNSUPPORTED_CONTENT_FORMAT)
+        self.assertEqual(self.upload(payload=b"short", content_format=None).code, coap.UNSUPPORTED_CONTENT_FORMAT)
+        self.assertEqual(self.client_link.stats.packets_sent, 2)
+        self.assertEqual(self.blob.received, [])
+        self.assertEqual(self.transfer(self.client.request(self.makeRequest())).code, coap.CONTENT)
+
+    def test_bodySize(self):
+        response = self.upload(payload=PAYLOAD)
+        self.assertEqual(response.code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response.opt.size1, 4096)
+        self.assertEqual(self.client_link.stats.packets_sent, 1)
+        self.blob.max_body_size = 16
+        response = self.upload(payload=PAYLOAD[:32])
+        self.assertEqual(response.code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response.opt.size1, 16)
+        self.assertEqual(self.blob.received, [])
+
+
+class TestQBlock(ProtocolTestCase):
+
+    def test_uintSequence(self):
+        numbers = [0, 23, 24, 255, 256, 65535, 65536, 2 ** 32]
+        encoded = coap.encodeUintSequence(numbers)
+        self.assertEqual(encoded[:3], b'\x00\x17\x18')
+        self.assertEqual(coap.decodeUintSequence(encoded), numbers)
+        self.assertRaises(ValueError, coap.decodeUintSequence, b'\x20')
+
+    def test_download(self):
+        response = self.transfer(self.client.request(self.makeRequest(), qBlock=True, blockSizeExp=6))
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(response.opt.qblock2, None)
+        self.assertEqual(self.server_link.stats.packets_sent, len(PAYLOAD) // 1024)
+        self.assertEqual(self.client.outgoing_requests, {})
+
+    def test_upload(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD), qBlock=True)
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD])
+        self.assertEqual(self.client_link.stats.packets_sent, len(PAYLOAD) // 64)
+        self.clock.advance(coap.NON_PARTIAL_TIMEOUT)
+        self.assertEqual(len(self.server.incoming_requests), 0)
+
+    def sendBlock(self, number, more=False):
+        request = self.makeRequest(coap.PUT, b"x" * 1024)
+        request.mtype = coap.NON
+        request.opt.qblock1 = (number, more, 6)
+        return self.transfer(self.client.request(request, blockSizeExp=6))
+
+    def test_hugeBlockNumber(self):
+        start = timeit.default_timer()
+        self.assertEqual(self.sendBlock(2 ** 23).code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertTrue(timeit.default_timer() - start < 0.1)
+        self.assertEqual(len(self.server.incoming_requests), 0)
+        self.assertEqual(self.blob.received, [])
+
+    def test_blockNumberOverBodyLimit(self):
+        self.server.incoming_requests.max_body_size = 64 * 1024
+        response = self.sendBlock(64, more=True)
+        self.assertEqual(response.code, coap.REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response.opt.size1, 64 * 1024)
+
+    def test_missingReport(self):
+        self.sendBlock(0, more=True)
+        request = self.makeRequest(coap.PUT, b"x" * 1024)
+        request.mtype = coap.NON
+        request.opt.qblock1 = (4000, True, 6)
+        self.client.sendMessage(request)
+        self.clock.advance(0.02)
+        receiver = self.server.incoming_requests[(b'/blob', (ip_address(CLIENT_ADDRESS[0]), CLIENT_ADDRESS[1]))]
+        self.assertEqual(receiver.highest, 4000)
+        self.assertEqual(coap.missingBlocks(receiver.blocks, receiver.next_missing, receiver.highest, coap.MAX_PAYLOADS),
+                         list(range(1, 11)))
+
+
+class TestQBlockLossy(ProtocolTestCase):
+
+    def linkProfile(self):
+        return dict(seed=7, loss=0.2, delay=impairment.constantDelay(0.2))
+
+    def test_download(self):
+        d = self.client.request(self.makeRequest(), qBlock=True, blockSizeExp=4)
+        transfer, = self.client.outgoing_requests.values()
+        response = self.transfer(d)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertTrue(self.server_link.stats.dropped > 0)
+        self.assertTrue(transfer.recovered > 0)
+        # Only missing blocks are sent again
+        self.assertTrue(self.server_link.stats.packets_sent < 2 * len(PAYLOAD) // 256)
+
+    def test_upload(self):
+        d = self.client.request(self.makeRequest(coap.PUT, PAYLOAD), qBlock=True, blockSizeExp=4)
+        transfer, = self.client.outgoing_requests.values()
+        self.assertEqual(self.transfer(d).code, coap.CHANGED)
+        self.assertEqual(self.blob.received, [PAYLOAD])
+        self.assertTrue(self.client_link.stats.dropped > 0)
+        self.assertTrue(transfer.recovered > 0)
+        self.assertTrue(self.client_link.stats.packets_sent < 2 * len(PAYLOAD) // 256)
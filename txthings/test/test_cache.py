@@ -0,0 +1,203 @@
+"""
+Tests for server and client response caches and ETag validation.
+"""
+from txthings import coap
+from txthings import resource
+from txthings.test.support import PAYLOAD, BlobResource, ProtocolTestCase
+
+
+class TestResponseCache(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.blob.response_cache = resource.ResponseCache(max_size=2 * len(PAYLOAD) + 64)
+
+    def get(self, query=(), host=None):
+        request = self.makeRequest()
+        request.opt.uri_query = query
+        request.opt.uri_host = host
+        return self.transfer(self.client.request(request))
+
+    def test_hit(self):
+        self.assertEqual(self.get().payload, PAYLOAD)
+        response = self.get()
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(response.opt.etag, coap.generateETag(PAYLOAD))
+        self.assertEqual(self.blob.renders, 1)
+        self.assertEqual(self.blob.response_cache.hits, 1)
+        self.get((b'n=1',))
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_virtualHosts(self):
+        self.get(host=b"a.example")
+        self.get(host=b"b.example")
+        self.get(host=b"a.example")
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_updatedState(self):
+        self.get()
+        self.blob.payload = PAYLOAD[::-1]
+        self.blob.updatedState()
+        self.assertEqual(self.get().payload, PAYLOAD[::-1])
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_maxAge(self):
+        self.get()
+        self.clock.advance(coap.DEFAULT_MAX_AGE)
+        self.get()
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_maxSize(self):
+        cache = self.blob.response_cache
+        for n in range(3):
+            self.get((b'n=%d' % n,))
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.size, cache.max_size)
+        self.get((b'n=0',))
+        self.assertEqual(self.blob.renders, 4)
+
+    def test_notCached(self):
+        cache = resource.ResponseCache()
+        response = coap.Message(code=coap.CONTENT, payload=b"x")
+        response.opt.max_age = 0
+        cache.put(b'key', response, 0)
+        cache.put(b'other', coap.Message(code=coap.NOT_FOUND), 0)
+        self.assertEqual(len(cache), 0)
+        response.opt.max_age = 5
+        cache.put(b'key', response, 0)
+        self.assertEqual(cache.get(b'key', 4).payload, b"x")
+        self.assertEqual(cache.get(b'key', 5), None)
+
+
+class TestValidation(ProtocolTestCase):
+
+    def get(self, etags=()):
+        request = self.makeRequest()
+        request.opt.etags = etags
+        return self.transfer(self.client.request(request))
+
+    def test_contentETag(self):
+        etag = self.get().opt.etag
+        self.assertEqual(etag, coap.generateETag(PAYLOAD))
+        packets = self.server_link.stats.packets_sent
+        response = self.get([b'other', etag])
+        self.assertEqual(response.code, coap.VALID)
+        self.assertEqual(response.opt.etag, etag)
+        self.assertFalse(response.payload)
+        self.assertEqual(self.server_link.stats.packets_sent - packets, 1)
+        self.assertEqual(self.blob.renders, 2)
+        self.blob.payload = PAYLOAD[::-1]
+        self.assertEqual(self.get([etag]).code, coap.CONTENT)
+
+    def test_versionETag(self):
+        self.blob.etag_mode = resource.ETAG_VERSION
+        etag = self.get().opt.etag
+        self.assertEqual(self.get([etag]).code, coap.VALID)
+        self.assertEqual(self.blob.renders, 1)
+        self.blob.updatedState()
+        response = self.get([etag])
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertNotEqual(response.opt.etag, etag)
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_versionETagVariants(self):
+        self.blob.etag_mode = resource.ETAG_VERSION
+        etag = self.get().opt.etag
+        request = self.makeRequest()
+        request.opt.uri_query = (b'format=short',)
+        request.opt.etags = [etag]
+        response = self.transfer(self.client.request(request))
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertNotEqual(response.opt.etag, etag)
+        request = self.makeRequest()
+        request.opt.accept = 50
+        request.opt.etags = [etag]
+        self.assertEqual(self.transfer(self.client.request(request)).code, coap.CONTENT)
+        self.assertEqual(self.get([etag]).code, coap.VALID)
+
+    def test_versionETagReload(self):
+        self.blob.etag_mode = resource.ETAG_VERSION
+        etag = self.get().opt.etag
+        reloaded = BlobResource(PAYLOAD[::-1])
+        reloaded.etag_mode = resource.ETAG_VERSION
+        self.server.endpoint.resource.putChild(b'blob', reloaded)
+        response = self.get([etag])
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD[::-1])
+
+    def test_smallResponse(self):
+        self.blob.payload = b"small"
+        self.assertEqual(self.get().opt.etag, None)
+        self.blob.etag_mode = resource.ETAG_CONTENT
+        etag = self.get().opt.etag
+        self.assertEqual(etag, coap.generateETag(b"small"))
+        self.assertEqual(self.get([etag]).code, coap.VALID)
+
+
+class TestClientCache(ProtocolTestCase):
+
+    def clientOptions(self):
+        self.cache = coap.ClientCache(max_entries=2)
+        return {'client_cache': self.cache}
+
+    def get(self, query=()):
+        request = self.makeRequest()
+        request.opt.uri_query = query
+        return self.transfer(self.client.request(request))
+
+    def test_fresh(self):
+        self.assertEqual(self.get().payload, PAYLOAD)
+        packets = self.client_link.stats.packets_sent
+        response = self.get()
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.client_link.stats.packets_sent, packets)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.blob.renders, 1)
+
+    def test_revalidation(self):
+        self.get()
+        self.clock.advance(coap.DEFAULT_MAX_AGE)
+        packets = self.server_link.stats.packets_sent
+        response = self.get()
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.server_link.stats.packets_sent - packets, 1)
+        self.assertEqual(self.cache.revalidations, 1)
+        self.get()
+        self.assertEqual(self.blob.renders, 2)
+        self.blob.payload = PAYLOAD[::-1]
+        self.clock.advance(coap.DEFAULT_MAX_AGE)
+        self.assertEqual(self.get().payload, PAYLOAD[::-1])
+        self.assertEqual(self.cache.size, len(PAYLOAD))
+
+    def test_bounds(self):
+        for n in range(3):
+            self.get((b'n=%d' % n,))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.size, 2 * len(PAYLOAD))
+        self.get((b'n=0',))
+        self.assertEqual(self.blob.renders, 4)
+        request = self.makeRequest()
+        request.opt.observe = 0
+        self.assertFalse(self.cache.accepts(request))
+
+    def test_requestNotModified(self):
+        self.get()
+        self.clock.advance(coap.DEFAULT_MAX_AGE)
+        request = self.makeRequest()
+        self.assertEqual(self.transfer(self.client.request(request)).payload, PAYLOAD)
+        self.assertEqual(self.cache.revalidations, 1)
+        self.assertEqual(request.opt.etags, [])
+
+    def test_evictedDuringRevalidation(self):
+        self.get()
+        self.clock.advance(coap.DEFAULT_MAX_AGE)
+        d = self.client.request(self.makeRequest())
+        self.cache.remove(list(self.cache.entries)[0])
+        response = self.transfer(d)
+        self.assertEqual(response.code, coap.CONTENT)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertEqual(self.blob.renders, 3)
+        self.assertEqual(len(self.cache), 1)
@@ -0,0 +1,57 @@
+"""
+Tests for client request handling (coalescing of identical requests).
+"""
+from twisted.internet import defer
+from txthings import coap
+from txthings.test.support import PAYLOAD, BlobResource, ProtocolTestCase
+
+
+class FetchResource(BlobResource):
+
+    def render_FETCH(self, request):
+        self.renders += 1
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=request.payload * 2))
+
+
+class TestCoalescing(ProtocolTestCase):
+
+    def clientOptions(self):
+        return {'coalesce_requests': True}
+
+    def test_shared(self):
+        other_blob = BlobResource()
+        self.server.endpoint.resource.putChild(b'other', other_blob)
+        deferreds = [self.client.request(self.makeRequest()) for i in range(3)]
+        other = self.makeRequest()
+        other.opt.uri_path = (b'other',)
+        deferreds.append(self.client.request(other))
+        responses = [self.transfer(d) for d in deferreds]
+        self.assertEqual([response.payload for response in responses], [PAYLOAD] * 4)
+        self.assertNotIdentical(responses[0].opt, responses[1].opt)
+        self.assertEqual((self.blob.renders, other_blob.renders), (1, 1))
+        self.assertEqual(self.client.shared_requests, {})
+        self.transfer(self.client.request(self.makeRequest()))
+        self.assertEqual(self.blob.renders, 2)
+
+    def test_cancel(self):
+        self.blob.payload = b"small"
+        first = self.client.request(self.makeRequest())
+        second = self.client.request(self.makeRequest())
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertEqual(self.transfer(second).payload, b"small")
+        third = self.client.request(self.makeRequest())
+        third.cancel()
+        self.failureResultOf(third, defer.CancelledError)
+        self.assertEqual(self.client.outgoing_requests, {})
+        self.assertEqual(self.client.shared_requests, {})
+
+    def test_fetch(self):
+        self.server.endpoint.resource.putChild(b'fetch', FetchResource())
+        deferreds = []
+        for payload in (b"a", b"a", b"b"):
+            request = self.makeRequest(code=coap.FETCH, payload=payload)
+            request.opt.uri_path = (b'fetch',)
+            deferreds.append(self.client.request(request))
+        self.assertEqual([self.transfer(d).payload for d in deferreds], [b"aa", b"aa", b"bb"])
+        self.assertEqual(self.server.endpoint.resource.children[b'fetch'].renders, 2)
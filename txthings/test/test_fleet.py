@@ -0,0 +1,79 @@
+"""
+Tests for simulated device fleet.
+"""
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from txthings import coap
+from txthings import fleet
+from txthings import resource
+from txthings import impairment
+
+from txthings.test.support import CLIENT_ADDRESS, ProtocolTestCase
+
+
+class TestSingleSocketFleet(ProtocolTestCase):
+
+    def makeServer(self, root):
+        self.fleet = fleet.DeviceFleet(clock=self.clock, seed=1)
+        self.behavior = fleet.DeviceBehavior(latency=0.2, observe_interval=5.0, payload_size=100)
+        self.fleet.addDevices(500, behavior=self.behavior)
+        return self.fleet.protocol
+
+    def tearDown(self):
+        self.fleet.stop()
+
+    def deviceRequest(self, device, path, code=coap.GET, payload=b""):
+        request = self.makeRequest(code, payload, path)
+        request.opt.uri_host = device
+        return request
+
+    def test_demultiplexing(self):
+        requests = [self.client.request(self.deviceRequest(b'dev-%d' % i, (b'sensors', b'temp')))
+                    for i in (0, 17, 499)]
+        outcome = self.transfer(defer.gatherResults(requests), limit=10)
+        payloads = [response.payload for response in outcome]
+        self.assertEqual(len(payloads[0]), 100)
+        self.assertTrue(payloads[0].startswith(b'dev-0/temp='))
+        self.assertTrue(payloads[1].startswith(b'dev-17/temp='))
+        self.assertTrue(payloads[2].startswith(b'dev-499/temp='))
+
+    def test_deviceState(self):
+        d = self.client.request(self.deviceRequest(b'dev-3', (b'config',), coap.PUT, b'{"on": 1}'))
+        self.assertEqual(self.transfer(d, limit=10).code, coap.CHANGED)
+        d = defer.gatherResults([self.client.request(self.deviceRequest(b'dev-%d' % i, (b'config',)))
+                                 for i in (3, 4)])
+        self.assertEqual([r.payload for r in self.transfer(d, limit=10)], [b'{"on": 1}', b'{}'])
+
+    def test_observe(self):
+        notifications = []
+        request = self.deviceRequest(b'dev-42', (b'sensors', b'humidity'))
+        request.opt.observe = 0
+        d = self.client.request(request, observeCallback=notifications.append)
+        self.transfer(d, limit=10)
+        self.clock.pump([0.05] * 220)
+        self.assertEqual(len(notifications), 2)
+        self.assertTrue(notifications[0].payload.startswith(b'dev-42/humidity='))
+
+    def test_unknownDevice(self):
+        d = self.client.request(self.deviceRequest(b'nosuchdevice', (b'config',)))
+        d.addErrback(lambda failure: None)
+        self.clock.pump([0.1] * 5)
+        self.assertEqual(self.fleet.protocol.unroutable, 1)
+        d.cancel()
+
+
+class TestInMemoryFleet(unittest.TestCase):
+
+    def test_exchange(self):
+        clock = task.Clock()
+        devices = fleet.DeviceFleet(clock=clock)
+        devices.addDevices(50)
+        network = fleet.InMemoryNetwork(clock, delay=0.01)
+        devices.attachTo(network, ((u"10.0.%d.%d" % (i // 250, i % 250 + 1), 5683) for i in range(50)))
+        client = coap.Coap(resource.Endpoint(None), clock=clock)
+        network.attach(client, CLIENT_ADDRESS)
+        request = coap.Message(code=coap.GET)
+        request.opt.uri_path = (b'sensors', b'temp')
+        request.remote = devices.devices[b'dev-7'].address
+        outcome = impairment.runUntilFired(clock, client.request(request), limit=10)
+        self.assertTrue(outcome[0].payload.startswith(b'dev-7/temp='))
@@ -0,0 +1,84 @@
+"""
+Tests for network impairment simulator.
+"""
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from txthings import coap
+from txthings import resource
+from txthings import impairment
+
+from txthings.test.support import ProtocolTestCase
+
+PAYLOAD = b"123456789 " * 100
+
+
+class TextResource(resource.CoAPResource):
+
+    def __init__(self):
+        resource.CoAPResource.__init__(self)
+        self.text = PAYLOAD
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=self.text))
+
+
+class TestImpairedLink(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.received = []
+
+    def test_loss(self):
+        link = impairment.ImpairedLink(self.clock, loss=1.0, delay=0.1)
+        for i in range(10):
+            link.transmit(b"\x50\x01\x00\x01", self.received.append)
+        self.clock.advance(1)
+        self.assertEqual(self.received, [])
+        self.assertEqual(link.stats.dropped, 10)
+
+    def test_duplicate(self):
+        link = impairment.ImpairedLink(self.clock, duplicate=1.0, delay=0.1)
+        link.transmit(b"\x50\x01\x00\x01", self.received.append)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(link.stats.duplicated, 1)
+
+    def test_bandwidth(self):
+        link = impairment.ImpairedLink(self.clock, bandwidth=100, delay=0.0, queue_limit=150)
+        for i in range(4):
+            link.transmit(b"\x50" * 100, self.received.append)
+        self.clock.advance(1.0)
+        self.assertEqual(len(self.received), 1)
+        self.clock.advance(1.0)
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(link.stats.queue_drops, 2)
+
+    def test_reorder(self):
+        link = impairment.ImpairedLink(self.clock, delay=0.1, reorder=1.0, reorder_delay=1.0)
+        link.transmit(b"\x50\x01\x00\x01", self.received.append)
+        link.reorder = 0.0
+        link.transmit(b"\x50\x01\x00\x02", self.received.append)
+        self.clock.advance(2)
+        self.assertEqual(self.received, [b"\x50\x01\x00\x02", b"\x50\x01\x00\x01"])
+
+    def test_retransmission_count(self):
+        link = impairment.ImpairedLink(self.clock)
+        link.transmit(b"\x40\x01\x00\x01", self.received.append)
+        link.transmit(b"\x40\x01\x00\x01", self.received.append)
+        link.transmit(b"\x50\x01\x00\x01", self.received.append)
+        self.assertEqual(link.stats.con_sent, 1)
+        self.assertEqual(link.stats.con_retransmitted, 1)
+
+
+class TestLossyBlockwiseExchange(ProtocolTestCase):
+
+    def linkProfile(self):
+        return dict(seed=7, loss=0.2, delay=impairment.uniformDelay(0.05, 0.15))
+
+    def test_exchange(self):
+        self.server.endpoint.resource.putChild(b'text', TextResource())
+        request = self.makeRequest(path=(b'text',))
+        response = self.transfer(self.client.request(request), limit=coap.REQUEST_TIMEOUT * 4)
+        self.assertEqual(response.payload, PAYLOAD)
+        self.assertTrue(self.client_link.stats.dropped > 0)
+        self.assertTrue(self.client_link.stats.con_retransmitted > 0)
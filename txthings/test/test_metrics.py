@@ -0,0 +1,125 @@
+"""
+Tests for protocol metrics.
+"""
+import json
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from txthings import coap
+from txthings import metrics
+from txthings import resource
+from txthings import streaming
+
+from txthings.test.support import ProtocolTestCase
+
+
+class TextResource(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return defer.succeed(coap.Message(code=coap.CONTENT, payload=b"x" * 200))
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_cumulative(self):
+        histogram = metrics.Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.count, 4)
+
+
+class TestCoapMetrics(ProtocolTestCase):
+
+    def serverOptions(self):
+        self.server_metrics = metrics.CoapMetrics()
+        return {'metrics': self.server_metrics}
+
+    def clientOptions(self):
+        self.client_metrics = metrics.CoapMetrics()
+        return {'metrics': self.client_metrics}
+
+    def linkProfile(self):
+        return {'delay': 0.05}
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        root = self.server.endpoint.resource
+        root.putChild(b'text', TextResource())
+        well_known = resource.CoAPResource()
+        root.putChild(b'.well-known', well_known)
+        well_known.putChild(b'stats', metrics.StatsResource(self.server_metrics))
+
+    def get(self, path, accept=None):
+        request = self.makeRequest(path=path)
+        request.opt.accept = accept
+        return self.transfer(self.client.request(request), limit=300)
+
+    def test_counters(self):
+        response = self.get((b'text',))
+        self.assertEqual(len(response.payload), 200)
+        self.assertEqual(self.client_metrics.messages_sent[(coap.CON, coap.GET)], 4)
+        self.assertEqual(self.server_metrics.messages_received[(coap.CON, coap.GET)], 4)
+        self.assertEqual(self.server_metrics.messages_sent[(coap.ACK, coap.CONTENT)], 4)
+        self.assertEqual(self.client_metrics.rtt.count, 4)
+        self.assertTrue(abs(self.client_metrics.rtt.sum - 0.4) < 1e-6)
+        self.assertTrue(abs(self.client_metrics.peers[self.remote].srtt - 0.1) < 1e-6)
+        self.assertEqual(self.server_metrics.gauges()['incoming_requests'], 0)
+
+    def test_retransmissions(self):
+        self.client_link.loss = 1.0
+        outcome = self.transfer(self.client.request(self.makeRequest(path=(b'text',))), limit=300)
+        self.assertTrue(outcome.check(coap.error.RequestTimedOut))
+        self.assertEqual(self.client_metrics.retransmissions, coap.MAX_RETRANSMIT)
+        self.assertEqual(self.client_metrics.timeouts['exchange'], 1)
+        self.assertEqual(self.client_metrics.timeouts['request'], 1)
+        self.assertEqual(self.client_metrics.rtt.count, 0)
+
+    def test_statsResource(self):
+        self.get((b'text',))
+        response = self.get((b'.well-known', b'stats'))
+        self.assertEqual(response.opt.content_format, metrics.JSON_CONTENT_FORMAT)
+        snapshot = json.loads(response.payload.decode('utf-8'))
+        json_blocks = (len(response.payload) + 63) // 64
+        self.assertEqual(snapshot['messages_received']['CON 0.01'], 5)
+        response = self.get((b'.well-known', b'stats'), accept=metrics.PROMETHEUS_CONTENT_FORMAT)
+        text = response.payload.decode('utf-8')
+        self.assertIn('txthings_messages_received_total{code="0.01",type="CON"} %d\n' % (5 + json_blocks), text)
+        self.assertIn('# TYPE txthings_rtt_seconds histogram', text)
+        self.assertIn('txthings_active_exchanges 0', text)
+
+    def test_gaugesDuringQBlock(self):
+        d = self.client.request(self.makeRequest(path=(b'text',)), qBlock=True, blockSizeExp=2)
+        self.clock.advance(0.05)
+        self.assertEqual(self.client_metrics.gauges()['blockwise_sessions'], 1)
+        self.assertIn('txthings_blockwise_sessions 1', self.client_metrics.prometheusText())
+        self.assertEqual(self.client_metrics.snapshot()['gauges']['outgoing_requests'], 1)
+        response = self.transfer(d, limit=300)
+        self.assertEqual(len(response.payload), 200)
+        upload = self.makeRequest(coap.PUT, b"x" * 200, (b'text',))
+        d = self.client.request(upload, qBlock=True, blockSizeExp=2)
+        self.assertEqual(self.client_metrics.gauges()['blockwise_sessions'], 1)
+        self.transfer(d, limit=300)
+
+    def test_gaugesDuringWindow(self):
+        d = self.client.request(self.makeRequest(path=(b'text',)), blockSizeExp=0, block2Window=4)
+        self.clock.pump([0.05] * 3)
+        self.assertGreater(self.client_metrics.gauges()['outgoing_requests'], 1)
+        self.assertEqual(self.client_metrics.gauges()['blockwise_sessions'], 1)
+        self.assertEqual(len(self.transfer(d, limit=300).payload), 200)
+
+    def test_gaugesDuringStream(self):
+        consumer = streaming.BlockConsumer()
+        d = self.client.request(self.makeRequest(path=(b'text',)), blockSizeExp=0, block2Consumer=consumer)
+        self.clock.pump([0.05] * 3)
+        self.assertEqual(self.client_metrics.gauges()['blockwise_sessions'], 1)
+        self.transfer(d, limit=300)
+        self.assertEqual(consumer.received, 200)
+        self.assertEqual(self.client_metrics.gauges()['blockwise_sessions'], 0)
+
+    def test_observers(self):
+        self.server.endpoint.resource.children[b'text'].observable = True
+        request = self.makeRequest(path=(b'text',))
+        request.opt.observe = 0
+        self.transfer(self.client.request(request, blockSizeExp=6), limit=300)
+        self.assertEqual(self.server_metrics.gauges()['observers'], 1)
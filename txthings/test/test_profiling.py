@@ -0,0 +1,100 @@
+"""
+Tests for render latency profiler.
+"""
+from twisted.internet import defer, task
+from txthings import coap
+from txthings import profiling
+from txthings import resource
+
+from txthings.test.support import ProtocolTestCase
+
+
+class DelayedResource(resource.CoAPResource):
+
+    def __init__(self, clock, delay):
+        resource.CoAPResource.__init__(self)
+        self.clock = clock
+        self.delay = delay
+
+    def render_GET(self, request):
+        response = coap.Message(code=coap.CONTENT, payload=b'done')
+        return task.deferLater(self.clock, self.delay, lambda: response)
+
+    def render_PUT(self, request):
+        return defer.succeed(coap.Message(code=coap.INTERNAL_SERVER_ERROR))
+
+
+class OddResource(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return defer.succeed(b'not a message')
+
+    def render_PUT(self, request):
+        return defer.fail(ValueError())
+
+
+class TestRenderProfiler(ProtocolTestCase):
+
+    def serverOptions(self):
+        self.profiler = profiling.RenderProfiler(slow_threshold=1.0, profile_rate=1.0, timer=self.clock.seconds)
+        return {'profiler': self.profiler}
+
+    def linkProfile(self):
+        return {}
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        root = self.server.endpoint.resource
+        root.putChild(b'fast', DelayedResource(self.clock, 0.01))
+        root.putChild(b'slow', DelayedResource(self.clock, 2.0))
+        devices = resource.CoAPResource()
+        devices.putRoute('{id:int}', DelayedResource(self.clock, 0.01))
+        root.putChild(b'dev', devices)
+
+    def fetch(self, path, code=coap.GET):
+        request = self.makeRequest(code, path=path if isinstance(path, tuple) else (path,))
+        return self.transfer(self.client.request(request), limit=10)
+
+    def test_latency(self):
+        for i in range(3):
+            self.fetch(b'fast')
+        self.fetch(b'slow')
+        report = self.profiler.asDict()
+        self.assertEqual(report[u'/fast']['GET']['count'], 3)
+        self.assertEqual(report[u'/fast']['GET']['slow'], 0)
+        self.assertEqual(report[u'/fast']['GET']['in_flight'], 0)
+        self.assertEqual(report[u'/slow']['GET']['count'], 1)
+        self.assertEqual(report[u'/slow']['GET']['slow'], 1)
+        self.assertTrue(abs(report[u'/slow']['GET']['max_latency'] - 2.0) < 0.01)
+        self.assertEqual(len(self.profiler.slow_renders), 1)
+        self.assertIn('render_GET', self.profiler.slow_renders[0].profile)
+
+    def test_errors(self):
+        self.assertEqual(self.fetch(b'fast', coap.PUT).code, coap.INTERNAL_SERVER_ERROR)
+        self.assertEqual(self.profiler.asDict()[u'/fast']['PUT']['errors'], 1)
+
+    def test_invalidResult(self):
+        oddity = OddResource()
+        results = []
+        self.profiler.render(oddity, coap.Message(code=coap.GET)).addCallback(results.append)
+        self.profiler.render(oddity, coap.Message(code=coap.PUT)).addErrback(results.append)
+        self.assertEqual(results[0], b'not a message')
+        self.assertTrue(results[1].check(ValueError))
+        report = self.profiler.asDict()[u'OddResource']
+        self.assertEqual(report['GET']['errors'], 1)
+        self.assertEqual(report['PUT']['errors'], 1)
+
+    def test_report(self):
+        self.fetch(b'fast')
+        self.fetch(b'slow')
+        lines = self.profiler.report().splitlines()
+        self.assertTrue(lines[1].startswith('/slow '))
+        self.assertTrue(lines[2].startswith('/fast '))
+        self.assertIn('Slow render: GET /slow took 2.000 s', lines)
+
+    def test_routeKey(self):
+        for i in range(20):
+            self.fetch((b'dev', b'%d' % i))
+        report = self.profiler.asDict()
+        self.assertEqual(report[u'DelayedResource']['GET']['count'], 20)
+        self.assertEqual(len(self.profiler.stats), 1)
@@ -0,0 +1,154 @@
+"""
+Tests for resource tree routing.
+"""
+from twisted.trial import unittest
+from txthings import coap
+from txthings import error
+from txthings import resource
+
+
+class DynamicResource(resource.CoAPResource):
+
+    def getChild(self, path, request):
+        if path.startswith(b'item'):
+            child = resource.CoAPResource()
+            child.name = path
+            return child
+        raise error.NoResource()
+
+
+class TestRoutingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = resource.CoAPResource()
+        self.sensors = resource.CoAPResource()
+        self.temperature = resource.CoAPResource()
+        self.sensors.putChild(b'temperature', self.temperature)
+        self.root.putChild(b'sensors', self.sensors)
+        self.endpoint = resource.Endpoint(self.root)
+
+    def lookup(self, *path):
+        request = coap.Message(code=coap.GET)
+        request.prepath = []
+        request.postpath = list(path)
+        return self.endpoint.getResourceFor(request), request
+
+    def test_static(self):
+        found, request = self.lookup(b'sensors', b'temperature')
+        self.assertIdentical(found, self.temperature)
+        self.assertEqual(request.prepath, [b'sensors', b'temperature'])
+        self.assertEqual(request.postpath, [])
+        self.assertIdentical(self.lookup()[0], self.root)
+        self.assertEqual(len(self.endpoint.routes), 3)
+
+    def test_putChild(self):
+        humidity = resource.CoAPResource()
+        humidity.putChild(b'history', resource.CoAPResource())
+        self.sensors.putChild(b'humidity', humidity)
+        self.assertIdentical(self.endpoint.routes.get((b'sensors', b'humidity')), humidity)
+        self.assertIn((b'sensors', b'humidity', b'history'), self.endpoint.routes.routes)
+        replacement = resource.CoAPResource()
+        self.sensors.putChild(b'humidity', replacement)
+        self.assertIdentical(self.lookup(b'sensors', b'humidity')[0], replacement)
+        self.assertNotIn((b'sensors', b'humidity', b'history'), self.endpoint.routes.routes)
+
+    def test_delEntity(self):
+        self.root.delEntity(b'sensors')
+        self.assertEqual(list(self.endpoint.routes.routes), [()])
+        self.assertRaises(error.NoResource, self.lookup, b'sensors', b'temperature')
+        self.assertEqual(self.temperature.routing, None)
+
+    def test_sharedTree(self):
+        other = resource.Endpoint(self.root)
+        request = coap.Message(code=coap.GET)
+        request.prepath = []
+        request.postpath = [b'sensors', b'temperature']
+        self.assertIdentical(other.getResourceFor(request), self.temperature)
+        self.sensors.delEntity(b'temperature')
+        for endpoint in (self.endpoint, other):
+            request.prepath = []
+            request.postpath = [b'sensors', b'temperature']
+            self.assertRaises(error.NoResource, endpoint.getResourceFor, request)
+        humidity = resource.CoAPResource()
+        self.sensors.putChild(b'humidity', humidity)
+        self.assertIdentical(self.endpoint.routes.get((b'sensors', b'humidity')), humidity)
+        self.assertIdentical(other.routes.get((b'sensors', b'humidity')), humidity)
+        self.assertEqual(len(humidity.routing), 2)
+
+    def test_dynamic(self):
+        self.root.putChild(b'dynamic', DynamicResource())
+        found, request = self.lookup(b'dynamic', b'item7')
+        self.assertEqual(found.name, b'item7')
+        self.assertEqual(request.prepath, [b'dynamic', b'item7'])
+        self.assertRaises(error.NoResource, self.lookup, b'dynamic', b'other')
+
+    def test_leaf(self):
+        leaf = resource.CoAPResource()
+        leaf.isLeaf = 1
+        leaf.putChild(b'hidden', resource.CoAPResource())
+        self.root.putChild(b'leaf', leaf)
+        found, request = self.lookup(b'leaf', b'hidden')
+        self.assertIdentical(found, leaf)
+        self.assertEqual(request.postpath, [b'hidden'])
+
+
+class SensorHandler(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return coap.Message(code=coap.CONTENT, payload=repr(sorted(request.route_params.items())).encode('ascii'))
+
+
+class TestRouteTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.root = resource.CoAPResource()
+        self.devices = resource.CoAPResource()
+        self.root.putChild(b'dev', self.devices)
+        self.sensor = SensorHandler()
+        self.config = SensorHandler()
+        self.raw = SensorHandler()
+        self.devices.putRoute('{id:int}/sensor/{name}', self.sensor)
+        self.devices.putRoute('{id:int}/config', self.config)
+        self.devices.putRoute('{key:bytes}/config', self.raw)
+        self.endpoint = resource.Endpoint(self.root)
+
+    def lookup(self, *path):
+        request = coap.Message(code=coap.GET)
+        request.prepath = []
+        request.postpath = list(path)
+        return self.endpoint.getResourceFor(request), request
+
+    def test_match(self):
+        found, request = self.lookup(b'dev', b'17', b'sensor', b'temp')
+        self.assertIdentical(found, self.sensor)
+        self.assertEqual(request.route_params, {'id': 17, 'name': u'temp'})
+        self.assertEqual(request.prepath, [b'dev', b'17', b'sensor', b'temp'])
+        self.assertEqual(request.postpath, [])
+        other, request = self.lookup(b'dev', b'18', b'sensor', b'humidity')
+        self.assertIdentical(other, found)
+        self.assertEqual(request.route_params, {'id': 18, 'name': u'humidity'})
+
+    def test_types(self):
+        found, request = self.lookup(b'dev', b'17', b'config')
+        self.assertIdentical(found, self.config)
+        found, request = self.lookup(b'dev', b'abc', b'config')
+        self.assertIdentical(found, self.raw)
+        self.assertEqual(request.route_params, {'key': b'abc'})
+        self.assertRaises(error.NoResource, self.lookup, b'dev', b'abc', b'sensor', b'temp')
+
+    def test_canonicalInt(self):
+        self.assertEqual(self.lookup(b'dev', b'0', b'sensor', b'temp')[1].route_params['id'], 0)
+        for segment in (b'007', b'+7', b' 7', b'7 ', b'-7', b'7_0', b'\xd9\xa7', b''):
+            self.assertRaises(error.NoResource, self.lookup, b'dev', segment, b'sensor', b'temp')
+
+    def test_precedence(self):
+        static = resource.CoAPResource()
+        self.devices.putChild(b'17', static)
+        self.assertIdentical(self.lookup(b'dev', b'17')[0], static)
+        self.assertIdentical(self.lookup(b'dev', b'18', b'config')[0], self.config)
+
+    def test_remainingPath(self):
+        self.assertRaises(error.NoResource, self.lookup, b'dev', b'17', b'sensor', b'temp', b'history')
+
+    def test_invalidType(self):
+        self.assertRaises(ValueError, self.devices.putRoute, '{id:float}', self.sensor)
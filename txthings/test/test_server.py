@@ -0,0 +1,147 @@
+"""
+Tests for server request handling (shared and synchronous renders).
+"""
+from twisted.internet import defer
+from txthings import coap
+from txthings import resource
+from txthings.test.support import ProtocolTestCase
+
+
+class SlowResource(resource.CoAPResource):
+
+    single_flight = True
+
+    def __init__(self, clock):
+        resource.CoAPResource.__init__(self)
+        self.clock = clock
+        self.renders = 0
+
+    def render_GET(self, request):
+        self.renders += 1
+        d = defer.Deferred()
+        self.clock.callLater(2.0, d.callback, coap.Message(code=coap.CONTENT, payload=b"slow %d" % self.renders))
+        return d
+
+
+class TestSingleFlight(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.slow = SlowResource(self.clock)
+        self.server.endpoint.resource.putChild(b'slow', self.slow)
+
+    def get(self, query=(), host=None):
+        request = self.makeRequest()
+        request.opt.uri_path = (b'slow',)
+        request.opt.uri_query = query
+        request.opt.uri_host = host
+        return self.client.request(request)
+
+    def test_shared(self):
+        deferreds = [self.get() for i in range(5)]
+        other = self.get((b'n=1',))
+        responses = [self.transfer(d) for d in deferreds]
+        self.assertEqual([response.payload for response in responses], [b"slow 1"] * 5)
+        self.assertEqual(len(set(response.token for response in responses)), 5)
+        self.assertEqual(self.transfer(other).payload, b"slow 2")
+        self.assertEqual(self.server.shared_renders, {})
+        self.assertEqual(self.transfer(self.get()).payload, b"slow 3")
+
+    def test_virtualHosts(self):
+        first = self.get(host=b"a.example")
+        second = self.get(host=b"b.example")
+        self.assertEqual(self.transfer(first).payload, b"slow 1")
+        self.assertEqual(self.transfer(second).payload, b"slow 2")
+
+    def test_perPeer(self):
+        self.slow.single_flight_per_peer = True
+        first = self.get()
+        second = self.get()
+        request = self.makeRequest()
+        request.opt.uri_path = (b'slow',)
+        request.mtype = coap.CON
+        request.mid = 1
+        request.token = b'other'
+        self.server.datagramReceived(request.encode(), (u"192.168.37.3", 61616))
+        # Request of the other peer arrives first (no link delay)
+        self.assertEqual(self.transfer(first).payload, b"slow 2")
+        self.assertEqual(self.transfer(second).payload, b"slow 2")
+        self.assertEqual(self.slow.renders, 2)
+
+
+class PlainResource(resource.CoAPResource):
+
+    def render_GET(self, request):
+        return coap.Message(code=coap.CONTENT, payload=b"plain")
+
+
+class TestSynchronousRender(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.server.endpoint.resource.putChild(b'plain', PlainResource())
+        self.server.endpoint.resource.putChild(b'slow', SlowResource(self.clock))
+
+    def emptyAckTimers(self):
+        return [call for call in self.clock.getDelayedCalls() if call.func.__name__ == 'sendEmptyAck']
+
+    def get(self, path):
+        request = self.makeRequest()
+        request.opt.uri_path = (path,)
+        d = self.client.request(request)
+        self.clock.advance(0.01)
+        return d
+
+    def test_fastPath(self):
+        for path in (b'blob', b'plain'):
+            d = self.get(path)
+            self.assertEqual(self.emptyAckTimers(), [])
+            self.assertEqual(self.transfer(d).code, coap.CONTENT)
+        self.assertEqual(self.transfer(self.get(b'plain')).payload, b"plain")
+
+    def test_pendingRender(self):
+        d = self.get(b'slow')
+        self.assertEqual(len(self.emptyAckTimers()), 1)
+        self.assertEqual(self.transfer(d).payload, b"slow 1")
+
+
+class FaultyResource(resource.CoAPResource):
+
+    observable = True
+    broken = False
+
+    def render_GET(self, request):
+        if self.broken:
+            raise ZeroDivisionError()
+        return coap.Message(code=coap.CONTENT, payload=b"ok")
+
+
+class TestRenderErrors(ProtocolTestCase):
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+        self.faulty = FaultyResource()
+        self.server.endpoint.resource.putChild(b'faulty', self.faulty)
+
+    def get(self, observeCallback=None):
+        request = self.makeRequest()
+        request.opt.uri_path = (b'faulty',)
+        if observeCallback is not None:
+            request.opt.observe = 0
+        return self.transfer(self.client.request(request, observeCallback=observeCallback))
+
+    def test_internalServerError(self):
+        self.faulty.broken = True
+        self.assertEqual(self.get().code, coap.INTERNAL_SERVER_ERROR)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_observers(self):
+        notifications = []
+        for i in range(2):
+            self.assertEqual(self.get(notifications.append).code, coap.CONTENT)
+        self.assertEqual(len(self.faulty.observers), 2)
+        self.faulty.broken = True
+        self.faulty.updatedState()
+        self.clock.pump([0.01] * 10)
+        self.assertEqual([response.code for response in notifications], [coap.INTERNAL_SERVER_ERROR] * 2)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 2)
@@ -0,0 +1,76 @@
+"""
+Tests for SQLite-backed lazy resource container.
+"""
+from twisted.internet import task
+from twisted.trial import unittest
+from txthings import coap
+from txthings import error
+from txthings import resource
+from txthings import store
+
+
+class TestLazyContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.store = store.SQLiteStore()
+        self.store.save([(b"dev%d" % i, b"state%d" % i) for i in range(100)])
+        self.container = store.LazyContainer(self.store, max_live=10, flush_interval=1.0,
+                                             batch_size=4, clock=self.clock)
+        root = resource.CoAPResource()
+        root.putChild(b'devices', self.container)
+        self.endpoint = resource.Endpoint(root)
+
+    def lookup(self, name):
+        request = coap.Message(code=coap.GET)
+        request.prepath = []
+        request.postpath = [b'devices', name]
+        return self.endpoint.getResourceFor(request)
+
+    def test_loadOnDemand(self):
+        child = self.lookup(b'dev7')
+        self.assertEqual(child.state, b"state7")
+        self.assertIdentical(self.lookup(b'dev7'), child)
+        self.assertEqual(self.container.loads, 1)
+        self.assertRaises(error.NoResource, self.lookup, b'missing')
+
+    def test_eviction(self):
+        for i in range(30):
+            self.lookup(b"dev%d" % i)
+        self.assertEqual(len(self.container.live), 10)
+        self.assertEqual(list(self.container.live), [b"dev%d" % i for i in range(20, 30)])
+        self.assertEqual(self.container.evictions, 20)
+
+    def test_observedPinned(self):
+        observed = self.lookup(b'dev0')
+        observed.observers[('remote', b'token')] = object()
+        for i in range(1, 30):
+            self.lookup(b"dev%d" % i)
+        self.assertIdentical(self.lookup(b'dev0'), observed)
+        self.assertEqual(len(self.container.live), 10)
+
+    def test_writeBack(self):
+        transactions = self.store.transactions
+        for i in range(10):
+            child = self.lookup(b"dev%d" % i)
+            child.loadState(b"changed%d" % i)
+            child.markDirty()
+        for i in range(10, 30):
+            self.lookup(b"dev%d" % i)
+        # changed resources stay in memory until written
+        self.assertEqual(len(self.container.live), 11)
+        self.assertEqual(self.store.load(b'dev3'), b"state3")
+        self.clock.advance(1.0)
+        self.assertEqual(self.store.transactions - transactions, 3)
+        self.assertEqual(self.store.load(b'dev3'), b"changed3")
+        self.assertEqual(len(self.container.live), 10)
+        self.assertEqual(self.lookup(b'dev3').state, b"changed3")
+
+    def test_putAndDelete(self):
+        self.container.putStored(b'new', store.StoredResource(b"fresh"))
+        self.assertEqual(self.lookup(b'new').state, b"fresh")
+        self.container.flush()
+        self.assertEqual(len(self.store), 101)
+        self.container.delStored(b'new')
+        self.assertRaises(error.NoResource, self.lookup, b'new')
+        self.assertEqual(len(self.store), 100)